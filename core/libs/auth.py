@@ -1,6 +1,326 @@
 # coding: utf8
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 
-from ldap3 import Server, Connection, ALL, SUBTREE
+from django.conf import settings
+from ldap3 import Server, Connection, DSA, SUBTREE, BASE
+from ldap3.core.exceptions import LDAPException, LDAPCommunicationError, LDAPResponseTimeoutError
+from ldap3.utils.conv import escape_filter_chars
+
+LDAP_POOL_SIZE = getattr(settings, "LDAP_POOL_SIZE", 10)
+# 连接空闲超过该时间（秒）后，使用前先进行一次健康检查
+LDAP_POOL_IDLE_CHECK = getattr(settings, "LDAP_POOL_IDLE_CHECK", 60)
+LDAP_CONNECT_TIMEOUT = getattr(settings, "LDAP_CONNECT_TIMEOUT", 3)
+LDAP_RECEIVE_TIMEOUT = getattr(settings, "LDAP_RECEIVE_TIMEOUT", 5)
+LDAP_UNAVAILABLE_ERRORS = (LDAPCommunicationError, LDAPResponseTimeoutError)
+
+
+LDAP_MAX_WORKERS = getattr(settings, "LDAP_MAX_WORKERS", LDAP_POOL_SIZE)
+# 等待空闲LDAP工作线程的最长时间（秒），超时后直接拒绝本次登录
+LDAP_SLOT_TIMEOUT = getattr(settings, "LDAP_SLOT_TIMEOUT", 0.5)
+LDAP_OPERATION_TIMEOUT = getattr(settings, "LDAP_OPERATION_TIMEOUT", LDAP_CONNECT_TIMEOUT + LDAP_RECEIVE_TIMEOUT)
+# 连续失败达到阈值后熔断，熔断LDAP_CIRCUIT_RESET_TIMEOUT秒后放行一次试探请求
+LDAP_CIRCUIT_FAILURE_THRESHOLD = getattr(settings, "LDAP_CIRCUIT_FAILURE_THRESHOLD", 5)
+LDAP_CIRCUIT_RESET_TIMEOUT = getattr(settings, "LDAP_CIRCUIT_RESET_TIMEOUT", 30)
+
+
+# LDAP服务器无法连接或响应超时
+class LDAPUnavailable(Exception):
+    pass
+
+
+# LDAP工作线程已满
+class LDAPBusy(LDAPUnavailable):
+    pass
+
+
+# LDAP熔断器处于打开状态
+class LDAPCircuitOpen(LDAPUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=LDAP_CIRCUIT_FAILURE_THRESHOLD, reset_timeout=LDAP_CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_time = None
+        self.__trial_running = False
+        self.__lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_time is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_time >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    # 半开状态下只放行一个试探请求
+    def allow(self):
+        with self.__lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.__trial_running:
+                self.__trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.__lock:
+            self.failures = 0
+            self.opened_time = None
+            self.__trial_running = False
+
+    def record_failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.__trial_running or self.failures >= self.failure_threshold:
+                self.opened_time = time.monotonic()
+            self.__trial_running = False
+
+    def to_dict(self):
+        return {"state": self.state, "failures": self.failures}
+
+
+class LDAPExecutor:
+    """
+    在有界线程池中执行LDAP操作，每个操作有独立的超时时间，并通过熔断器在LDAP持续异常时快速失败
+    超时的操作在线程中执行完毕前仍占用名额，保证占用的线程数不超过max_workers
+    """
+    def __init__(self, name, max_workers=LDAP_MAX_WORKERS):
+        self.name = name
+        self.max_workers = max_workers
+        self.breaker = CircuitBreaker()
+        self.__slots = threading.BoundedSemaphore(max_workers)
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ldap")
+        self.__lock = threading.Lock()
+        self.__running = 0
+
+    def run(self, func, *args, timeout=LDAP_OPERATION_TIMEOUT):
+        if not self.__slots.acquire(timeout=LDAP_SLOT_TIMEOUT):
+            raise LDAPBusy("ldap server {} is busy, please retry later".format(self.name))
+        if not self.breaker.allow():
+            self.__slots.release()
+            raise LDAPCircuitOpen("ldap server {} is unavailable, please retry later".format(self.name))
+        with self.__lock:
+            self.__running += 1
+        try:
+            future = self.__executor.submit(func, *args)
+        except Exception:
+            self.__release()
+            raise
+        future.add_done_callback(lambda f: self.__release())
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.breaker.record_failure()
+            raise LDAPUnavailable("ldap server {} operation timed out".format(self.name))
+        except LDAPUnavailable:
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def __release(self):
+        with self.__lock:
+            self.__running -= 1
+        self.__slots.release()
+
+    def to_dict(self):
+        status = self.breaker.to_dict()
+        status.update({"server": self.name, "running": self.__running, "max_workers": self.max_workers})
+        return status
+
+
+class LDAPConnectionPool:
+    """
+    进程内共享的LDAP连接池，服务器类型只检测一次
+    search连接以管理员身份（AD域为匿名）绑定并保持复用，bind连接仅用于校验用户密码，通过rebind复用同一个TCP连接
+    """
+    # 该子字段用于判断认证服务器为OpenLDAP还是Windows的AD域，带有该字段的为OpenLDAP服务器
+    __openldap_flag = 'OpenLDAProotDSE'
+
+    def __init__(self, host='localhost', port=389, admin_dn=None, admin_password=None, size=LDAP_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.server = Server(host, port=port, get_info=DSA, connect_timeout=LDAP_CONNECT_TIMEOUT)
+        self.__admin_dn = admin_dn
+        self.__admin_password = admin_password
+        self.__search_connections = queue.LifoQueue(maxsize=size)
+        self.__bind_connections = queue.LifoQueue(maxsize=size)
+        self.__lock = threading.Lock()
+        self.__is_openldap = None
+        self.executor = LDAPExecutor("{}:{}".format(host, port))
+
+    @property
+    def is_openldap(self):
+        if self.__is_openldap is None:
+            with self.__lock:
+                if self.__is_openldap is None:
+                    self.__is_openldap = self.executor.run(self.__detect_openldap)
+        return self.__is_openldap
+
+    # 仅读取root DSE判断服务器类型，不下载schema
+    def __detect_openldap(self):
+        conn = self.__new_connection()
+        try:
+            if not conn.bind():
+                raise LDAPUnavailable('connect to ldap server {}:{} failed'.format(self.host, self.port))
+            return self.__openldap_flag in self.server.info.to_json()
+        except LDAP_UNAVAILABLE_ERRORS as e:
+            raise LDAPUnavailable('connect to ldap server {}:{} failed: {}'.format(self.host, self.port, e))
+        finally:
+            self.__discard(conn)
+
+    def __new_connection(self, user=None, password=None):
+        return Connection(self.server, user=user, password=password, receive_timeout=LDAP_RECEIVE_TIMEOUT)
+
+    def __new_search_connection(self):
+        if self.is_openldap:
+            conn = self.__new_connection(self.__admin_dn, self.__admin_password)
+        else:
+            conn = self.__new_connection()
+        if not conn.bind():
+            message = conn.result['message'] if conn.result else ''
+            conn.unbind()
+            raise Exception(message or 'connect to ldap server {}:{} failed'.format(self.host, self.port))
+        return conn
+
+    # bind连接在用户密码错误后处于未绑定状态，仍可继续复用
+    @staticmethod
+    def __is_healthy(conn, require_bound=True):
+        if conn.closed or (require_bound and not conn.bound):
+            return False
+        if time.monotonic() - getattr(conn, "last_used_time", 0) < LDAP_POOL_IDLE_CHECK:
+            return True
+        try:
+            return conn.search('', '(objectClass=*)', search_scope=BASE, attributes=['1.1'])
+        except LDAPException:
+            return False
+
+    @staticmethod
+    def __release(pool, conn):
+        conn.last_used_time = time.monotonic()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.unbind()
+
+    @staticmethod
+    def __discard(conn):
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+    def __checkout(self, pool, factory, require_bound=True):
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                return factory()
+            if self.__is_healthy(conn, require_bound):
+                return conn
+            self.__discard(conn)
+
+    @contextmanager
+    def search_connection(self):
+        conn = self.__checkout(self.__search_connections, self.__new_search_connection)
+        try:
+            yield conn
+        except LDAPException:
+            self.__discard(conn)
+            raise
+        self.__release(self.__search_connections, conn)
+
+    def search(self, search_base, search_filter, attributes):
+        return self.executor.run(self.__search, search_base, search_filter, attributes)
+
+    def __search(self, search_base, search_filter, attributes):
+        # 复用的连接可能已被服务端关闭，通信异常时使用新连接重试一次
+        for retry in (True, False):
+            try:
+                with self.search_connection() as conn:
+                    if conn.search(search_base=search_base, search_filter=search_filter,
+                                   search_scope=SUBTREE, attributes=attributes):
+                        return conn.response
+                    return []
+            except LDAP_UNAVAILABLE_ERRORS as e:
+                if not retry:
+                    raise LDAPUnavailable('search on ldap server {}:{} failed: {}'.format(self.host, self.port, e))
+
+    """
+    使用用户名和密码进行绑定，绑定成功时返回该连接以便以用户身份继续查询，使用完毕后需调用release_bind_connection
+    """
+    def bind(self, user, password):
+        return self.executor.run(self.__bind, user, password)
+
+    def __bind(self, user, password):
+        for retry in (True, False):
+            conn = self.__checkout(self.__bind_connections, self.__new_connection, require_bound=False)
+            try:
+                if conn.rebind(user=user, password=password, read_server_info=False):
+                    return conn
+                self.release_bind_connection(conn)
+                return None
+            except LDAP_UNAVAILABLE_ERRORS as e:
+                self.__discard(conn)
+                if not retry:
+                    raise LDAPUnavailable('bind on ldap server {}:{} failed: {}'.format(self.host, self.port, e))
+
+    def release_bind_connection(self, conn):
+        self.__release(self.__bind_connections, conn)
+
+    # 分页查询，用于批量同步，不经过有界线程池
+    def paged_search(self, search_base, search_filter, attributes, page_size):
+        with self.search_connection() as conn:
+            for entry in conn.extend.standard.paged_search(search_base, search_filter, search_scope=SUBTREE,
+                                                           attributes=attributes, paged_size=page_size,
+                                                           generator=True):
+                yield entry
+
+    # 使用已绑定的连接查询，AD域下以用户自身身份查询用户信息
+    def search_by_connection(self, conn, search_base, search_filter, attributes):
+        def search():
+            try:
+                if conn.search(search_base=search_base, search_filter=search_filter,
+                               search_scope=SUBTREE, attributes=attributes):
+                    return conn.response
+                return []
+            except LDAP_UNAVAILABLE_ERRORS as e:
+                raise LDAPUnavailable('search on ldap server {}:{} failed: {}'.format(self.host, self.port, e))
+        return self.executor.run(search)
+
+
+ldap_pools = {}
+ldap_pools_lock = threading.Lock()
+
+
+def get_ldap_status():
+    return [pool.executor.to_dict() for pool in list(ldap_pools.values())]
+
+
+def get_ldap_pool(host, port, admin_dn=None, admin_password=None):
+    key = (host, port, admin_dn)
+    pool = ldap_pools.get(key)
+    if pool is None:
+        with ldap_pools_lock:
+            pool = ldap_pools.get(key)
+            if pool is None:
+                pool = ldap_pools[key] = LDAPConnectionPool(host, port, admin_dn, admin_password)
+    return pool
 
 
 class LDAPAuth:
@@ -8,8 +328,6 @@ class LDAPAuth:
     __search_base = None
     __attribute_list = ['cn', 'displayName', 'mail', 'member', 'mobile', 'uid']
     __search_filter_key = None
-    # 该子字段用于判断认证服务器为OpenLDAP还是Windows的AD域，带有该字段的为OpenLDAP服务器
-    __openldap_flag = 'OpenLDAProotDSE'
 
     """
     admin_dn及admin_password仅在OpenLDAP下生效
@@ -17,47 +335,73 @@ class LDAPAuth:
     def __init__(self, host='localhost', domain=None, port=389, search_base=None, admin_dn=None, admin_password=None):
         self.__domain = domain
         self.__search_base = search_base
-        self.__server = Server(host, port=port, get_info=ALL)
-        self.__conn = Connection(self.__server)
-        if self.__conn.bind():
-            if self.__openldap_flag in self.__server.info.to_json():
-                self.__search_filter_key = 'uid'
-                self.__conn = Connection(self.__server, user=admin_dn, password=admin_password)
-                if not self.__conn.bind():
-                    raise Exception(self.__conn.result['message'])
-            else:
-                self.__search_filter_key = 'sAMAccountName'
-                self.__attribute_list.append('sAMAccountName')
+        self.__pool = get_ldap_pool(host, port, admin_dn, admin_password)
+        self.__attribute_list = list(self.__attribute_list)
+        if self.__pool.is_openldap:
+            self.__search_filter_key = 'uid'
         else:
-            raise Exception('connect to ldap server {}:{} failed'.format(host, port))
+            self.__search_filter_key = 'sAMAccountName'
+            self.__attribute_list.append('sAMAccountName')
+
+    def __search_filter(self, username):
+        return '({}={})'.format(self.__search_filter_key, escape_filter_chars(username))
 
     def __search(self, username):
-        res = self.__conn.search(search_base=self.__search_base,
-                                 search_filter='({}={})'.format(self.__search_filter_key, username),
-                                 search_scope=SUBTREE, attributes=self.__attribute_list)
-        if res:
-            return self.__conn.response[0]
+        response = self.__pool.search(self.__search_base, self.__search_filter(username), self.__attribute_list)
+        if response:
+            return response[0]
         return False
 
     """
-    OpenLDAP返回的属性信息均为长度为1的列表格式，此处进行提取
+    AD域下使用用户自身绑定的连接查询用户信息
+    """
+    def __search_by_connection(self, conn, username):
+        response = self.__pool.search_by_connection(conn, self.__search_base, self.__search_filter(username),
+                                                    self.__attribute_list)
+        if response:
+            return response[0]
+        return False
+
+    """
+    未加载schema时返回的属性信息均为列表格式，此处提取第一个值；OpenLDAP使用cn作为显示名
     """
     def __pretty_user_info(self, ldap_user_info):
         user_info = {}
+        attributes = ldap_user_info['attributes']
+        for key in self.__attribute_list:
+            value = attributes.get(key, [])
+            if isinstance(value, list):
+                value = value[0] if len(value) > 0 else ''
+            user_info[key] = value
+        user_info['username'] = user_info[self.__search_filter_key]
         if self.__search_filter_key == 'uid':
-            for key in self.__attribute_list:
-                value = ldap_user_info['attributes'][key]
-                if len(value) > 0:
-                    user_info[key] = value[0]
-                else:
-                    user_info[key] = ''
-            user_info['username'] = ldap_user_info['attributes']['uid'][0]
-            user_info['displayName'] = ldap_user_info['attributes']['cn'][0]
-        else:
-            user_info = ldap_user_info
-            user_info['username'] = ldap_user_info['attributes']['sAMAccountName']
+            user_info['displayName'] = user_info['cn']
         return user_info
 
+    """
+    增量同步使用的属性，OpenLDAP为modifyTimestamp，AD域为uSNChanged
+    """
+    @property
+    def sync_attribute(self):
+        return 'modifyTimestamp' if self.__search_filter_key == 'uid' else 'uSNChanged'
+
+    """
+    分页查询所有用户，since不为空时只查询同步属性不小于since的用户，返回(用户信息, 同步属性值)的生成器
+    """
+    def search_users(self, user_filter=None, since=None, page_size=500):
+        if not user_filter:
+            user_filter = '({}=*)'.format(self.__search_filter_key)
+        if since is not None:
+            user_filter = '(&{}({}>={}))'.format(user_filter, self.sync_attribute, escape_filter_chars(str(since)))
+        attributes = self.__attribute_list + [self.sync_attribute]
+        for entry in self.__pool.paged_search(self.__search_base, user_filter, attributes, page_size):
+            if entry.get('type') != 'searchResEntry':
+                continue
+            sync_value = entry['attributes'].get(self.sync_attribute)
+            if isinstance(sync_value, list):
+                sync_value = sync_value[0] if sync_value else None
+            yield self.__pretty_user_info(entry), sync_value
+
     def auth(self, username, password):
         ldap_user_info = None
         """
@@ -74,11 +418,14 @@ class LDAPAuth:
             ldap_user = '{}@{}'.format(username, self.__domain)
 
         # 带上用户名和密码进行校验
-        self.__conn = Connection(self.__server, user=ldap_user, password=password)
-
-        if self.__conn.bind():
-            if self.__search_filter_key == 'uid':
-                return self.__pretty_user_info(ldap_user_info)
-            else:
-                return self.__search(username)['attributes']
-        return False
+        conn = self.__pool.bind(ldap_user, password)
+        if not conn:
+            return False
+        try:
+            if self.__search_filter_key != 'uid':
+                ldap_user_info = self.__search_by_connection(conn, username)
+                if not ldap_user_info:
+                    return False
+            return self.__pretty_user_info(ldap_user_info)
+        finally:
+            self.__pool.release_bind_connection(conn)
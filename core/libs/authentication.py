@@ -1,13 +1,35 @@
 # coding: utf8
 
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
 from rest_framework import exceptions
 from rest_framework.authentication import BaseAuthentication
 from core.libs import utils
+from core.libs.caches import get_token_cache, set_token_cache
+from core.libs.tokens import get_temp_token_value, load_user_snapshot, tmp_token_snapshot_fields, \
+    signed_token_verifier, get_signed_payload_snapshot
 from core.models import Token
+from utils.tokens import InvalidToken, is_signed_token
 
 UserModel = get_user_model()
+token_snapshot_user_fields = tmp_token_snapshot_fields
+
+
+def get_token_snapshot(token):
+    user = token.user
+    return {
+        "id": token.id,
+        "user": dict((field, getattr(user, field)) for field in token_snapshot_user_fields),
+    }
+
+
+# 由缓存的快照还原token及用户对象，不查询数据库
+def load_token_snapshot(snapshot, key):
+    user = UserModel(**snapshot["user"])
+    user._state.adding = False
+    token = Token(id=snapshot["id"], key=key, user=user)
+    token._state.adding = False
+    user.token = token
+    return token
 
 
 class SessionAuthentication(BaseAuthentication):
@@ -33,11 +55,17 @@ class TokenAuthentication(BaseAuthentication):
         return self.authenticate_credentials(access_token)
 
     def authenticate_credentials(self, key):
-        model = self.model
-        try:
-            token = model.objects.get(key=key)
-        except model.DoesNotExist:
-            raise exceptions.AuthenticationFailed("Invalid token")
+        # 优先使用进程内及redis中缓存的用户快照，均未命中时查询一次数据库
+        snapshot = get_token_cache(key)
+        if snapshot is None:
+            model = self.model
+            try:
+                token = model.objects.select_related("user").get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed("Invalid token")
+            snapshot = get_token_snapshot(token)
+            set_token_cache(key, snapshot)
+        token = load_token_snapshot(snapshot, key)
         if not token.user.is_active:
             raise exceptions.AuthenticationFailed("User inactive")
         return token.user, token
@@ -47,19 +75,27 @@ class TokenAuthentication(BaseAuthentication):
 
 
 class TmpTokenAuthentication(TokenAuthentication):
-    token_prefix = utils.TMP_TOKEN_PREFIX
     keyword = utils.TMP_TOKEN_HEADER_STRING
-    timeout = utils.TMP_TOKEN_TIMEOUT
 
     def authenticate_credentials(self, key):
-        token_key = "{}:{}".format(self.token_prefix, key)
-        try:
-            user_id = cache.get(token_key)
-            user = UserModel.objects.get(id=user_id)
-        except UserModel.DoesNotExist:
+        # 签名token在进程内校验签名、有效期及吊销列表，被禁用用户的token在吊销列表中
+        if is_signed_token(key):
+            try:
+                payload = signed_token_verifier.verify(key)
+            except InvalidToken:
+                raise exceptions.AuthenticationFailed("Invalid token.")
+            return load_user_snapshot(get_signed_payload_snapshot(payload)), key
+        # 一次往返读取用户快照并按需刷新临时token的过期时间
+        snapshot = get_temp_token_value(key)
+        if snapshot is None:
             raise exceptions.AuthenticationFailed("Invalid token.")
+        # 兼容旧格式中仅保存用户id的临时token
+        if not isinstance(snapshot, dict):
+            try:
+                snapshot = UserModel.objects.values(*tmp_token_snapshot_fields).get(id=snapshot)
+            except UserModel.DoesNotExist:
+                raise exceptions.AuthenticationFailed("Invalid token.")
+        user = load_user_snapshot(snapshot)
         if not user.is_active:
             raise exceptions.AuthenticationFailed("User inactive")
-        # 刷新临时token的过期时间
-        cache.expire(token_key, self.timeout)
         return user, key
@@ -1,22 +1,73 @@
 # coding: utf8
 
+import hashlib
+import hmac
+import os
 import uuid
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password
 from django.contrib.auth.backends import ModelBackend
+from django.utils import timezone
 from rest_framework import exceptions
-from core.libs.auth import LDAPAuth
+from core.libs.auth import LDAPAuth, LDAPUnavailable
+from core.libs.caches import LocalCache
 from core.models import User, Token
 from core.serializer import UserSerializer
 
 UserModel = get_user_model()
+VERIFIED_PASSWORD_CACHE_SIZE = getattr(settings, "VERIFIED_PASSWORD_CACHE_SIZE", 10000)
+VERIFIED_PASSWORD_CACHE_TIMEOUT = getattr(settings, "VERIFIED_PASSWORD_CACHE_TIMEOUT", 3600)
+LDAP_FALLBACK_ENABLED = getattr(settings, "LDAP_FALLBACK_ENABLED", False)
+LDAP_FALLBACK_MAX_AGE = getattr(settings, "LDAP_FALLBACK_MAX_AGE", 7 * 24 * 3600)
+PASSWORD_VERIFIED_TIME_INTERVAL = getattr(settings, "PASSWORD_VERIFIED_TIME_INTERVAL", 3600)
+# 进程内记录最近校验通过的本地密码哈希，使用进程随机密钥的HMAC摘要，避免重复执行耗时的密码哈希校验
+verified_password_cache = LocalCache(VERIFIED_PASSWORD_CACHE_SIZE, VERIFIED_PASSWORD_CACHE_TIMEOUT)
+verified_password_secret = os.urandom(32)
 
 
+def get_password_digest(user, password):
+    message = "{}:{}:{}".format(user.id, user._password, password).encode()
+    return hmac.new(verified_password_secret, message, hashlib.sha256).hexdigest()
+
+
+# 仅在本地保存的密码哈希无法校验通过或哈希算法参数已过期时重新生成，且只更新变化的字段
+def update_local_password(user, password):
+    update_fields = []
+    if verified_password_cache.get(user.id) != get_password_digest(user, password):
+        must_update = []
+        if not (user._password and check_password(password, user._password, setter=must_update.append)) \
+                or must_update:
+            user.password = password
+            update_fields.append("_password")
+    # 记录密码通过LDAP校验的时间，供LDAP不可用时判断本地密码哈希是否过期，未修改密码时按间隔更新
+    now = timezone.now()
+    verified_time = user.password_verified_time
+    if update_fields or not verified_time or (now - verified_time).total_seconds() > PASSWORD_VERIFIED_TIME_INTERVAL:
+        user.password_verified_time = now
+        update_fields.append("password_verified_time")
+    if update_fields:
+        user.save(update_fields=update_fields)
+    verified_password_cache.set(user.id, get_password_digest(user, password))
+
+
+# 校验本地保存的密码哈希，仅接受在LDAP_FALLBACK_MAX_AGE秒内通过LDAP校验过的密码
+def check_local_password(username, password):
+    user = User.objects.filter(username=username).first()
+    if not (user and user._password and user.password_verified_time):
+        return None
+    if (timezone.now() - user.password_verified_time).total_seconds() > LDAP_FALLBACK_MAX_AGE:
+        return None
+    if verified_password_cache.get(user.id) == get_password_digest(user, password) or user.check_password(password):
+        verified_password_cache.set(user.id, get_password_digest(user, password))
+        return user
+    return None
+
 
 def get_or_create_user(user_info):
-    user = User.objects.filter(username=user_info['username'])
-    if user.exists():
-        return user.first()
+    user = User.objects.filter(username=user_info['username']).first()
+    if user:
+        return user
     else:
         user = {
             "username": user_info['username'],
@@ -42,14 +93,25 @@ class LDAPAuthBackend(ModelBackend):
 
     def authenticate(self, request, username=None, password=None, **kwargs):
         if username and password:
-            ldap_auth = LDAPAuth(host=self.ldap_host, port=self.ldap_port, search_base=self.ldap_search_base,
-                                 admin_dn=self.admin_dn, admin_password=self.admin_password)
-            user_info = ldap_auth.auth(username, password)
+            try:
+                ldap_auth = LDAPAuth(host=self.ldap_host, port=self.ldap_port, search_base=self.ldap_search_base,
+                                     admin_dn=self.admin_dn, admin_password=self.admin_password)
+                user_info = ldap_auth.auth(username, password)
+            except LDAPUnavailable:
+                if not LDAP_FALLBACK_ENABLED:
+                    raise
+                return self.authenticate_local(username, password)
             if user_info:
                 user = get_or_create_user(user_info)
-                user.password = password
-                user.save()
+                update_local_password(user, password)
                 if self.user_can_authenticate(user):
                     return user
             else:
                 raise exceptions.AuthenticationFailed("Invalid username or password.")
+
+    # LDAP服务不可用时使用本地保存的密码哈希校验
+    def authenticate_local(self, username, password):
+        user = check_local_password(username, password)
+        if user and self.user_can_authenticate(user):
+            return user
+        raise exceptions.AuthenticationFailed("Invalid username or password.")
@@ -0,0 +1,216 @@
+# coding: utf8
+import uuid
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from rest_framework import exceptions
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.validators import UniqueValidator
+
+from core.libs import utils
+from core.libs.closure import closure_models, add_nodes, move_node
+from core.libs.signals import objects_bulk_saved
+from core.models import User, Token
+
+BULK_MAX_ITEMS = getattr(settings, "BULK_MAX_ITEMS", 5000)
+BULK_BATCH_SIZE = getattr(settings, "BULK_BATCH_SIZE", 500)
+
+
+class PreloadedRelatedField(PrimaryKeyRelatedField):
+    """
+    从预先批量查询的对象中取关联对象，避免逐条查询数据库
+    """
+    def __init__(self, objects, **kwargs):
+        self.objects = objects
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        try:
+            obj = self.objects.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if obj is None:
+            self.fail('does_not_exist', pk_value=data)
+        return obj
+
+
+def get_int_values(values):
+    int_values = set()
+    for value in values:
+        try:
+            int_values.add(int(value))
+        except (TypeError, ValueError):
+            pass
+    return int_values
+
+
+# 生成用于批量校验的序列化器：唯一性由批量查询校验，外键对象一次查询预先加载
+def get_bulk_serializer(serializer_class, items):
+    serializer = serializer_class()
+    serializer.validators = []
+    for name, field in list(serializer.fields.items()):
+        field.validators = [validator for validator in field.validators if not isinstance(validator, UniqueValidator)]
+        if isinstance(field, PrimaryKeyRelatedField) and not field.read_only:
+            pks = get_int_values(item.get(name) for item in items)
+            serializer.fields[name] = PreloadedRelatedField(field.get_queryset().in_bulk(pks),
+                                                            queryset=field.get_queryset(),
+                                                            allow_null=field.allow_null, required=field.required)
+    return serializer
+
+
+def get_unique_constraints(model):
+    constraints = [(field.name,) for field in model._meta.fields if field.unique and not field.primary_key]
+    return constraints + [tuple(fields) for fields in model._meta.unique_together]
+
+
+def get_unique_value(model, constraint, values):
+    return tuple(getattr(values.get(field), "pk", values.get(field)) for field in constraint)
+
+
+# 查询数据库中与unique_values冲突的记录，返回{唯一键值: id}，每个唯一约束一次查询
+def get_existing_unique_values(model, constraint, unique_values):
+    attnames = [model._meta.get_field(field).attname for field in constraint]
+    filters = dict(("{}__in".format(attname), set(value[i] for value in unique_values))
+                   for i, attname in enumerate(attnames))
+    return dict((tuple(row[1:]), row[0]) for row in model.objects.filter(**filters).values_list("id", *attnames))
+
+
+# 校验批量数据的唯一性，包括批次内重复及与数据库中其它记录的冲突，错误写入errors。
+# unique_fields为视图uk_name_list中的字段，与逐条新增、修改时的校验一致，按单个字段全局唯一
+def check_unique(model, validated_items, errors, unique_fields=()):
+    constraints = get_unique_constraints(model)
+    constraints += [(field,) for field in unique_fields if (field,) not in constraints]
+    for constraint in constraints:
+        unique_values = {}
+        for index, (pk, values) in validated_items.items():
+            unique_value = get_unique_value(model, constraint, values)
+            if unique_value in unique_values:
+                errors[index] = "{}: {} duplicated in batch.".format(
+                    ", ".join(constraint), ", ".join(str(value) for value in unique_value))
+            else:
+                unique_values[unique_value] = index
+        if not unique_values:
+            continue
+        existing_values = get_existing_unique_values(model, constraint, list(unique_values))
+        for unique_value, index in unique_values.items():
+            existing_pk = existing_values.get(unique_value)
+            if existing_pk is not None and existing_pk != validated_items[index][0]:
+                errors[index] = "{}: {} already exist.".format(
+                    ", ".join(constraint), ", ".join(str(value) for value in unique_value))
+
+
+def check_items(items):
+    if not isinstance(items, list):
+        raise exceptions.ParseError("parameter items is null or not a list")
+    if len(items) > BULK_MAX_ITEMS:
+        raise exceptions.ParseError("too many items, at most {}".format(BULK_MAX_ITEMS))
+    for item in items:
+        if not isinstance(item, dict):
+            raise exceptions.ParseError("item {} is not a dict".format(item))
+
+
+# 逐条校验数据，返回{序号: (主键, 校验后的数据)}及{序号: 错误信息}
+def validate_items(serializer_class, items, instances=None, unique_fields=()):
+    model = serializer_class.Meta.model
+    serializer = get_bulk_serializer(serializer_class, items)
+    validated_items = {}
+    errors = {}
+    for index, item in enumerate(items):
+        pk = None
+        if instances is not None:
+            pk = get_int_values([item.get("id")])
+            pk = pk.pop() if pk else None
+            if pk not in instances:
+                errors[index] = "{} id {} does not exist".format(model.__name__.lower(), item.get("id"))
+                continue
+        try:
+            validated_items[index] = (pk, serializer.run_validation(item))
+        except exceptions.ValidationError as e:
+            errors[index] = e.detail
+    check_unique(model, validated_items, errors, unique_fields)
+    return validated_items, errors
+
+
+def raise_bulk_errors(errors):
+    if errors:
+        raise exceptions.ValidationError(dict((str(index), errors[index]) for index in sorted(errors)))
+
+
+def set_created_ids(model, objs):
+    constraint = get_unique_constraints(model)[0]
+    attnames = [model._meta.get_field(field).attname for field in constraint]
+    values = [tuple(getattr(obj, attname) for attname in attnames) for obj in objs]
+    existing_values = get_existing_unique_values(model, constraint, values)
+    for obj, value in zip(objs, values):
+        obj.id = existing_values[value]
+
+
+# 批量新增，全部数据校验通过后在一个事务中写入，返回新增记录的id列表
+def bulk_create(serializer_class, items, unique_fields=()):
+    check_items(items)
+    model = serializer_class.Meta.model
+    validated_items, errors = validate_items(serializer_class, items, unique_fields=unique_fields)
+    raise_bulk_errors(errors)
+    objs = [model(**validated_items[index][1]) for index in sorted(validated_items)]
+    if not objs:
+        return []
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+            # MySQL的bulk_create不会回填主键，按唯一约束查询新增记录的id
+            if objs[0].id is None:
+                set_created_ids(model, objs)
+            # bulk_create不会调用save，以集合操作补充token及默认排序标识
+            if model is User:
+                Token.objects.bulk_create([Token(key=uuid.uuid4().hex, user_id=obj.id) for obj in objs],
+                                          batch_size=BULK_BATCH_SIZE)
+            if hasattr(model, "sort_id"):
+                model.objects.filter(id__in=[obj.id for obj in objs], sort_id=0).update(sort_id=F("id"))
+                for obj in objs:
+                    obj.sort_id = obj.sort_id or obj.id
+            if model in closure_models:
+                add_nodes(model, [(obj.id, obj.parent_id) for obj in objs])
+            transaction.on_commit(lambda: objects_bulk_saved(model, objs, created=True))
+    except IntegrityError as e:
+        raise exceptions.ParseError("bulk create failed: {}".format(e))
+    return [obj.id for obj in objs]
+
+
+# 批量修改，每条数据需包含id，全部数据校验通过后在一个事务中写入，返回修改的记录数
+def bulk_update(serializer_class, items, unique_fields=()):
+    check_items(items)
+    model = serializer_class.Meta.model
+    instances = model.objects.in_bulk(get_int_values(item.get("id") for item in items))
+    validated_items, errors = validate_items(serializer_class, items, instances, unique_fields)
+    raise_bulk_errors(errors)
+    objs = []
+    fields = set()
+    old_values = {"app_id": set(), "parent_id": set()}
+    moved = []
+    for index in sorted(validated_items):
+        pk, values = validated_items[index]
+        obj = instances[pk]
+        old_parent_id = getattr(obj, "parent_id", None)
+        for attname, old_value_set in old_values.items():
+            old_value_set.add(getattr(obj, attname, None))
+        for field, value in values.items():
+            setattr(obj, field, value)
+        fields.update(values)
+        objs.append(obj)
+        if model in closure_models and obj.parent_id != old_parent_id:
+            moved.append(obj)
+    if not objs:
+        return 0
+    try:
+        with transaction.atomic():
+            utils.bulk_update(model, objs, list(fields), batch_size=BULK_BATCH_SIZE)
+            # 逐个移动父节点变化的子树，移动到自身后代下时报错并回滚
+            for obj in moved:
+                move_node(model, obj.id, obj.parent_id)
+            transaction.on_commit(lambda: objects_bulk_saved(model, objs, created=False,
+                                                             old_app_ids=old_values["app_id"],
+                                                             old_parent_ids=old_values["parent_id"]))
+    except IntegrityError as e:
+        raise exceptions.ParseError("bulk update failed: {}".format(e))
+    return len(objs)
@@ -0,0 +1,269 @@
+# coding: utf8
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from core.libs import pubsub
+from core.libs.events import publish_rbac_event
+from core.models import App, Menu, Resource, Role
+
+PERMISSION_CACHE_PREFIX = getattr(settings, "PERMISSION_CACHE_PREFIX", "permission")
+PERMISSION_CACHE_TIMEOUT = getattr(settings, "PERMISSION_CACHE_TIMEOUT", 3600)
+TOKEN_CACHE_PREFIX = getattr(settings, "TOKEN_CACHE_PREFIX", "access_token")
+TOKEN_CACHE_TIMEOUT = getattr(settings, "TOKEN_CACHE_TIMEOUT", 300)
+TOKEN_LOCAL_CACHE_SIZE = getattr(settings, "TOKEN_LOCAL_CACHE_SIZE", 10000)
+TOKEN_LOCAL_CACHE_TIMEOUT = getattr(settings, "TOKEN_LOCAL_CACHE_TIMEOUT", 30)
+TOKEN_INVALIDATE_CHANNEL = "token"
+VERSION_CACHE_PREFIX = getattr(settings, "VERSION_CACHE_PREFIX", "version")
+MENU_CACHE_PREFIX = getattr(settings, "MENU_CACHE_PREFIX", "menu")
+MENU_CACHE_TIMEOUT = getattr(settings, "MENU_CACHE_TIMEOUT", 3600)
+MODEL_VERSION_PREFIX = "model"
+RBAC_VERSION_PREFIX = "rbac"
+APP_CACHE_PREFIX = getattr(settings, "APP_CACHE_PREFIX", "app")
+
+
+class LocalCache:
+    """
+    进程内的LRU缓存，超过容量时淘汰最久未使用的条目，条目超过timeout秒后失效
+    """
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is None:
+                return None
+            value, expire_time = item
+            if expire_time < time.monotonic():
+                del self.__data[key]
+                return None
+            self.__data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__data[key] = (value, time.monotonic() + self.timeout)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.max_size:
+                self.__data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.__lock:
+            for key in keys:
+                self.__data.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+
+def get_app_permission_key(app_name):
+    return "{}:{}".format(PERMISSION_CACHE_PREFIX, app_name)
+
+
+def get_user_permission_key(app_name, user_id):
+    return "{}:user:{}".format(get_app_permission_key(app_name), user_id)
+
+
+def get_index_key(app_name):
+    return "{}:index".format(get_app_permission_key(app_name))
+
+
+def get_index_version_key(app_name):
+    return "{}:version".format(get_app_permission_key(app_name))
+
+
+def get_index_lock_key(app_name):
+    return "{}:lock".format(get_app_permission_key(app_name))
+
+
+def get_app_cache_key(app_name):
+    return "{}:{}".format(APP_CACHE_PREFIX, app_name)
+
+
+# 按名称获取应用id，应用不存在时返回None
+def get_app_id(app_name):
+    app_id = cache.get(get_app_cache_key(app_name))
+    if app_id is None:
+        app_id = App.objects.filter(name=app_name).values_list("id", flat=True).first()
+        if app_id is not None:
+            cache.set(get_app_cache_key(app_name), app_id, PERMISSION_CACHE_TIMEOUT)
+    return app_id
+
+
+def clear_app_id_cache(app_names):
+    cache.delete_many([get_app_cache_key(app_name) for app_name in app_names if app_name])
+
+
+# 一次读取用户在应用下的角色id集合以及应用权限索引的版本号，未命中的返回None
+def get_permission_cache(app_name, user_id):
+    user_key = get_user_permission_key(app_name, user_id)
+    version_key = get_index_version_key(app_name)
+    values = cache.get_many([user_key, version_key])
+    return values.get(user_key), values.get(version_key)
+
+
+def set_user_permission_cache(app_name, user_id, role_ids):
+    cache.set(get_user_permission_key(app_name, user_id), frozenset(role_ids), PERMISSION_CACHE_TIMEOUT)
+
+
+# 清除指定用户在指定应用下的权限缓存，未指定应用时清除所有应用，role_ids为引起变化的角色
+def clear_user_permission_cache(user_ids, app_names=None, role_ids=None):
+    if not user_ids:
+        return
+    if app_names is None:
+        apps = list(App.objects.values_list("id", "name"))
+    else:
+        apps = [(get_app_id(app_name), app_name) for app_name in app_names]
+    keys = [get_user_permission_key(app_name, user_id) for _, app_name in apps for user_id in user_ids]
+    # 在事务提交后才清除，避免其它请求在提交前重新缓存旧的角色集合
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+    # 用户的角色变化同样改变应用的权限清单
+    bump_rbac_versions([app_id for app_id, _ in apps], user_ids, role_ids)
+
+
+# 清除应用下所有用户的权限缓存以及应用的权限索引
+def clear_app_permission_cache(app_name):
+    cache.delete_pattern("{}:*".format(get_app_permission_key(app_name)))
+
+
+def get_version_key(name):
+    return "{}:{}".format(VERSION_CACHE_PREFIX, name)
+
+
+# 版本号不存在时以当前毫秒时间戳初始化，保证缓存被清除后的版本号不会回退到旧值
+def init_version(key):
+    cache.add(key, int(time.time() * 1000), None)
+    return cache.get(key)
+
+
+# 一次读取多个计数器的当前版本号，按names的顺序返回
+def get_versions(names):
+    keys = [get_version_key(name) for name in names]
+    values = cache.get_many(keys)
+    return [values[key] if values.get(key) is not None else init_version(key) for key in keys]
+
+
+def get_version(name):
+    return get_versions([name])[0]
+
+
+# 递增多个计数器的版本号，按names的顺序返回递增后的版本号
+def incr_versions(names):
+    versions = []
+    for name in names:
+        try:
+            versions.append(cache.incr(get_version_key(name)))
+        except ValueError:
+            versions.append(init_version(get_version_key(name)))
+    return versions
+
+
+# 递增计数器的版本号，使以旧版本号为键的缓存全部失效。
+# 在事务提交后才递增，避免其它请求在提交前以新版本号缓存旧数据
+def bump_versions(names):
+    names = set(names)
+    transaction.on_commit(lambda: incr_versions(names))
+
+
+# 模型的版本号，指定应用时为模型在该应用下的版本号
+def get_model_version_name(model, app_id=None):
+    if app_id is None:
+        return "{}:{}".format(MODEL_VERSION_PREFIX, model._meta.model_name)
+    return "{}:{}:{}".format(MODEL_VERSION_PREFIX, model._meta.model_name, app_id)
+
+
+def bump_model_versions(models, app_ids=()):
+    app_ids = [app_id for app_id in app_ids if app_id is not None]
+    names = [get_model_version_name(model) for model in models]
+    names += [get_model_version_name(model, app_id) for model in models for app_id in app_ids]
+    bump_versions(names)
+
+
+def get_menu_version_name(app_id):
+    return "{}:{}".format(MENU_CACHE_PREFIX, app_id)
+
+
+def get_menu_cache_key(app_id, version, fingerprint):
+    return "{}:{}:{}:{}".format(MENU_CACHE_PREFIX, app_id, version, fingerprint)
+
+
+# 菜单或资源变化时同时递增应用的权限清单版本号，role_ids为权限发生变化的角色
+def bump_menu_version(app_id, role_ids=None):
+    bump_versions([get_menu_version_name(app_id)])
+    bump_rbac_versions([app_id], role_ids=role_ids)
+
+
+# 应用的权限、菜单及列表缓存全部失效，用于导入权限配置或重建闭包表之后
+def clear_app_caches(app):
+    clear_app_permission_cache(app.name)
+    bump_menu_version(app.id)
+    bump_model_versions([App, Menu, Resource, Role], [app.id])
+
+
+# 应用的权限清单版本号，应用下的菜单、资源、角色及用户的角色任一变化时递增
+def get_rbac_version_name(app_id):
+    return "{}:{}".format(RBAC_VERSION_PREFIX, app_id)
+
+
+# 递增应用的权限清单版本号并发布权限变化事件，user_ids为空表示应用下的所有用户都可能受影响
+def incr_rbac_versions(app_ids, user_ids=None, role_ids=None):
+    versions = incr_versions([get_rbac_version_name(app_id) for app_id in app_ids])
+    app_names = dict(App.objects.filter(id__in=app_ids).values_list("id", "name"))
+    for app_id, version in zip(app_ids, versions):
+        publish_rbac_event(app_id, app_names.get(app_id), version, user_ids, role_ids)
+
+
+def bump_rbac_versions(app_ids, user_ids=None, role_ids=None):
+    app_ids = sorted(set(app_id for app_id in app_ids if app_id is not None))
+    if app_ids:
+        transaction.on_commit(lambda: incr_rbac_versions(app_ids, user_ids, role_ids))
+
+
+token_local_cache = LocalCache(TOKEN_LOCAL_CACHE_SIZE, TOKEN_LOCAL_CACHE_TIMEOUT)
+
+
+def get_token_cache_key(key):
+    return "{}:{}".format(TOKEN_CACHE_PREFIX, key)
+
+
+# 先读进程内缓存，再读redis，均未命中时返回None
+def get_token_cache(key):
+    pubsub.ensure_listener()
+    snapshot = token_local_cache.get(key)
+    if snapshot is None:
+        snapshot = cache.get(get_token_cache_key(key))
+        if snapshot is not None:
+            token_local_cache.set(key, snapshot)
+    return snapshot
+
+
+def set_token_cache(key, snapshot):
+    cache.set(get_token_cache_key(key), snapshot, TOKEN_CACHE_TIMEOUT)
+    token_local_cache.set(key, snapshot)
+
+
+def delete_token_cache(keys):
+    cache.delete_many([get_token_cache_key(key) for key in keys])
+    token_local_cache.delete_many(keys)
+    pubsub.publish(TOKEN_INVALIDATE_CHANNEL, keys)
+
+
+# 清除token缓存，并通知其它worker进程清除各自的进程内缓存。
+# 在事务提交后才清除，避免其它请求在提交前以旧的用户快照重新缓存
+def clear_token_cache(keys):
+    keys = [key for key in keys if key]
+    if keys:
+        transaction.on_commit(lambda: delete_token_cache(keys))
+
+
+pubsub.subscribe(TOKEN_INVALIDATE_CHANNEL, token_local_cache.delete_many)
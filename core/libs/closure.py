@@ -0,0 +1,94 @@
+# coding: utf8
+from collections import defaultdict
+
+from django.db import transaction
+from rest_framework import exceptions
+
+from core.models import Menu, MenuClosure, Resource, ResourceClosure
+
+CLOSURE_BATCH_SIZE = 500
+
+# 树形模型 -> 闭包表
+closure_models = {
+    Menu: MenuClosure,
+    Resource: ResourceClosure,
+}
+
+
+# 新增节点的闭包记录，nodes为[(id, parent_id), ...]，父节点需已有闭包记录或在nodes中排在子节点之前
+def add_nodes(model, nodes):
+    closure_model = closure_models[model]
+    parent_ids = set(parent_id for _, parent_id in nodes if parent_id)
+    ancestors = defaultdict(list)
+    for descendant_id, ancestor_id, depth in closure_model.objects.filter(descendant_id__in=parent_ids) \
+            .values_list("descendant_id", "ancestor_id", "depth"):
+        ancestors[descendant_id].append((ancestor_id, depth))
+    rows = []
+    for node_id, parent_id in nodes:
+        node_ancestors = [(node_id, 0)]
+        if parent_id:
+            node_ancestors += [(ancestor_id, depth + 1) for ancestor_id, depth in ancestors[parent_id]]
+        ancestors[node_id] = node_ancestors
+        rows += [closure_model(ancestor_id=ancestor_id, descendant_id=node_id, depth=depth)
+                 for ancestor_id, depth in node_ancestors]
+    closure_model.objects.bulk_create(rows, batch_size=CLOSURE_BATCH_SIZE)
+
+
+def raise_circular_parent(model, node_id):
+    raise exceptions.ParseError("{} {} can not be moved under itself or its descendant".format(
+        model.__name__.lower(), node_id))
+
+
+# 父节点不能是节点自身或其后代节点
+def check_parent(model, node_id, parent_id):
+    if parent_id and (parent_id == node_id or closure_models[model].objects.filter(
+            ancestor_id=node_id, descendant_id=parent_id).exists()):
+        raise_circular_parent(model, node_id)
+
+
+# 移动节点及其子树到新的父节点下：删除子树与原祖先的关联，再关联到新父节点及其祖先
+def move_node(model, node_id, parent_id):
+    closure_model = closure_models[model]
+    subtree = list(closure_model.objects.filter(ancestor_id=node_id).values_list("descendant_id", "depth"))
+    subtree_ids = [descendant_id for descendant_id, _ in subtree]
+    if parent_id in subtree_ids:
+        raise_circular_parent(model, node_id)
+    closure_model.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+    if parent_id:
+        ancestors = closure_model.objects.filter(descendant_id=parent_id).values_list("ancestor_id", "depth")
+        closure_model.objects.bulk_create([
+            closure_model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + depth + 1)
+            for ancestor_id, ancestor_depth in ancestors for descendant_id, depth in subtree
+        ], batch_size=CLOSURE_BATCH_SIZE)
+
+
+# 根据parent字段重建整个闭包表
+@transaction.atomic
+def rebuild_closure(model):
+    nodes = list(model.objects.values_list("id", "parent_id"))
+    children = defaultdict(list)
+    for node_id, parent_id in nodes:
+        children[parent_id].append(node_id)
+    # 按层级从根节点开始排列，保证父节点在子节点之前
+    ordered_nodes = []
+    parent_ids = [None]
+    while parent_ids:
+        next_parent_ids = []
+        for parent_id in parent_ids:
+            for node_id in children[parent_id]:
+                ordered_nodes.append((node_id, parent_id))
+                next_parent_ids.append(node_id)
+        parent_ids = next_parent_ids
+    closure_models[model].objects.all().delete()
+    add_nodes(model, ordered_nodes)
+    # 存在循环引用的节点无法从根节点到达
+    return len(nodes) - len(ordered_nodes)
+
+
+# 闭包表为空而已有节点时（部署闭包表之前的数据）根据parent字段补全，返回补全的模型
+def backfill_closures():
+    models = [model for model, closure_model in closure_models.items()
+              if model.objects.exists() and not closure_model.objects.exists()]
+    for model in models:
+        rebuild_closure(model)
+    return models
@@ -1,15 +1,25 @@
 # coding: utf8
 import functools
-import json
+import hashlib
+import time
+from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.core.cache import cache
-from rest_framework.permissions import IsAuthenticated
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
 
+from core.libs.caches import get_versions, get_model_version_name
 from core.libs.permissions import check_user_has_permission, is_super_user
-from core.libs.response import ForbiddenResponse, UnauthorizedResponse, ApiResponse
+from core.libs.response import ForbiddenResponse, UnauthorizedResponse
 from core.libs.utils import APP_NAME
 
+RESPONSE_CACHE_PREFIX = getattr(settings, "RESPONSE_CACHE_PREFIX", "response")
+RESPONSE_CACHE_TIMEOUT = getattr(settings, "RESPONSE_CACHE_TIMEOUT", 3600)
+
 
 def login_required(func):
     @functools.wraps(func)
@@ -38,28 +48,72 @@ def permission_required(permission_name):
     return decorator
 
 
-def cache_response(timeout=60):
+def get_request_fingerprint(request):
+    query = urlencode(sorted((key, value) for key, values in request.GET.lists() for value in values))
+    return hashlib.md5("{}?{}".format(request.path, query).encode()).hexdigest()
+
+
+# 由请求及版本号生成强ETag，需在读取数据之前获取版本号，保证数据变化后ETag随之改变
+def get_version_etag(request, version_names):
+    versions = get_versions(version_names)
+    return quote_etag(hashlib.md5("{}:{}".format(get_request_fingerprint(request), versions).encode()).hexdigest())
+
+
+def get_response_cache_key(view_cls, request, related_models, per_user, app_param):
+    # 指定应用参数时，视图模型使用其在该应用下的版本号，其它应用的数据变化不影响缓存
+    app_id = request.GET.get(app_param) if app_param else None
+    version_names = [get_model_version_name(view_cls.queryset.model, app_id)]
+    versions = get_versions(version_names + [get_model_version_name(model) for model in related_models])
+    cache_key = "{}:{}:{}".format(RESPONSE_CACHE_PREFIX, get_request_fingerprint(request),
+                                  "-".join(str(version) for version in versions))
+    if per_user:
+        cache_key = "{}:{}".format(cache_key, request.user.id)
+    return cache_key
+
+
+def render_response(view_cls, request, response, *args, **kwargs):
+    if isinstance(response, Response):
+        response = view_cls.finalize_response(request, response, *args, **kwargs)
+        response.render()
+    return response
+
+
+def cache_response(timeout=RESPONSE_CACHE_TIMEOUT, related_models=(), per_user=False, app_param=None):
+    """
+    缓存视图GET请求渲染后的响应内容，缓存键包含请求路径、查询参数、视图模型及related_models的版本号，
+    per_user为True时再区分用户，app_param为应用id的请求参数名。模型数据变化时版本号递增，缓存随之失效。
+    响应带有ETag及Last-Modified，客户端的条件请求未变化时返回304
+    """
     def decorator(func):
         @functools.wraps(func)
         def wrapper(view_cls, request, *args, **kwargs):
-            cache_key_prefix = request.path.replace('/', '_')
-            user = getattr(request, 'user', None)
-            if user:
-                cache_key = "{}_{}".format(cache_key_prefix, user.username)
-                cache_value = cache.get(cache_key)
-                response = func(view_cls, request, *args, **kwargs)
-                if not cache_value:
-                    data = {
-                        "status_code": response.status_code,
-                        "data": response.data,
-                    }
-                    cache.set(cache_key, json.dumps(data), timeout)
-                else:
-                    data = json.loads(cache_value)
-                    response = ApiResponse(data=data["data"])
-                    response.status_code = data["status_code"]
-                return response
-            return func(view_cls, request, *args, **kwargs)
+            if request.method != "GET":
+                return func(view_cls, request, *args, **kwargs)
+            cache_key = get_response_cache_key(view_cls, request, related_models, per_user, app_param)
+            cache_value = cache.get(cache_key)
+            response = None
+            if cache_value is None:
+                response = render_response(view_cls, request, func(view_cls, request, *args, **kwargs),
+                                           *args, **kwargs)
+                # 只缓存成功的响应
+                if response.status_code != 200 or getattr(response, "code", 200) != 200:
+                    return response
+                cache_value = {
+                    "content": response.content,
+                    "content_type": response["Content-Type"],
+                    "etag": quote_etag(hashlib.md5(response.content).hexdigest()),
+                    "last_modified": int(time.time()),
+                }
+                cache.set(cache_key, cache_value, timeout)
+            not_modified = get_conditional_response(request, etag=cache_value["etag"],
+                                                    last_modified=cache_value["last_modified"])
+            if not_modified is not None:
+                response = not_modified
+            elif response is None:
+                response = HttpResponse(cache_value["content"], content_type=cache_value["content_type"])
+            response["ETag"] = cache_value["etag"]
+            response["Last-Modified"] = http_date(cache_value["last_modified"])
+            return response
 
         return wrapper
 
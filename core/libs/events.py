@@ -0,0 +1,84 @@
+# coding: utf8
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from core.libs import pubsub
+
+RBAC_EVENT_CHANNEL = "rbac"
+# 进程内保留的最近事件数，长轮询据此返回客户端版本号之后的事件
+RBAC_EVENT_BUFFER_SIZE = getattr(settings, "RBAC_EVENT_BUFFER_SIZE", 1000)
+# 受影响的用户数超过该值时事件中不列出用户id，按应用下所有用户处理
+RBAC_EVENT_MAX_IDS = getattr(settings, "RBAC_EVENT_MAX_IDS", 1000)
+RBAC_EVENT_POLL_TIMEOUT = getattr(settings, "RBAC_EVENT_POLL_TIMEOUT", 30)
+# 其它进程递增版本号后，事件经redis送达本进程前的最长等待时间
+RBAC_EVENT_DELIVERY_TIMEOUT = getattr(settings, "RBAC_EVENT_DELIVERY_TIMEOUT", 1)
+# 进程内同时等待事件的长轮询请求数上限，每个等待的请求占用一个工作线程
+RBAC_EVENT_MAX_WAITERS = getattr(settings, "RBAC_EVENT_MAX_WAITERS", 50)
+
+recent_events = deque(maxlen=RBAC_EVENT_BUFFER_SIZE)
+events_condition = threading.Condition()
+poll_waiters = threading.BoundedSemaphore(RBAC_EVENT_MAX_WAITERS)
+
+
+def get_id_list(ids):
+    if ids is None or len(ids) > RBAC_EVENT_MAX_IDS:
+        return None
+    return sorted(ids)
+
+
+# 发布权限变化事件，user_ids为空表示应用下的所有用户都可能受影响，role_ids为权限发生变化的角色
+def publish_rbac_event(app_id, app_name, version, user_ids=None, role_ids=None):
+    pubsub.publish(RBAC_EVENT_CHANNEL, {
+        "app_id": app_id,
+        "app": app_name,
+        "version": version,
+        "user_ids": get_id_list(user_ids),
+        "role_ids": get_id_list(role_ids),
+        "time": time.time(),
+    })
+
+
+# 注册进程内的权限变化回调，回调在后台监听线程中以事件为参数调用
+def subscribe_rbac_events(callback):
+    pubsub.subscribe(RBAC_EVENT_CHANNEL, callback)
+    pubsub.ensure_listener()
+
+
+def receive_event(event):
+    with events_condition:
+        recent_events.append(event)
+        events_condition.notify_all()
+
+
+def get_events_since(app_id, version):
+    return sorted((event for event in list(recent_events) if event["app_id"] == app_id and event["version"] > version),
+                  key=lambda event: event["version"])
+
+
+# 版本号逐次递增，事件从version之后连续覆盖到until_version时才完整
+def is_complete(events, version, until_version):
+    return [event["version"] for event in events[:until_version - version]] == \
+        list(range(version + 1, until_version + 1))
+
+
+# 等待应用下版本号大于version的事件，指定until_version时等待事件连续覆盖到该版本号，超时后返回已收到的事件
+def wait_events(app_id, version, timeout=RBAC_EVENT_POLL_TIMEOUT, until_version=None):
+    pubsub.ensure_listener()
+    deadline = time.time() + timeout
+    with events_condition:
+        while True:
+            events = get_events_since(app_id, version)
+            if until_version is None:
+                done = bool(events)
+            else:
+                done = is_complete(events, version, until_version)
+            remaining = deadline - time.time()
+            if done or remaining <= 0:
+                return events
+            events_condition.wait(remaining)
+
+
+pubsub.subscribe(RBAC_EVENT_CHANNEL, receive_event)
@@ -0,0 +1,78 @@
+# coding: utf8
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from core.models import User, Group, Role, Resource
+
+EXPORT_CHUNK_SIZE = getattr(settings, "EXPORT_CHUNK_SIZE", 2000)
+EXPORT_CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# 导出名称 -> (模型, 导出的列)，多对多关系直接读取关联表，每条关联记录为一行
+export_tables = {
+    "user": (User, ["id", "username", "cname", "email", "is_active", "last_login"]),
+    "group": (Group, ["id", "name", "description"]),
+    "role": (Role, ["id", "name", "description", "app_id", "app__name"]),
+    "group_user": (Group.user.through, ["group_id", "group__name", "user_id", "user__username"]),
+    "role_user": (Role.user.through, ["role_id", "role__name", "role__app__name", "user_id", "user__username"]),
+    "role_group": (Role.group.through, ["role_id", "role__name", "role__app__name", "group_id", "group__name"]),
+    "resource_role": (Resource.role.through, ["resource_id", "resource__name", "resource__app__name", "role_id",
+                                              "role__name"]),
+}
+
+
+def check_export_params(name, export_format):
+    if name not in export_tables:
+        raise ValueError("invalid export name {}, choices: {}".format(name, ", ".join(export_tables)))
+    if export_format not in EXPORT_CONTENT_TYPES:
+        raise ValueError("invalid export format {}, choices: {}".format(
+            export_format, ", ".join(EXPORT_CONTENT_TYPES)))
+
+
+# 按主键分批读取，每批一次查询。PyMySQL会缓存整个结果集，分批读取才能保证内存占用与数据总量无关
+def iter_rows(queryset, columns, chunk_size=EXPORT_CHUNK_SIZE):
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by("id").values_list("id", *columns)[:chunk_size])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
+def get_column_names(columns):
+    return [column.replace("__", "_") for column in columns]
+
+
+def iter_ndjson(columns, rows):
+    columns = get_column_names(columns)
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + "\n"
+
+
+class Echo:
+    """
+    csv.writer的输出对象，直接返回写入的内容
+    """
+    def write(self, value):
+        return value
+
+
+def iter_csv(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(get_column_names(columns))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_export(name, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    check_export_params(name, export_format)
+    model, columns = export_tables[name]
+    rows = iter_rows(model.objects.all(), columns, chunk_size)
+    return iter_csv(columns, rows) if export_format == "csv" else iter_ndjson(columns, rows)
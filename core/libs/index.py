@@ -0,0 +1,187 @@
+# coding: utf8
+import logging
+import threading
+import uuid
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from core.libs.caches import PERMISSION_CACHE_TIMEOUT, get_index_key, get_index_version_key, get_index_lock_key
+from core.models import App, Resource, ResourceClosure
+
+logger = logging.getLogger(__name__)
+
+# 进程内缓存的应用权限索引，通过版本号与redis中的索引保持一致
+local_indexes = {}
+# 正在后台建立权限索引的应用
+building_apps = set()
+building_lock = threading.Lock()
+
+
+class PermissionIndex:
+    """
+    应用的权限索引：每个资源分配一个顺序号，每个角色保存其可访问资源（包含可用的子资源）的位图
+    """
+    def __init__(self, app_name):
+        self.app_name = app_name
+        self.version = uuid.uuid4().hex
+        # 资源名称 -> 顺序号
+        self.name_ordinals = {}
+        # 资源id -> (资源名称, 顺序号)
+        self.resource_ordinals = {}
+        # 角色id -> 位图
+        self.role_bitmaps = {}
+        self.next_ordinal = 0
+
+    @classmethod
+    def build(cls, app):
+        index = cls(app.name)
+        for resource_id, name in Resource.objects.filter(app=app).order_by("id").values_list("id", "name"):
+            index.set_resource(resource_id, name)
+        index.role_bitmaps = index.compute_role_bitmaps(app.id)
+        return index
+
+    def set_resource(self, resource_id, name):
+        if resource_id in self.resource_ordinals:
+            old_name, ordinal = self.resource_ordinals[resource_id]
+            self.name_ordinals.pop(old_name, None)
+        else:
+            ordinal = self.next_ordinal
+            self.next_ordinal += 1
+        self.resource_ordinals[resource_id] = (name, ordinal)
+        self.name_ordinals[name] = ordinal
+
+    # 删除的资源顺序号不再复用，待索引重建时重新紧凑排列
+    def remove_resource(self, resource_id):
+        if resource_id in self.resource_ordinals:
+            name, ordinal = self.resource_ordinals.pop(resource_id)
+            self.name_ordinals.pop(name, None)
+
+    def get_ordinal(self, resource_id):
+        return self.resource_ordinals[resource_id][1]
+
+    def compute_role_bitmaps(self, app_id, role_ids=None):
+        resource_base_query = Resource.objects.filter(app_id=app_id).filter(available=1)
+        links = Resource.role.through.objects.filter(resource__in=resource_base_query)
+        bitmaps = {}
+        if role_ids is not None:
+            links = links.filter(role_id__in=role_ids)
+            bitmaps = dict.fromkeys(role_ids, 0)
+        links = list(links.values_list("role_id", "resource_id"))
+        # 经闭包表一次查询关联资源自身及其任意层级的可用后代资源
+        descendants = defaultdict(list)
+        closure = ResourceClosure.objects.filter(ancestor__in=set(resource_id for _, resource_id in links),
+                                                 descendant__in=resource_base_query)
+        for ancestor_id, descendant_id in closure.values_list("ancestor_id", "descendant_id"):
+            descendants[ancestor_id].append(descendant_id)
+        for role_id, resource_id in links:
+            bitmap = bitmaps.get(role_id, 0)
+            for granted_id in descendants[resource_id]:
+                # 尚未加入索引的资源由其post_save信号负责更新
+                if granted_id in self.resource_ordinals:
+                    bitmap |= 1 << self.get_ordinal(granted_id)
+            bitmaps[role_id] = bitmap
+        return bitmaps
+
+    def get_bitmap(self, role_ids):
+        bitmap = 0
+        for role_id in role_ids:
+            bitmap |= self.role_bitmaps.get(role_id, 0)
+        return bitmap
+
+    # 资源不存在时返回None
+    def check_bitmap(self, bitmap, resource_name):
+        ordinal = self.name_ordinals.get(resource_name)
+        if ordinal is None:
+            return None
+        return bool(bitmap >> ordinal & 1)
+
+
+def save_permission_index(index):
+    index.version = uuid.uuid4().hex
+    cache.set_many({
+        get_index_key(index.app_name): index,
+        get_index_version_key(index.app_name): index.version,
+    }, PERMISSION_CACHE_TIMEOUT)
+    local_indexes[index.app_name] = index
+
+
+# 获取已建立的应用权限索引，未建立时返回None
+def get_cached_permission_index(app_name, version=None):
+    index = local_indexes.get(app_name)
+    if index and version and index.version == version:
+        return index
+    index = cache.get(get_index_key(app_name))
+    if index is not None:
+        local_indexes[app_name] = index
+    return index
+
+
+# 获取应用的权限索引，应用不存在时返回None
+def get_permission_index(app_name, version=None):
+    index = get_cached_permission_index(app_name, version)
+    if index is None:
+        with cache.lock(get_index_lock_key(app_name), timeout=60):
+            index = cache.get(get_index_key(app_name))
+            if index is None:
+                try:
+                    app = App.objects.get(name=app_name)
+                except App.DoesNotExist:
+                    return None
+                index = PermissionIndex.build(app)
+                save_permission_index(index)
+        local_indexes[app_name] = index
+    return index
+
+
+def build_permission_index(app_name):
+    try:
+        get_permission_index(app_name)
+    except Exception as e:
+        logger.exception("build permission index of app %s failed: %s", app_name, e)
+    finally:
+        building_apps.discard(app_name)
+        connection.close()
+
+
+# 在后台线程中建立应用的权限索引，同一进程内每个应用只有一个线程在建立
+def build_permission_index_async(app_name):
+    with building_lock:
+        if app_name in building_apps:
+            return
+        building_apps.add(app_name)
+    threading.Thread(target=build_permission_index, args=(app_name,), name="sso-permission-index",
+                     daemon=True).start()
+
+
+# 增量更新应用的权限索引：刷新指定资源的顺序号并重新计算指定角色的位图，索引未建立时不做处理
+def update_permission_index(app, role_ids=(), resource_ids=()):
+    with cache.lock(get_index_lock_key(app.name), timeout=60):
+        index = cache.get(get_index_key(app.name))
+        if index is None:
+            return
+        if resource_ids:
+            resources = dict(Resource.objects.filter(app=app, id__in=resource_ids).values_list("id", "name"))
+            for resource_id in resource_ids:
+                if resource_id in resources:
+                    index.set_resource(resource_id, resources[resource_id])
+                else:
+                    index.remove_resource(resource_id)
+        if role_ids:
+            existing_role_ids = set(app.role_set.filter(id__in=role_ids).values_list("id", flat=True))
+            for role_id in set(role_ids) - existing_role_ids:
+                index.role_bitmaps.pop(role_id, None)
+            index.role_bitmaps.update(index.compute_role_bitmaps(app.id, existing_role_ids))
+        save_permission_index(index)
+
+
+# 事务提交后再更新权限索引，事务回滚时redis及进程内的索引保持不变；资源移动到其它应用时需同时传入新旧应用
+def update_permission_index_on_commit(app_ids, role_ids=(), resource_ids=()):
+    app_ids = set(app_ids) - {None}
+    role_ids, resource_ids = list(role_ids), list(resource_ids)
+
+    def update():
+        for app in App.objects.filter(id__in=app_ids):
+            update_permission_index(app, role_ids, resource_ids)
+    transaction.on_commit(update)
@@ -0,0 +1,50 @@
+# coding: utf8
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from core.libs.caches import get_rbac_version_name, get_version
+from core.libs.menus import get_user_menu
+from core.libs.utils import get_resource_by_user_and_app
+
+MANIFEST_CACHE_PREFIX = getattr(settings, "MANIFEST_CACHE_PREFIX", "manifest")
+MANIFEST_CACHE_TIMEOUT = getattr(settings, "MANIFEST_CACHE_TIMEOUT", 86400)
+
+
+def get_rbac_version(app):
+    return get_version(get_rbac_version_name(app.id))
+
+
+def get_manifest_cache_key(app_id, user_id, version):
+    return "{}:{}:{}:{}".format(MANIFEST_CACHE_PREFIX, app_id, user_id, version)
+
+
+# 用户在应用下某一版本的权限清单，按(应用, 用户, 版本号)缓存，用于计算之后版本的增量
+def get_manifest(user, app, version):
+    cache_key = get_manifest_cache_key(app.id, user.id, version)
+    manifest = cache.get(cache_key)
+    if manifest is None:
+        resources = sorted(set(get_resource_by_user_and_app(user, app).values_list("name", flat=True)))
+        menus = get_user_menu(user, app)
+        menu_hash = hashlib.md5(json.dumps(menus, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+        manifest = {"version": version, "resources": resources, "menus": menus, "menu_hash": menu_hash}
+        cache.set(cache_key, manifest, MANIFEST_CACHE_TIMEOUT)
+    return manifest
+
+
+# 客户端提供的版本号的清单仍在缓存中时只返回增减的资源名称，菜单未变化时不返回菜单，否则返回完整清单
+def get_manifest_data(user, app, version, client_version=None):
+    manifest = get_manifest(user, app, version)
+    previous = cache.get(get_manifest_cache_key(app.id, user.id, client_version)) if client_version else None
+    if previous is None:
+        return {"version": version, "full": True, "resources": manifest["resources"], "menus": manifest["menus"]}
+    old_resources = set(previous["resources"])
+    new_resources = set(manifest["resources"])
+    data = {"version": version, "full": False, "added": sorted(new_resources - old_resources),
+            "removed": sorted(old_resources - new_resources)}
+    if previous["menu_hash"] != manifest["menu_hash"]:
+        data["menus"] = manifest["menus"]
+    return data
@@ -0,0 +1,30 @@
+# coding: utf8
+import hashlib
+
+from django.core.cache import cache
+
+from core.libs.caches import MENU_CACHE_TIMEOUT, get_menu_cache_key, get_menu_version_name, get_version
+from core.libs.permissions import get_user_role_ids
+from core.libs.utils import is_super_user, get_menu_by_app, get_menu_by_roles
+
+SUPER_USER_FINGERPRINT = "super"
+
+
+def get_role_fingerprint(role_ids):
+    return hashlib.md5(",".join(str(role_id) for role_id in sorted(role_ids)).encode()).hexdigest()
+
+
+# 菜单树按(应用, 角色集合)缓存，角色相同的用户共享同一份缓存，菜单或资源变化时递增应用的菜单版本号使其失效
+def get_user_menu(user, app):
+    if is_super_user(user):
+        role_ids = None
+        fingerprint = SUPER_USER_FINGERPRINT
+    else:
+        role_ids = get_user_role_ids(user, app.name)
+        fingerprint = get_role_fingerprint(role_ids)
+    cache_key = get_menu_cache_key(app.id, get_version(get_menu_version_name(app.id)), fingerprint)
+    menus = cache.get(cache_key)
+    if menus is None:
+        menus = get_menu_by_app(app) if role_ids is None else get_menu_by_roles(role_ids, app)
+        cache.set(cache_key, menus, MENU_CACHE_TIMEOUT)
+    return menus
@@ -0,0 +1,27 @@
+# coding: utf8
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+API_PAGE_SIZE = getattr(settings, "API_PAGE_SIZE", 1000)
+API_MAX_PAGE_SIZE = getattr(settings, "API_MAX_PAGE_SIZE", 10000)
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    按主键（或视图的cursor_ordering字段，需唯一且有索引）进行游标分页，翻页深度不影响查询性能。
+    请求携带cursor或page_size参数时才分页，否则仍返回完整列表，兼容已有的调用方
+    """
+    ordering = "id"
+    page_size = API_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = API_MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, "cursor_ordering", self.ordering)
+        return (ordering,) if isinstance(ordering, str) else tuple(ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and \
+                self.page_size_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
@@ -1,11 +1,12 @@
 # coding: utf8
-from django.conf import settings
-from django.db.models import Q
+from django.db.models import Exists, OuterRef
 from rest_framework import exceptions
 from rest_framework.permissions import BasePermission
 
-from core.libs.utils import is_super_user, get_resource_by_user_and_app
-from core.models import Group, Role, Resource, User, App
+from core.libs.caches import get_permission_cache, set_user_permission_cache, get_app_id
+from core.libs.index import get_cached_permission_index, build_permission_index_async
+from core.libs.utils import is_super_user, get_role_by_user_and_app, get_user_role_filter
+from core.models import Resource, User
 
 request_method_action_maps = {
     'options': 'read',
@@ -17,21 +18,87 @@ request_method_action_maps = {
 }
 
 
+def get_app_id_or_exception(app_name):
+    app_id = get_app_id(app_name)
+    if app_id is None:
+        raise exceptions.PermissionDenied("invalid app name {}".format(app_name))
+    return app_id
+
+
+def get_role_id_set(user, app_name):
+    app_id = get_app_id_or_exception(app_name)
+    role_ids = set(get_role_by_user_and_app(user, app_id).values_list("id", flat=True))
+    set_user_permission_cache(app_name, user.id, role_ids)
+    return role_ids
+
+
+def get_user_role_ids(user, app_name):
+    role_ids, _ = get_permission_cache(app_name, user.id)
+    if role_ids is None:
+        role_ids = get_role_id_set(user, app_name)
+    return role_ids
+
+
+# 一条EXISTS查询判断用户对多个资源的权限：资源可用，且资源本身或其父资源关联了用户直接或通过用户组拥有的该应用角色，
+# 关联的资源需可用。返回{资源名称: 是否有权限}，不包含不存在的资源
+def check_permissions_by_sql(user, app_id, resource_names):
+    # 角色关联到资源自身或其任一祖先资源
+    links = Resource.role.through.objects.filter(
+        resource__descendant_links__descendant_id=OuterRef("id"),
+        resource__available=True, role__app_id=app_id).filter(get_user_role_filter(user, "role_id"))
+    query = Resource.objects.filter(app_id=app_id, name__in=resource_names).annotate(granted=Exists(links))
+    return dict((name, bool(available and granted)) for name, available, granted in
+                query.values_list("name", "available", "granted"))
+
+
+# 用户在应用下对多个资源的权限，返回{资源名称: 是否有权限}，不包含无效的资源名称。
+# 权限索引已建立时为索引位图中的位运算，未建立时以一条SQL查询判断，并在后台建立索引
+def get_user_permissions(user, app_name, resource_names):
+    # 一次读取用户在该应用下的角色及权限索引版本
+    role_ids, version = get_permission_cache(app_name, user.id)
+    index = get_cached_permission_index(app_name, version)
+    if index is None:
+        app_id = get_app_id_or_exception(app_name)
+        build_permission_index_async(app_name)
+        return check_permissions_by_sql(user, app_id, resource_names)
+    if role_ids is None:
+        role_ids = get_role_id_set(user, app_name)
+    bitmap = index.get_bitmap(role_ids)
+    results = {}
+    for resource_name in resource_names:
+        has_resource = index.check_bitmap(bitmap, resource_name)
+        if has_resource is not None:
+            results[resource_name] = has_resource
+    return results
+
+
 def check_user_has_permission(user, app_name, resource_name):
     if not isinstance(user, User):
         return False
     # 检测是否为超级管理员
     if is_super_user(user):
         return True
-    try:
-        app = App.objects.get(name=app_name)
-    except App.DoesNotExist:
-        raise exceptions.PermissionDenied("invalid app name {}".format(app_name))
-    resource = Resource.objects.filter(Q(name=resource_name) & Q(app=app))
-    if resource.exists():
-        return resource.first() in get_resource_by_user_and_app(user, app)
-    else:
+    has_resource = get_user_permissions(user, app_name, [resource_name]).get(resource_name)
+    if has_resource is None:
         raise exceptions.PermissionDenied("invalid resource {} or app {}".format(resource_name, app_name))
+    return has_resource
+
+
+# 批量检测用户在同一应用下的多个权限，返回权限结果及无效资源的错误信息
+def check_user_has_permissions(user, app_name, resource_names):
+    errors = {}
+    if not isinstance(user, User):
+        return dict.fromkeys(resource_names, False), errors
+    if is_super_user(user):
+        return dict.fromkeys(resource_names, True), errors
+    try:
+        results = get_user_permissions(user, app_name, resource_names)
+    except exceptions.PermissionDenied as e:
+        return {}, dict.fromkeys(resource_names, e.detail)
+    for resource_name in resource_names:
+        if resource_name not in results:
+            errors[resource_name] = "invalid resource {} or app {}".format(resource_name, app_name)
+    return results, errors
 
 
 class CheckUserPermission(BasePermission):
@@ -0,0 +1,67 @@
+# coding: utf8
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_CHANNEL_PREFIX = getattr(settings, "PUBSUB_CHANNEL_PREFIX", "sso")
+PUBSUB_RETRY_INTERVAL = getattr(settings, "PUBSUB_RETRY_INTERVAL", 1)
+
+# 频道名 -> 回调函数列表
+subscribers = {}
+listener_lock = threading.Lock()
+listener_pid = None
+
+
+def get_channel_name(channel):
+    return "{}:{}".format(PUBSUB_CHANNEL_PREFIX, channel)
+
+
+def publish(channel, message):
+    get_redis_connection("default").publish(get_channel_name(channel), json.dumps(message))
+
+
+# 注册频道的回调函数，回调函数在后台监听线程中以反序列化后的消息为参数调用
+def subscribe(channel, callback):
+    subscribers.setdefault(get_channel_name(channel), []).append(callback)
+
+
+def dispatch(message):
+    channel = message["channel"]
+    if isinstance(channel, bytes):
+        channel = channel.decode()
+    data = json.loads(message["data"])
+    for callback in subscribers.get(channel, []):
+        try:
+            callback(data)
+        except Exception as e:
+            logger.exception("pubsub callback for channel %s failed: %s", channel, e)
+
+
+def listen():
+    while True:
+        try:
+            pubsub = get_redis_connection("default").pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(get_channel_name("*"))
+            for message in pubsub.listen():
+                dispatch(message)
+        except Exception as e:
+            logger.warning("pubsub listener disconnected, retry in %ss: %s", PUBSUB_RETRY_INTERVAL, e)
+            time.sleep(PUBSUB_RETRY_INTERVAL)
+
+
+# 确保当前进程已启动监听线程，需在请求处理路径中调用，以兼容fork之后启动的worker进程
+def ensure_listener():
+    global listener_pid
+    if listener_pid == os.getpid():
+        return
+    with listener_lock:
+        if listener_pid != os.getpid():
+            threading.Thread(target=listen, name="sso-pubsub-listener", daemon=True).start()
+            listener_pid = os.getpid()
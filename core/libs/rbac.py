@@ -0,0 +1,249 @@
+# coding: utf8
+import json
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F
+from rest_framework import exceptions
+
+from core.libs import utils
+from core.libs.bulk import set_created_ids, BULK_BATCH_SIZE
+from core.libs.closure import closure_models, add_nodes, move_node
+from core.libs.caches import clear_app_caches
+from core.libs.export import iter_rows
+from core.models import App, Menu, Resource, Role
+
+# 文档中各部分的(字段名, 查询列)，外键以关联记录的名称表示
+menu_columns = [("name", "name"), ("description", "description"), ("url", "url"), ("icon", "icon"),
+                ("parent", "parent__name"), ("public", "public"), ("available", "available"),
+                ("sort_id", "sort_id")]
+resource_columns = [("name", "name"), ("description", "description"), ("parent", "parent__name"),
+                    ("menu", "menu__name"), ("available", "available"), ("sort_id", "sort_id")]
+role_columns = [("name", "name"), ("description", "description")]
+role_resource_columns = [("role", "role__name"), ("resource", "resource__name")]
+
+
+def get_document_sections(app):
+    role_resources = Resource.role.through.objects.filter(role__app=app, resource__app=app)
+    return [
+        ("menus", Menu.objects.filter(app=app), menu_columns),
+        ("resources", Resource.objects.filter(app=app), resource_columns),
+        ("roles", Role.objects.filter(app=app), role_columns),
+        ("role_resources", role_resources, role_resource_columns),
+    ]
+
+
+def dumps(value):
+    return json.dumps(value, cls=DjangoJSONEncoder, ensure_ascii=False)
+
+
+# 逐段生成应用的权限配置文档：菜单、资源、角色及角色与资源的关联，分批读取数据库
+def iter_app_document(app):
+    yield '{{"app": {}'.format(dumps({"name": app.name, "description": app.description}))
+    for key, queryset, columns in get_document_sections(app):
+        yield ', "{}": ['.format(key)
+        names = [name for name, _ in columns]
+        separator = ""
+        for row in iter_rows(queryset, [column for _, column in columns]):
+            yield separator + dumps(dict(zip(names, row)))
+            separator = ", "
+        yield "]"
+    yield "}\n"
+
+
+def get_items(document, key):
+    items = document.get(key) or []
+    if not isinstance(items, list):
+        raise exceptions.ParseError("{} is not a list".format(key))
+    for item in items:
+        if not isinstance(item, dict) or not item.get("name"):
+            raise exceptions.ParseError("invalid {} item {}".format(key, item))
+    return items
+
+
+# 按父节点的层级分组，返回各层级的记录列表，父节点在前。
+# 父节点不在文档中时需已存在于数据库，存在循环引用时报错
+def group_by_level(key, items, existing_names):
+    items_by_name = dict((item["name"], item) for item in items)
+    depths = {}
+
+    def get_depth(name, path):
+        if name in depths:
+            return depths[name]
+        if name in path:
+            raise exceptions.ParseError("{} {} has circular parent reference".format(key, name))
+        parent = items_by_name[name].get("parent")
+        if not parent or parent not in items_by_name:
+            if parent and parent not in existing_names:
+                raise exceptions.ParseError("parent {} of {} {} does not exist".format(parent, key, name))
+            depth = 0
+        else:
+            depth = get_depth(parent, path | {name}) + 1
+        depths[name] = depth
+        return depth
+
+    levels = defaultdict(list)
+    for item in items:
+        levels[get_depth(item["name"], set())].append(item)
+    return [levels[depth] for depth in sorted(levels)]
+
+
+# 校验exclude以外的字段，返回{字段名: 错误信息列表}
+def get_field_errors(obj, exclude):
+    try:
+        obj.clean_fields(exclude=exclude)
+    except DjangoValidationError as e:
+        return e.message_dict
+    return {}
+
+
+class Importer:
+    """
+    按(name, app)唯一键将文档中的记录写入应用，已存在的记录只在字段变化时更新，新记录按层级批量插入
+    """
+    def __init__(self, app):
+        self.app = app
+        self.stats = {}
+        self.errors = {}
+        # 各部分校验失败的记录名称，引用这些记录的子记录同样记为失败
+        self.failed = defaultdict(set)
+        self.role_names = []
+
+    def get_value(self, model, item, field, ids):
+        value = item.get(field)
+        if field not in ("parent", "menu"):
+            return value
+        if not value:
+            if not model._meta.get_field(field).null:
+                raise exceptions.ParseError("{} of {} {} is required".format(field, model.__name__.lower(),
+                                                                             item["name"]))
+            return None
+        if value not in ids:
+            raise exceptions.ParseError("{} {} of {} {} does not exist".format(
+                field, value, model.__name__.lower(), item["name"]))
+        return ids[value]
+
+    def upsert(self, model, items, fields, key, related_ids=None):
+        existing = dict((obj.name, obj) for obj in model.objects.filter(app=self.app))
+        names = [item["name"] for item in items]
+        if len(set(names)) != len(names):
+            raise exceptions.ParseError("duplicated name in {}".format(key))
+        ids = dict((name, obj.id) for name, obj in existing.items())
+        # 外键字段名 -> 按名称查找id的字典
+        fk_ids = {"parent": ids, "menu": related_ids}
+        fk_failed = {"parent": self.failed[key], "menu": self.failed["menus"]}
+        attnames = [model._meta.get_field(field).attname for field in fields]
+        levels = group_by_level(key, items, existing) if "parent" in fields else [items]
+        created = updated = 0
+        for level in levels:
+            to_create = []
+            to_update = []
+            moved = []
+            for item in level:
+                invalid_fields = dict((field, ["{} {} is invalid".format(field, item[field])]) for field in fk_ids
+                                      if field in fields and item.get(field) in fk_failed[field])
+                if invalid_fields:
+                    self.errors["{}.{}".format(key, item["name"])] = invalid_fields
+                    self.failed[key].add(item["name"])
+                    continue
+                obj = existing.get(item["name"]) or model(app=self.app, name=item["name"])
+                old_values = [getattr(obj, attname) for attname in attnames]
+                old_parent_id = getattr(obj, "parent_id", None)
+                for field, attname in zip(fields, attnames):
+                    if field in fk_ids:
+                        setattr(obj, attname, self.get_value(model, item, field, fk_ids[field]))
+                    elif field in item:
+                        setattr(obj, attname, item[field])
+                field_errors = get_field_errors(obj, ["app", "parent", "menu"])
+                if field_errors:
+                    self.errors["{}.{}".format(key, item["name"])] = field_errors
+                    self.failed[key].add(item["name"])
+                    continue
+                if obj.pk is None:
+                    to_create.append(obj)
+                elif old_values != [getattr(obj, attname) for attname in attnames]:
+                    to_update.append(obj)
+                    if model in closure_models and obj.parent_id != old_parent_id:
+                        moved.append(obj)
+            # 同一层级的新记录一次插入，插入后下一层级才能引用其id
+            self.create(model, to_create, ids)
+            if to_update:
+                utils.bulk_update(model, to_update, fields, batch_size=BULK_BATCH_SIZE)
+            for obj in moved:
+                move_node(model, obj.id, obj.parent_id)
+            created += len(to_create)
+            updated += len(to_update)
+        self.stats[key] = {"created": created, "updated": updated}
+        return ids
+
+    def create(self, model, objs, ids):
+        if not objs:
+            return
+        model.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+        if objs[0].id is None:
+            set_created_ids(model, objs)
+        if hasattr(model, "sort_id"):
+            model.objects.filter(id__in=[obj.id for obj in objs], sort_id=0).update(sort_id=F("id"))
+        for obj in objs:
+            ids[obj.name] = obj.id
+        if model in closure_models:
+            add_nodes(model, [(obj.id, obj.parent_id) for obj in objs])
+
+    # 文档中角色的资源关联以文档为准，新增缺少的关联并删除多余的关联
+    def sync_role_resources(self, links, role_ids, resource_ids):
+        pairs = set()
+        for link in links:
+            if not isinstance(link, dict) or link.get("role") not in role_ids or \
+                    link.get("resource") not in resource_ids:
+                raise exceptions.ParseError("invalid role resource {}".format(link))
+            pairs.add((role_ids[link["role"]], resource_ids[link["resource"]]))
+        through = Resource.role.through
+        document_role_ids = set(role_ids[name] for name in self.role_names)
+        existing = dict(((role_id, resource_id), link_id) for link_id, role_id, resource_id in
+                        through.objects.filter(role_id__in=document_role_ids)
+                        .values_list("id", "role_id", "resource_id"))
+        added = [through(role_id=role_id, resource_id=resource_id) for role_id, resource_id in pairs - set(existing)]
+        removed = [existing[pair] for pair in set(existing) - pairs]
+        through.objects.bulk_create(added, batch_size=BULK_BATCH_SIZE)
+        for link_ids in utils.chunks(removed, BULK_BATCH_SIZE):
+            through.objects.filter(id__in=link_ids).delete()
+        self.stats["role_resources"] = {"added": len(added), "removed": len(removed)}
+
+    def run(self, document):
+        menus = get_items(document, "menus")
+        resources = get_items(document, "resources")
+        roles = get_items(document, "roles")
+        self.role_names = [role["name"] for role in roles]
+        menu_ids = self.upsert(Menu, menus, ["description", "url", "icon", "parent", "public", "available",
+                                             "sort_id"], "menus")
+        resource_ids = self.upsert(Resource, resources, ["description", "parent", "menu", "available", "sort_id"],
+                                   "resources", menu_ids)
+        role_ids = self.upsert(Role, roles, ["description"], "roles")
+        if self.errors:
+            raise exceptions.ValidationError(self.errors)
+        self.sync_role_resources(document.get("role_resources") or [], role_ids, resource_ids)
+        return self.stats
+
+
+# 导入应用的权限配置文档，app_name为空时使用文档中的应用名称，应用不存在时自动创建。
+# 整个导入在一个事务中完成，任一记录校验失败时全部回滚
+def import_app_document(document, app_name=None):
+    if not isinstance(document, dict):
+        raise exceptions.ParseError("document is not a dict")
+    app_info = document.get("app") or {}
+    app_name = app_name or app_info.get("name")
+    if not app_name:
+        raise exceptions.ParseError("app name is required")
+    with transaction.atomic():
+        app = App.objects.filter(name=app_name).first()
+        if app is None:
+            app = App(name=app_name, description=app_info.get("description") or app_name)
+            field_errors = get_field_errors(app, [])
+            if field_errors:
+                raise exceptions.ValidationError({"app": field_errors})
+            app.save()
+        stats = Importer(app).run(document)
+        transaction.on_commit(lambda: clear_app_caches(app))
+    return stats
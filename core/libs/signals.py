@@ -0,0 +1,318 @@
+# coding: utf8
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, pre_save, post_save, pre_delete, post_delete, post_migrate
+from django.dispatch import receiver
+
+from core.libs.caches import clear_user_permission_cache, clear_app_permission_cache, clear_token_cache, \
+    bump_menu_version, bump_model_versions, clear_app_id_cache, clear_app_caches
+from core.libs.closure import add_nodes, move_node, check_parent, backfill_closures
+from core.libs.index import update_permission_index_on_commit
+from core.libs.tokens import revoke_temp_tokens, refresh_temp_tokens
+from core.models import App, User, Group, Role, Resource, Token, Menu
+
+
+def get_user_ids_by_groups(group_ids):
+    return set(User.objects.filter(group__in=group_ids).values_list("id", flat=True))
+
+
+def get_user_ids_by_roles(role_ids):
+    query = User.objects.filter(Q(role__in=role_ids) | Q(group__role__in=role_ids))
+    return set(query.values_list("id", flat=True).distinct())
+
+
+def get_app_names_by_roles(role_ids):
+    return set(App.objects.filter(role__in=role_ids).values_list("name", flat=True).distinct())
+
+
+def get_app_names_by_groups(group_ids):
+    return set(App.objects.filter(role__group__in=group_ids).values_list("name", flat=True).distinct())
+
+
+# 关联到资源自身或其任一祖先资源的角色
+def get_role_ids_by_resources(resource_ids):
+    resource_ids = [resource_id for resource_id in resource_ids if resource_id]
+    query = Resource.role.through.objects.filter(resource__descendant_links__descendant__in=resource_ids)
+    return set(query.values_list("role_id", flat=True))
+
+
+# 根据多对多关系两端的id计算受影响的用户及应用，owner_ids为定义多对多字段一侧的id
+m2m_affected_maps = {
+    Role.user.through: lambda owner_ids, target_ids: (set(target_ids), get_app_names_by_roles(owner_ids)),
+    Role.group.through: lambda owner_ids, target_ids: (get_user_ids_by_groups(target_ids),
+                                                       get_app_names_by_roles(owner_ids)),
+    Group.user.through: lambda owner_ids, target_ids: (set(target_ids), get_app_names_by_groups(owner_ids)),
+}
+
+
+def get_related_pk_set(sender, instance, model):
+    instance_field = instance.__class__.__name__.lower()
+    related_field = "{}_id".format(model.__name__.lower())
+    return set(sender.objects.filter(**{instance_field: instance.pk}).values_list(related_field, flat=True))
+
+
+def clear_m2m_permission_cache(sender, instance, reverse, pk_set):
+    if not pk_set:
+        return
+    if reverse:
+        owner_ids, target_ids = pk_set, [instance.pk]
+    else:
+        owner_ids, target_ids = [instance.pk], pk_set
+    user_ids, app_names = m2m_affected_maps[sender](owner_ids, target_ids)
+    role_ids = None if sender is Group.user.through else owner_ids
+    clear_user_permission_cache(user_ids, app_names, role_ids)
+
+
+def permission_m2m_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action in ("post_add", "post_remove"):
+        clear_m2m_permission_cache(sender, instance, reverse, pk_set)
+    # clear操作不提供pk_set，需要在清除前记录关联的id
+    elif action == "pre_clear":
+        instance._permission_clear_pk_set = get_related_pk_set(sender, instance, model)
+    elif action == "post_clear":
+        clear_m2m_permission_cache(sender, instance, reverse, getattr(instance, "_permission_clear_pk_set", None))
+
+
+for through in m2m_affected_maps:
+    m2m_changed.connect(permission_m2m_changed, sender=through, dispatch_uid="permission_{}".format(through.__name__))
+
+
+# 资源与角色的关联变化时，重新计算相关角色在权限索引中的位图
+@receiver(m2m_changed, sender=Resource.role.through)
+def resource_role_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action == "pre_clear":
+        instance._permission_clear_pk_set = get_related_pk_set(sender, instance, model)
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_permission_clear_pk_set", None)
+    elif action not in ("post_add", "post_remove"):
+        return
+    if pk_set:
+        role_ids = [instance.pk] if reverse else pk_set
+        update_permission_index_on_commit([instance.app_id], role_ids)
+        bump_menu_version(instance.app_id, role_ids)
+
+
+# 仅更新排序字段时不影响权限索引
+def is_sort_id_update(update_fields):
+    return update_fields is not None and set(update_fields) == {"sort_id"}
+
+
+@receiver(pre_save, sender=Menu)
+@receiver(pre_save, sender=Resource)
+def tree_node_pre_save(sender, instance, update_fields=None, **kwargs):
+    instance._old_parent_id = instance._old_app_id = None
+    if is_sort_id_update(update_fields):
+        return
+    if instance.pk:
+        instance._old_parent_id, instance._old_app_id = sender.objects.filter(pk=instance.pk) \
+            .values_list("parent_id", "app_id").first() or (None, None)
+        if instance.parent_id != instance._old_parent_id:
+            check_parent(sender, instance.pk, instance.parent_id)
+
+
+# 维护层级闭包表，需在其它依赖闭包表的post_save信号之前执行；删除时闭包记录随节点级联删除
+@receiver(post_save, sender=Menu)
+@receiver(post_save, sender=Resource)
+def tree_node_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        add_nodes(sender, [(instance.id, instance.parent_id)])
+    elif not is_sort_id_update(update_fields) and instance.parent_id != instance._old_parent_id:
+        move_node(sender, instance.id, instance.parent_id)
+
+
+# 资源的名称、可用状态或父资源变化会影响关联到自身及新旧祖先资源的角色的位图
+@receiver(post_save, sender=Resource)
+def resource_saved(sender, instance, update_fields=None, **kwargs):
+    if is_sort_id_update(update_fields):
+        return
+    role_ids = get_role_ids_by_resources([instance.id, instance.parent_id, getattr(instance, "_old_parent_id", None)])
+    # 移动到其它应用时旧应用的索引中同时移除该资源
+    update_permission_index_on_commit([instance.app_id, instance._old_app_id], role_ids, [instance.id])
+    bump_menu_version(instance.app_id, role_ids)
+    if instance._old_app_id not in (None, instance.app_id):
+        bump_menu_version(instance._old_app_id, role_ids)
+
+
+@receiver(pre_delete, sender=Resource)
+def resource_pre_delete(sender, instance, **kwargs):
+    instance._deleted_role_ids = get_role_ids_by_resources([instance.id, instance.parent_id])
+
+
+@receiver(post_delete, sender=Resource)
+def resource_deleted(sender, instance, **kwargs):
+    role_ids = getattr(instance, "_deleted_role_ids", ())
+    update_permission_index_on_commit([instance.app_id], role_ids, [instance.id])
+    bump_menu_version(instance.app_id, role_ids)
+
+
+# 菜单变化时使所属应用（包括移出的旧应用）的菜单树缓存失效
+@receiver(post_save, sender=Menu)
+def menu_saved(sender, instance, **kwargs):
+    bump_menu_version(instance.app_id)
+    if instance._old_app_id not in (None, instance.app_id):
+        bump_menu_version(instance._old_app_id)
+
+
+@receiver(post_delete, sender=Menu)
+def menu_deleted(sender, instance, **kwargs):
+    bump_menu_version(instance.app_id)
+
+
+# 执行migrate后补全已有节点的闭包记录，依赖闭包表的权限索引及菜单缓存随之失效
+@receiver(post_migrate)
+def closure_post_migrate(sender, **kwargs):
+    if sender.name != "core" or not backfill_closures():
+        return
+    for app in App.objects.all():
+        clear_app_caches(app)
+
+
+@receiver(pre_save, sender=App)
+def app_pre_save(sender, instance, **kwargs):
+    instance._old_name = None
+    if instance.pk:
+        instance._old_name = App.objects.filter(pk=instance.pk).values_list("name", flat=True).first()
+
+
+@receiver(post_save, sender=App)
+@receiver(post_delete, sender=App)
+def app_changed(sender, instance, **kwargs):
+    old_name = getattr(instance, "_old_name", None)
+    clear_app_permission_cache(instance.name)
+    if old_name and old_name != instance.name:
+        clear_app_permission_cache(old_name)
+    clear_app_id_cache([instance.name, old_name])
+    bump_menu_version(instance.id)
+
+
+@receiver(pre_save, sender=Role)
+def role_pre_save(sender, instance, **kwargs):
+    instance._old_app_id = None
+    if instance.pk:
+        instance._old_app_id = Role.objects.filter(pk=instance.pk).values_list("app_id", flat=True).first()
+
+
+@receiver(post_save, sender=Role)
+def role_saved(sender, instance, created, **kwargs):
+    # 角色可能被移动到其它应用，清除该角色下用户在新旧应用的缓存
+    if not created:
+        app_names = App.objects.filter(id__in=[instance.app_id, instance._old_app_id]).values_list("name", flat=True)
+        clear_user_permission_cache(get_user_ids_by_roles([instance.id]), list(app_names), [instance.id])
+        if instance._old_app_id not in (None, instance.app_id):
+            update_permission_index_on_commit([instance.app_id, instance._old_app_id], [instance.id])
+
+
+# 级联删除多对多关系时不会触发m2m_changed信号，在删除前清除受影响用户的缓存
+@receiver(pre_delete, sender=Role)
+def role_pre_delete(sender, instance, **kwargs):
+    clear_user_permission_cache(get_user_ids_by_roles([instance.id]), [instance.app.name], [instance.id])
+
+
+@receiver(post_delete, sender=Role)
+def role_deleted(sender, instance, **kwargs):
+    update_permission_index_on_commit([instance.app_id], [instance.id])
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    clear_user_permission_cache(get_user_ids_by_groups([instance.id]), get_app_names_by_groups([instance.id]))
+
+
+# 在事务提交后吊销被禁用用户的临时token，并刷新其他用户临时token中的快照
+def update_temp_tokens_on_commit(users):
+    users = list(users)
+
+    def update():
+        for user in users:
+            if user.is_active:
+                refresh_temp_tokens(user)
+            else:
+                revoke_temp_tokens(user.id)
+    transaction.on_commit(update)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    clear_user_permission_cache([instance.id])
+    # 删除后instance.id被置为None，需在此时取出
+    user_id = instance.id
+    transaction.on_commit(lambda: revoke_temp_tokens(user_id))
+
+
+# 以下字段不包含在token缓存的用户快照中
+token_snapshot_ignore_fields = {"_password", "last_login", "password_verified_time"}
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and set(update_fields) <= token_snapshot_ignore_fields):
+        return
+    clear_token_cache(Token.objects.filter(user=instance).values_list("key", flat=True))
+    # 临时token中缓存了用户快照，禁用用户时吊销其所有临时token，否则刷新快照
+    update_temp_tokens_on_commit([instance])
+
+
+@receiver(pre_save, sender=Token)
+def token_pre_save(sender, instance, **kwargs):
+    instance._old_key = None
+    if instance.pk:
+        instance._old_key = Token.objects.filter(pk=instance.pk).values_list("key", flat=True).first()
+
+
+# 重置token后清除旧token的缓存
+@receiver(post_save, sender=Token)
+def token_saved(sender, instance, **kwargs):
+    old_key = getattr(instance, "_old_key", None)
+    if old_key != instance.key:
+        clear_token_cache([old_key])
+
+
+# 删除用户时token随之级联删除
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    clear_token_cache([instance.key])
+
+
+# bulk_create及批量更新不会触发模型信号，批量写入提交后调用，清除与逐条保存时相同的缓存
+def objects_bulk_saved(model, objs, created, old_app_ids=(), old_parent_ids=()):
+    app_ids = set(getattr(obj, "app_id", None) for obj in objs) | set(old_app_ids)
+    app_ids.discard(None)
+    bump_model_versions([model], app_ids)
+    if model in (Menu, Resource):
+        for app_id in app_ids:
+            bump_menu_version(app_id)
+    if model is Resource:
+        resource_ids = [obj.id for obj in objs]
+        role_ids = get_role_ids_by_resources(resource_ids + [obj.parent_id for obj in objs] + list(old_parent_ids))
+        update_permission_index_on_commit(app_ids, role_ids, resource_ids)
+    if created:
+        return
+    if model is Role:
+        role_ids = [obj.id for obj in objs]
+        app_names = App.objects.filter(id__in=app_ids).values_list("name", flat=True)
+        clear_user_permission_cache(get_user_ids_by_roles(role_ids), list(app_names), role_ids)
+        # 与逐条保存一致，角色移动到其它应用时同时更新新旧应用的权限索引
+        update_permission_index_on_commit(app_ids, role_ids)
+    elif model is User:
+        clear_token_cache(Token.objects.filter(user__in=objs).values_list("key", flat=True))
+        update_temp_tokens_on_commit(objs)
+
+
+# 模型数据变化时递增其版本号，使依赖该模型的响应缓存失效，属于应用的模型同时递增新旧应用下的版本号
+def model_changed(sender, instance, **kwargs):
+    bump_model_versions([sender], [getattr(instance, "app_id", None), getattr(instance, "_old_app_id", None)])
+
+
+# 多对多关系变化时递增两端模型的版本号
+def model_m2m_changed(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        bump_model_versions([field.related_model for field in sender._meta.fields if field.is_relation])
+
+
+for model in (App, User, Group, Role, Menu, Resource):
+    post_save.connect(model_changed, sender=model, dispatch_uid="version_save_{}".format(model.__name__))
+    post_delete.connect(model_changed, sender=model, dispatch_uid="version_delete_{}".format(model.__name__))
+
+for through in (Role.user.through, Role.group.through, Group.user.through, Resource.role.through):
+    m2m_changed.connect(model_m2m_changed, sender=through, dispatch_uid="version_{}".format(through.__name__))
@@ -0,0 +1,278 @@
+# coding: utf8
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+from core.libs import utils
+from core.libs.caches import get_version, bump_versions
+from utils.tokens import TokenVerifier, InvalidToken, sign_token, decode_token, is_signed_token, \
+    build_revocation_list
+
+UserModel = get_user_model()
+# 与访问token的用户快照字段一致，使用临时token的请求读取用户信息时无需查询数据库
+tmp_token_snapshot_fields = ['id', 'username', 'cname', 'email', 'is_active', 'last_login']
+# 票据中除用户快照外携带的用户信息，兑换票据时直接返回，无需查询数据库
+ticket_profile_fields = ['username', 'cname', 'email']
+
+# 读取token并在剩余有效期低于阈值时刷新过期时间，一次往返完成，返回值及是否刷新
+GET_AND_REFRESH_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return nil
+end
+local ttl = redis.call('TTL', KEYS[1])
+if ttl >= 0 and ttl < tonumber(ARGV[1]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return {value, 1}
+end
+return {value, 0}
+"""
+
+# 以新的用户快照覆盖用户的临时token及未兑换的票据，保留原有的过期时间
+REFRESH_SNAPSHOT_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    local key_type = redis.call('TYPE', key).ok
+    if key_type == 'string' then
+        local ttl = redis.call('PTTL', key)
+        if ttl > 0 then
+            redis.call('SET', key, ARGV[1], 'PX', ttl)
+        end
+    elseif key_type == 'hash' then
+        redis.call('HSET', key, 'value', ARGV[1])
+    end
+end
+"""
+
+REVOCATION_VERSION_NAME = "revocation"
+REVOCATION_CACHE_PREFIX = "revocation"
+
+# 读取票据中的用户快照，票据不存在或为旧格式时返回nil
+GET_TICKET_VALUE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'hash' then
+    return nil
+end
+return redis.call('HGET', KEYS[1], 'value')
+"""
+
+# 兑换票据：读取并删除票据，以票据中的用户快照生成临时token并加入用户token索引，一次往返原子完成。
+# KEYS依次为票据、用户token索引及临时token的键，不传入临时token的键时只读取并删除票据，由调用方生成签名token。
+# 票据不存在、已被兑换或为旧格式时返回nil
+REDEEM_TICKET_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'hash' then
+    return nil
+end
+local value = redis.call('HGET', KEYS[1], 'value')
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], KEYS[1])
+if #KEYS == 2 then
+    return value
+end
+redis.call('SET', KEYS[3], value, 'EX', ARGV[1])
+redis.call('SADD', KEYS[2], KEYS[3])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return value
+"""
+scripts = {}
+
+
+def get_script(source):
+    if source not in scripts:
+        scripts[source] = get_redis_connection("default").register_script(source)
+    return scripts[source]
+
+
+def get_tmp_token_key(token_str, token_type="token"):
+    cache_prefix = utils.TMP_TICKET_PREFIX if token_type == "ticket" else utils.TMP_TOKEN_PREFIX
+    return "{}:{}".format(cache_prefix, token_str)
+
+
+def get_user_snapshot(user):
+    return dict((field, getattr(user, field)) for field in tmp_token_snapshot_fields)
+
+
+# 由快照还原用户对象，快照之外的字段（如旧格式快照中缺少的字段）在首次访问时才从数据库加载
+def load_user_snapshot(snapshot):
+    fields = [field for field in tmp_token_snapshot_fields if field in snapshot]
+    return UserModel.from_db("default", fields, [snapshot[field] for field in fields])
+
+
+# 签名token的payload中携带用户快照，last_login以ISO格式保存
+def get_signed_payload_snapshot(payload):
+    return {"id": payload["uid"], "username": payload["usr"], "cname": payload.get("cn"),
+            "email": payload.get("eml"), "is_active": True,
+            "last_login": parse_datetime(payload["lgn"]) if payload.get("lgn") else None}
+
+
+# 用户的临时token索引，用于禁用用户时吊销其所有临时token
+def get_user_token_index_key(user_id):
+    return cache.client.make_key("{}:user:{}".format(utils.TMP_TOKEN_PREFIX, user_id))
+
+
+# 票据保存为hash，value为兑换后临时token的值（用户快照，包含ticket_profile_fields）
+def get_ticket_value(user):
+    return get_user_snapshot(user)
+
+
+def generate_signed_token(user):
+    key_id = utils.TMP_TOKEN_SIGNING_KEY_ID
+    if key_id not in utils.TMP_TOKEN_SIGNING_KEYS:
+        raise ImproperlyConfigured("USER_TEMP_TOKEN_SIGNING_KEY_ID is not in USER_TEMP_TOKEN_SIGNING_KEYS")
+    now = int(time.time())
+    payload = {"uid": user.id, "usr": user.username, "cn": user.cname, "eml": user.email,
+               "lgn": user.last_login.isoformat() if user.last_login else None,
+               "iat": now, "exp": now + utils.TMP_TOKEN_TIMEOUT, "jti": uuid.uuid4().hex}
+    return sign_token(payload, key_id, utils.TMP_TOKEN_SIGNING_KEYS[key_id])
+
+
+def is_signed_format(token_format=None):
+    return (token_format or utils.TMP_TOKEN_FORMAT) == "signed"
+
+
+# token_format为空时使用USER_TEMP_TOKEN_FORMAT配置的格式，票据总是保存在redis中
+def generate_temp_token(user, token_type="token", token_format=None):
+    if token_type != 'ticket' and is_signed_format(token_format):
+        return generate_signed_token(user)
+    token_str = uuid.uuid4().hex
+    token_key = cache.client.make_key(get_tmp_token_key(token_str, token_type))
+    index_key = get_user_token_index_key(user.id)
+    pipe = get_redis_connection("default").pipeline()
+    if token_type == 'ticket':
+        pipe.hset(token_key, "value", cache.client.encode(get_ticket_value(user)))
+        pipe.expire(token_key, utils.TMP_TICKET_TIMEOUT)
+    else:
+        pipe.set(token_key, cache.client.encode(get_user_snapshot(user)), ex=utils.TMP_TOKEN_TIMEOUT)
+    # 票据同样加入索引，禁用用户时未兑换的票据一并吊销
+    pipe.sadd(index_key, token_key)
+    pipe.expire(index_key, utils.TMP_TOKEN_TIMEOUT)
+    pipe.execute()
+    return token_str
+
+
+# 读取临时token中的用户快照，剩余有效期低于TMP_TOKEN_REFRESH_RATIO比例时才刷新过期时间
+def get_temp_token_value(token_str):
+    timeout = utils.TMP_TOKEN_TIMEOUT
+    script = get_script(GET_AND_REFRESH_SCRIPT)
+    result = script(keys=[cache.client.make_key(get_tmp_token_key(token_str))],
+                    args=[int(timeout * utils.TMP_TOKEN_REFRESH_RATIO), timeout])
+    if result is None:
+        return None
+    value, refreshed = result
+    value = cache.client.decode(value)
+    # token刷新后同步延长用户token索引的过期时间，保证索引不早于token过期
+    if refreshed and isinstance(value, dict):
+        get_redis_connection("default").expire(get_user_token_index_key(value["id"]), timeout)
+    return value
+
+
+# 用户快照中的用户id，快照不存在或格式错误时返回None
+def get_snapshot_user_id(value):
+    if value is None:
+        return None
+    value = cache.client.decode(value)
+    return value.get("id") if isinstance(value, dict) else None
+
+
+# 兑换票据并生成临时token，返回临时token及票据中的用户信息，票据无效时返回None
+def redeem_ticket(ticket, token_format=None):
+    ticket_key = cache.client.make_key(get_tmp_token_key(ticket, "ticket"))
+    # 票据为随机串，先由票据中的用户快照得到用户token索引的键；并发兑换时只有一个请求能在脚本中读到票据
+    user_id = get_snapshot_user_id(get_script(GET_TICKET_VALUE_SCRIPT)(keys=[ticket_key]))
+    if user_id is None:
+        return None
+    script = get_script(REDEEM_TICKET_SCRIPT)
+    keys = [ticket_key, get_user_token_index_key(user_id)]
+    if is_signed_format(token_format):
+        value = script(keys=keys)
+        if value is None:
+            return None
+        value = cache.client.decode(value)
+        return generate_signed_token(load_user_snapshot(value)), value
+    token_str = uuid.uuid4().hex
+    value = script(keys=keys + [cache.client.make_key(get_tmp_token_key(token_str))], args=[utils.TMP_TOKEN_TIMEOUT])
+    if value is None:
+        return None
+    return token_str, cache.client.decode(value)
+
+
+# 已吊销的签名token id，分值为token的过期时间，及{用户id: 吊销时间}
+def get_revocation_keys():
+    return cache.client.make_key("{}:revoked".format(utils.TMP_TOKEN_PREFIX)), \
+        cache.client.make_key("{}:revoked_users".format(utils.TMP_TOKEN_PREFIX))
+
+
+# 吊销用户的所有临时token：删除redis中的token及票据，并使该用户此前签发的签名token失效
+def revoke_temp_tokens(user_id):
+    conn = get_redis_connection("default")
+    index_key = get_user_token_index_key(user_id)
+    token_keys = conn.smembers(index_key)
+    conn.delete(index_key, *token_keys)
+    conn.hset(get_revocation_keys()[1], user_id, int(time.time()))
+    bump_versions([REVOCATION_VERSION_NAME])
+
+
+# 用户信息变化后刷新其临时token中的用户快照，签名token在过期前仍携带签发时的用户信息
+def refresh_temp_tokens(user):
+    token_keys = list(get_redis_connection("default").smembers(get_user_token_index_key(user.id)))
+    if token_keys:
+        get_script(REFRESH_SNAPSHOT_SCRIPT)(keys=token_keys, args=[cache.client.encode(get_user_snapshot(user))])
+
+
+# 吊销单个临时token，用于注销登录。redis中的token同时从用户token索引中移除
+def revoke_temp_token(token_str):
+    if not is_signed_token(token_str):
+        conn = get_redis_connection("default")
+        token_key = cache.client.make_key(get_tmp_token_key(token_str))
+        user_id = get_snapshot_user_id(conn.get(token_key))
+        pipe = conn.pipeline()
+        pipe.delete(token_key)
+        if user_id is not None:
+            pipe.srem(get_user_token_index_key(user_id), token_key)
+        pipe.execute()
+        return
+    try:
+        payload = decode_token(token_str, utils.TMP_TOKEN_SIGNING_KEYS)
+    except InvalidToken:
+        return
+    get_redis_connection("default").zadd(get_revocation_keys()[0], {payload["jti"]: payload["exp"]})
+    bump_versions([REVOCATION_VERSION_NAME])
+
+
+# 当前的吊销列表，按版本号缓存，生成时清理已过期的吊销记录
+def get_revocation_list():
+    version = get_version(REVOCATION_VERSION_NAME)
+    cache_key = "{}:{}".format(REVOCATION_CACHE_PREFIX, version)
+    revocations = cache.get(cache_key)
+    if revocations is not None:
+        return revocations
+    now = int(time.time())
+    tokens_key, users_key = get_revocation_keys()
+    conn = get_redis_connection("default")
+    pipe = conn.pipeline()
+    pipe.zremrangebyscore(tokens_key, "-inf", now)
+    pipe.zrange(tokens_key, 0, -1)
+    pipe.hgetall(users_key)
+    _, token_ids, users = pipe.execute()
+    users = dict((int(user_id), int(revoked_at)) for user_id, revoked_at in users.items())
+    # 吊销时间早于一个有效期的用户，其此前签发的token均已过期
+    expired_user_ids = [user_id for user_id, revoked_at in users.items() if revoked_at < now - utils.TMP_TOKEN_TIMEOUT]
+    if expired_user_ids:
+        conn.hdel(users_key, *expired_user_ids)
+    revocations = build_revocation_list([token_id.decode() for token_id in token_ids],
+                                        dict((user_id, revoked_at) for user_id, revoked_at in users.items()
+                                             if user_id not in expired_user_ids), version)
+    cache.set(cache_key, revocations, utils.TMP_TOKEN_TIMEOUT)
+    return revocations
+
+
+def check_revoked_token(token_id):
+    return get_redis_connection("default").zscore(get_revocation_keys()[0], token_id) is not None
+
+
+# 进程内校验签名token，按USER_TEMP_TOKEN_REVOCATION_SYNC_INTERVAL同步吊销列表，布隆过滤器命中时查询redis确认
+signed_token_verifier = TokenVerifier(utils.TMP_TOKEN_SIGNING_KEYS, get_revocation_list, check_revoked_token,
+                                      utils.TMP_TOKEN_REVOCATION_SYNC_INTERVAL)
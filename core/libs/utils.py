@@ -1,6 +1,8 @@
 # coding: utf8
+from collections import defaultdict
+
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Q, Case, When, Value
 from rest_framework import exceptions
 
 from core.models import Resource, Menu, Role
@@ -11,7 +13,15 @@ TMP_TOKEN_PREFIX = getattr(settings, "TMP_TOKEN_PREFIX", 'token')
 TMP_TICKET_PREFIX = getattr(settings, "TMP_TICKET_PREFIX", 'ticket')
 TMP_TOKEN_HEADER_STRING = getattr(settings, "TMP_TOKEN_HEADER", "tmp-token")
 TMP_TOKEN_TIMEOUT = getattr(settings, "USER_TEMP_TOKEN_TIMEOUT", 1800)
+# 临时token剩余有效期低于该比例时才刷新过期时间
+TMP_TOKEN_REFRESH_RATIO = getattr(settings, "USER_TEMP_TOKEN_REFRESH_RATIO", 0.5)
 TMP_TICKET_TIMEOUT = getattr(settings, "USER_TEMP_TICKET_TIMEOUT", 300)
+# 临时token格式，opaque为保存在redis中的随机串，signed为可在进程内校验的签名token
+TMP_TOKEN_FORMAT = getattr(settings, "USER_TEMP_TOKEN_FORMAT", "opaque")
+# 签名token的密钥{key id: 密钥}及签发使用的key id，轮换密钥时保留旧密钥直到其签发的token全部过期
+TMP_TOKEN_SIGNING_KEYS = getattr(settings, "USER_TEMP_TOKEN_SIGNING_KEYS", {})
+TMP_TOKEN_SIGNING_KEY_ID = getattr(settings, "USER_TEMP_TOKEN_SIGNING_KEY_ID", None)
+TMP_TOKEN_REVOCATION_SYNC_INTERVAL = getattr(settings, "USER_TEMP_TOKEN_REVOCATION_SYNC_INTERVAL", 10)
 SUPER_USERNAME_LIST = getattr(settings, "SUPER_USERNAME_LIST")
 APP_NAME = getattr(settings, "DEFAULT_APP_NAME", "sso")
 
@@ -28,58 +38,68 @@ def is_super_user(user):
         return True
 
 
-def extend_query_set(*args):
-    objs = []
-    for i in args:
-        for j in i:
-            if j not in objs:
-                objs.append(j)
-    return objs
+# 用户直接关联或通过用户组关联角色的过滤条件，以子查询代替多表连接，不会产生重复的行
+def get_user_role_filter(user, field="id"):
+    user_role_ids = Role.user.through.objects.filter(user=user).values("role_id")
+    group_role_ids = Role.group.through.objects.filter(group__user=user).values("role_id")
+    return Q(**{"{}__in".format(field): user_role_ids}) | Q(**{"{}__in".format(field): group_role_ids})
 
 
 def get_role_by_user_and_app(user, app):
-    user_groups = user.group_set.all()
-    role_list = Role.objects.filter(app=app).filter(Q(group__in=user_groups) | Q(user=user))
-    return role_list
+    return Role.objects.filter(app=app).filter(get_user_role_filter(user))
 
 
-def get_resource_by_user_and_app(user, app):
-    if is_super_user(user):
-        return Resource.objects.filter(app=app)
-    role_list = get_role_by_user_and_app(user, app)
+# 角色关联的资源及其任意层级的后代资源，经闭包表一次查询
+def get_resource_by_roles(role_list, app):
     resource_base_query = Resource.objects.filter(app=app).filter(available=1)
     resource_list = resource_base_query.filter(role__in=role_list)
-    children_resource_list = resource_base_query.filter(parent__in=resource_list)
-    return extend_query_set(resource_list, children_resource_list)
+    return resource_base_query.filter(ancestor_links__ancestor__in=resource_list).distinct()
 
 
-def get_menu_by_user_and_app(user, app):
+def get_resource_by_user_and_app(user, app):
     if is_super_user(user):
-        menus = Menu.objects.filter(app=app).filter(available=1).order_by("sort_id")
-    else:
-        menu_base_query = Menu.objects.filter(app=app).filter(available=1)
-        resource_list = get_resource_by_user_and_app(user, app)
-        menu_list = menu_base_query.filter(resource__in=resource_list).order_by("sort_id")
-        children_menu_list = menu_base_query.filter(parent__in=menu_list).order_by("sort_id")
-        menus = extend_query_set(menu_list, children_menu_list)
-    return sort_obj(menus, MenuSerializer)
+        return Resource.objects.filter(app=app)
+    return get_resource_by_roles(get_role_by_user_and_app(user, app), app)
+
+
+def get_menu_by_app(app):
+    return get_tree_by_queryset(Menu.objects.filter(app=app).filter(available=1).order_by("sort_id"), MenuSerializer)
+
+
+# 菜单只取决于角色集合，相同角色的用户得到相同的菜单树
+def get_menu_by_roles(role_list, app):
+    menu_base_query = Menu.objects.filter(app=app).filter(available=1).order_by("sort_id")
+    resource_list = get_resource_by_roles(role_list, app)
+    # 资源所属菜单及其任意层级的后代菜单
+    menu_list = menu_base_query.filter(ancestor_links__ancestor__in=menu_base_query.filter(resource__in=resource_list))
+    return build_tree(get_serialized_values(menu_list.distinct(), MenuSerializer))
 
 
 def get_resource_by_role(role):
     resource_base_query = Resource.objects.filter(available=1)
     resource_list = resource_base_query.filter(role=role)
-    children_resource_list = resource_base_query.filter(parent__in=resource_list)
-    return extend_query_set(resource_list, children_resource_list)
+    return resource_base_query.filter(ancestor_links__ancestor__in=resource_list).distinct()
+
+
+# 按序列化器的字段读取数据，外键字段输出主键值，与ModelSerializer的输出一致
+def get_serialized_values(queryset, serializer):
+    fields = serializer.Meta.fields
+    columns = [serializer.Meta.model._meta.get_field(field).attname for field in fields]
+    return [dict(zip(fields, row)) for row in queryset.values_list(*columns)]
+
+
+# 一次遍历按父节点分组构建树形结构，同一父节点下的子节点保持输入中的顺序
+def build_tree(nodes):
+    children_map = defaultdict(list)
+    for node in nodes:
+        children_map[node["parent"]].append(node)
+    for node in nodes:
+        node["children"] = children_map.get(node["id"], [])
+    return children_map.get(None, [])
 
 
-def sort_obj(obj_list, serializer, parent=None):
-    objs = []
-    for obj in obj_list:
-        if obj.parent == parent:
-            tmp_obj = serializer(obj).data
-            tmp_obj["children"] = sort_obj(obj_list, serializer, obj)
-            objs.append(tmp_obj)
-    return objs
+def get_tree_by_queryset(queryset, serializer):
+    return build_tree(get_serialized_values(queryset, serializer))
 
 
 def get_param_or_exception(request, key):
@@ -113,3 +133,20 @@ def get_obj_by_request_param(request, model, param_id=None, param_name=None):
     elif param_name:
         uk_name = get_param_or_exception(request, param_name)
     return get_obj_or_exception(model, pk_id=pk_id, uk_name=uk_name)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# 使用CASE WHEN按主键批量更新多条记录的指定字段，每批一条UPDATE语句
+def bulk_update(model, objs, fields, batch_size=500):
+    for batch in chunks(list(objs), batch_size):
+        values = {}
+        for field in fields:
+            output_field = model._meta.get_field(field)
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, output_field.attname), output_field=output_field))
+                     for obj in batch]
+            values[output_field.attname] = Case(*whens, output_field=output_field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**values)
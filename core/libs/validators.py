@@ -1,8 +1,8 @@
 # coding: utf8
 import re
 
+from django.core.exceptions import ValidationError
 from django.utils.deconstruct import deconstructible
-from rest_framework.exceptions import ValidationError
 
 
 class RegexValidator:
@@ -0,0 +1,27 @@
+# coding: utf8
+from django.core.management.base import BaseCommand, CommandError
+
+from core.libs.export import EXPORT_CHUNK_SIZE, EXPORT_CONTENT_TYPES, export_tables, iter_export
+
+
+class Command(BaseCommand):
+    help = "流式导出用户、用户组、角色及其关联关系"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=list(export_tables), help="导出的数据")
+        parser.add_argument("--format", default="ndjson", choices=list(EXPORT_CONTENT_TYPES), help="导出格式")
+        parser.add_argument("--output", help="输出文件，默认输出到标准输出")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="每次查询读取的行数")
+
+    def handle(self, *args, **options):
+        try:
+            rows = iter_export(options["name"], options["format"], options["chunk_size"])
+        except ValueError as e:
+            raise CommandError(e)
+        if not options["output"]:
+            for line in rows:
+                self.stdout.write(line, ending="")
+            return
+        with open(options["output"], "w", encoding="utf8", newline="") as output:
+            for line in rows:
+                output.write(line)
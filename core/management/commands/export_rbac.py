@@ -0,0 +1,26 @@
+# coding: utf8
+from django.core.management.base import BaseCommand, CommandError
+
+from core.libs.rbac import iter_app_document
+from core.models import App
+
+
+class Command(BaseCommand):
+    help = "导出应用的菜单、资源、角色及角色与资源关联的配置文档"
+
+    def add_arguments(self, parser):
+        parser.add_argument("app_name", help="应用名称")
+        parser.add_argument("--output", help="输出文件，默认输出到标准输出")
+
+    def handle(self, *args, **options):
+        try:
+            app = App.objects.get(name=options["app_name"])
+        except App.DoesNotExist:
+            raise CommandError("app {} does not exist".format(options["app_name"]))
+        if not options["output"]:
+            for chunk in iter_app_document(app):
+                self.stdout.write(chunk, ending="")
+            return
+        with open(options["output"], "w", encoding="utf8") as output:
+            for chunk in iter_app_document(app):
+                output.write(chunk)
@@ -0,0 +1,31 @@
+# coding: utf8
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import APIException
+
+from core.libs.rbac import import_app_document
+
+
+class Command(BaseCommand):
+    help = "导入应用的权限配置文档，按(名称, 应用)更新已存在的记录，可重复执行"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="配置文档路径，-表示从标准输入读取")
+        parser.add_argument("--app-name", help="导入到指定的应用，默认使用文档中的应用名称")
+
+    def handle(self, *args, **options):
+        try:
+            if options["file"] == "-":
+                document = json.load(sys.stdin)
+            else:
+                with open(options["file"], encoding="utf8") as f:
+                    document = json.load(f)
+            stats = import_app_document(document, options["app_name"])
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        except APIException as e:
+            raise CommandError(e.detail)
+        for key, value in stats.items():
+            self.stdout.write("{}: {}".format(key, ", ".join("{} {}".format(k, v) for k, v in value.items())))
@@ -0,0 +1,21 @@
+# coding: utf8
+from django.core.management.base import BaseCommand
+
+from core.libs.caches import clear_app_caches
+from core.libs.closure import closure_models, rebuild_closure
+from core.models import App
+
+
+class Command(BaseCommand):
+    help = "根据parent字段重建菜单及资源的层级闭包表，部署闭包表后需执行一次"
+
+    def handle(self, *args, **options):
+        for model in closure_models:
+            skipped = rebuild_closure(model)
+            self.stdout.write("{} closure rebuilt".format(model.__name__.lower()))
+            if skipped:
+                self.stderr.write("skip {} {} with circular parent reference".format(skipped,
+                                                                                     model.__name__.lower()))
+        # 权限索引及菜单缓存依赖闭包表，重建后全部失效
+        for app in App.objects.all():
+            clear_app_caches(app)
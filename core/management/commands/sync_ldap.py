@@ -0,0 +1,143 @@
+# coding: utf8
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from core.libs import utils
+from core.libs.auth import LDAPAuth
+from core.libs.signals import objects_bulk_saved
+from core.models import User, Token
+
+SYNC_CACHE_PREFIX = "ldap_sync"
+
+
+class Command(BaseCommand):
+    help = "增量同步LDAP中的用户到本地用户表"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true", help="忽略上次同步的位置，同步所有用户")
+        parser.add_argument("--deactivate", action="store_true", help="禁用LDAP中已不存在的本地用户")
+        parser.add_argument("--exclude", nargs="*", default=[],
+                            help="禁用用户时排除的用户名，与LDAP_SYNC_EXCLUDE_USERNAMES配置合并")
+        parser.add_argument("--batch-size", type=int, default=1000, help="每批写入数据库的用户数")
+        parser.add_argument("--page-size", type=int, default=500, help="LDAP分页查询每页的条目数")
+
+    def handle(self, *args, **options):
+        self.batch_size = options["batch_size"]
+        self.page_size = options["page_size"]
+        self.user_filter = getattr(settings, "LDAP_SYNC_FILTER", None)
+        self.ldap_auth = LDAPAuth(host=settings.LDAP_HOST, port=settings.LDAP_PORT,
+                                  search_base=settings.LDAP_SEARCH_BASE,
+                                  admin_dn=getattr(settings, "LDAP_ADMIN_DN", None),
+                                  admin_password=getattr(settings, "LDAP_ADMIN_PASSWORD", None))
+        self.created = self.updated = self.skipped = 0
+        self.sync(None if options["full"] else cache.get(self.get_sync_key()))
+        if options["deactivate"]:
+            self.deactivate(set(getattr(settings, "LDAP_SYNC_EXCLUDE_USERNAMES", [])) | set(options["exclude"]))
+
+    def get_sync_key(self):
+        return "{}:{}:{}:{}".format(SYNC_CACHE_PREFIX, settings.LDAP_HOST, settings.LDAP_PORT,
+                                    settings.LDAP_SEARCH_BASE)
+
+    @staticmethod
+    def get_sync_value(value):
+        # uSNChanged为数字，modifyTimestamp为同一格式的时间字符串，可直接比较
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
+    def sync(self, since):
+        self.stdout.write("sync ldap users since {}".format(since))
+        high_water_mark = since
+        batch = []
+        for user_info, sync_value in self.ldap_auth.search_users(self.user_filter, since, self.page_size):
+            sync_value = self.get_sync_value(sync_value)
+            if sync_value is not None and (high_water_mark is None or sync_value > high_water_mark):
+                high_water_mark = sync_value
+            batch.append(user_info)
+            if len(batch) >= self.batch_size:
+                self.upsert(batch)
+                batch = []
+        if batch:
+            self.upsert(batch)
+        # 全部写入成功后才记录同步位置，失败时下次从上次的位置重新同步
+        if high_water_mark is not None:
+            cache.set(self.get_sync_key(), high_water_mark, None)
+        self.stdout.write("created: {}, updated: {}, skipped: {}, high water mark: {}".format(
+            self.created, self.updated, self.skipped, high_water_mark))
+
+    def get_valid_users(self, batch):
+        users = {}
+        for user_info in batch:
+            user = User(username=user_info["username"], cname=user_info["displayName"], email=user_info["mail"])
+            try:
+                for field in ["username", "cname", "email"]:
+                    User._meta.get_field(field).run_validators(getattr(user, field))
+                if not user.email:
+                    raise ValidationError("email is required")
+            except Exception as e:
+                self.skipped += 1
+                self.stderr.write("skip ldap user {}: {}".format(user.username, e))
+                continue
+            users[user.username] = user
+        return users
+
+    @transaction.atomic
+    def upsert(self, batch):
+        users = self.get_valid_users(batch)
+        existing_users = dict((user.username, user) for user in User.objects.filter(username__in=list(users)))
+        # 邮箱唯一，新建或更新的条目与其他用户的邮箱冲突时跳过，避免整批写入失败
+        email_owners = dict(User.objects.filter(email__in=[user.email for user in users.values()])
+                            .values_list("email", "username"))
+        to_create = []
+        to_update = []
+        for username, user in users.items():
+            old_user = existing_users.get(username)
+            if email_owners.setdefault(user.email, username) != username:
+                self.skipped += 1
+                self.stderr.write("skip ldap user {}: email {} already exist".format(username, user.email))
+                continue
+            if old_user is None:
+                to_create.append(user)
+            # LDAP中重新出现的已禁用用户同时启用
+            elif (old_user.cname, old_user.email, old_user.is_active) != (user.cname, user.email, True):
+                old_user.cname = user.cname
+                old_user.email = user.email
+                old_user.is_active = True
+                to_update.append(old_user)
+        if to_create:
+            User.objects.bulk_create(to_create, batch_size=self.batch_size)
+            # bulk_create不会调用User.save，在此为新用户批量创建token
+            created_ids = User.objects.filter(username__in=[user.username for user in to_create]) \
+                .values_list("id", flat=True)
+            Token.objects.bulk_create([Token(key=uuid.uuid4().hex, user_id=user_id) for user_id in created_ids],
+                                      batch_size=self.batch_size)
+            transaction.on_commit(lambda: objects_bulk_saved(User, to_create, created=True))
+        if to_update:
+            utils.bulk_update(User, to_update, ["cname", "email", "is_active"], batch_size=self.batch_size)
+            # 批量写入不会触发信号，提交后递增用户模型版本号并清除token缓存
+            transaction.on_commit(lambda: objects_bulk_saved(User, to_update, created=False))
+        self.created += len(to_create)
+        self.updated += len(to_update)
+
+    # 查询LDAP中的全部用户名，禁用本地存在而LDAP中已不存在的用户，超级管理员及exclude_usernames中的本地、服务账号除外
+    def deactivate(self, exclude_usernames):
+        ldap_usernames = set(user_info["username"] for user_info, _ in
+                             self.ldap_auth.search_users(self.user_filter, page_size=self.page_size))
+        if not ldap_usernames:
+            self.stderr.write("no user found in ldap, skip deactivating")
+            return
+        query = User.objects.filter(is_active=True) \
+            .exclude(username__in=set(utils.SUPER_USERNAME_LIST or []) | exclude_usernames)
+        removed_ids = [user_id for user_id, username in query.values_list("id", "username").iterator(chunk_size=2000)
+                       if username not in ldap_usernames]
+        for user_ids in utils.chunks(removed_ids, self.batch_size):
+            User.objects.filter(id__in=user_ids).update(is_active=False)
+            # update不会触发信号，在此递增用户模型版本号、清除token缓存并吊销临时token
+            objects_bulk_saved(User, list(User.objects.filter(id__in=user_ids)), created=False)
+        self.stdout.write("deactivated: {}".format(len(removed_ids)))
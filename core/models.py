@@ -47,6 +47,7 @@ class User(BaseModel):
     email = models.EmailField(unique=True, max_length=100, verbose_name="邮箱")
     is_active = models.BooleanField(default=True, verbose_name="用户是否可用")
     last_login = models.DateTimeField(blank=True, null=True, verbose_name="最后登录时间")
+    password_verified_time = models.DateTimeField(blank=True, null=True, verbose_name="密码最后一次通过LDAP校验的时间")
 
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = ['cname', 'email']
@@ -80,6 +81,9 @@ class User(BaseModel):
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
+        # 仅更新部分字段（如登录时更新密码、登录时间）时不检查token
+        if kwargs.get("update_fields") is not None:
+            return
         token = Token.objects.filter(user__username=self.username)
         if not token.exists():
             token = Token()
@@ -182,3 +186,26 @@ class Resource(BaseModel):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         return set_default_sort_id(self)
+
+
+# 菜单层级的闭包表，每个菜单与其自身及所有祖先菜单各有一条记录
+class MenuClosure(models.Model):
+    ancestor = models.ForeignKey(Menu, on_delete=models.CASCADE, related_name="descendant_links", verbose_name="祖先菜单")
+    descendant = models.ForeignKey(Menu, on_delete=models.CASCADE, related_name="ancestor_links",
+                                   verbose_name="后代菜单")
+    depth = models.IntegerField(verbose_name="层级距离")
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
+
+
+# 资源层级的闭包表，每个资源与其自身及所有祖先资源各有一条记录
+class ResourceClosure(models.Model):
+    ancestor = models.ForeignKey(Resource, on_delete=models.CASCADE, related_name="descendant_links",
+                                 verbose_name="祖先资源")
+    descendant = models.ForeignKey(Resource, on_delete=models.CASCADE, related_name="ancestor_links",
+                                   verbose_name="后代资源")
+    depth = models.IntegerField(verbose_name="层级距离")
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
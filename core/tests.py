@@ -1,3 +1,859 @@
-from django.test import TestCase
+# coding: utf8
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, Client, override_settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from ldap3.core.exceptions import LDAPCommunicationError
+from rest_framework import exceptions
+
+from core.libs import pubsub, utils
+from core.libs.closure import move_node
+from core.libs.events import receive_event, recent_events
+from core.libs.auth import CircuitBreaker, LDAPBusy, LDAPCircuitOpen, LDAPConnectionPool, LDAPExecutor, \
+    LDAPUnavailable, LDAP_RECEIVE_TIMEOUT
+from core.libs.backends import LDAPAuthBackend, LDAP_FALLBACK_MAX_AGE, verified_password_cache
+from core.libs.caches import set_user_permission_cache, get_token_cache, set_token_cache, token_local_cache, \
+    get_rbac_version_name, get_version, TOKEN_INVALIDATE_CHANNEL
+from core.libs.index import get_cached_permission_index, get_permission_index, local_indexes
+from core.libs.permissions import check_user_has_permission, get_user_permissions, check_permissions_by_sql
+from core.libs.tokens import generate_temp_token, get_tmp_token_key, get_user_token_index_key
+from core.models import App, Group, Menu, MenuClosure, Resource, ResourceClosure, Role, Token, User
+
+
+class BaseTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        # 后台线程看不到测试事务中的数据，不在后台建立权限索引
+        patcher = mock.patch("core.libs.permissions.build_permission_index_async")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.super_user = User.objects.create(username=utils.SUPER_USERNAME_LIST[0], email="super@test.com")
+        self.client = Client(HTTP_ACCESS_TOKEN=self.super_user.token.key)
+
+
+# 缓存清除、版本号递增及权限索引更新均在事务提交后执行，相关测试需使用TransactionTestCase
+class BaseTransactionTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        local_indexes.clear()
+
+
+class PermissionCacheTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = App.objects.create(name="app1")
+        menu = Menu.objects.create(name="menu1", description="d", url="/", app=self.app)
+        resource = Resource.objects.create(name="readA", description="d", app=self.app, menu=menu)
+        self.role = Role.objects.create(name="role1", description="d", app=self.app)
+        resource.role.add(self.role)
+        self.user = User.objects.create(username="user1", cname="用户1", email="user1@test.com")
+        self.role.user.add(self.user)
+        get_permission_index(self.app.name)
+
+    # 提交前其它请求以旧的角色集合重新缓存时，提交后仍会被清除
+    def test_clear_after_commit(self):
+        self.assertTrue(check_user_has_permission(self.user, "app1", "readA"))
+        with transaction.atomic():
+            self.role.user.remove(self.user)
+            set_user_permission_cache("app1", self.user.id, [self.role.id])
+        self.assertFalse(check_user_has_permission(self.user, "app1", "readA"))
+
+
+class RbacImportTestCase(BaseTestCase):
+    def test_import_invalid_names(self):
+        document = {
+            "menus": [{"name": "bad name", "description": "d", "url": "/"},
+                      {"name": "menu1", "description": "d", "url": "/"}],
+            "resources": [{"name": "bad-resource", "description": "d", "menu": "menu1"}],
+            "roles": [{"name": "role1", "description": "d"}],
+        }
+        response = self.client.post("/sso/api/rbac/app3", document, content_type="application/json")
+        data = response.json()
+        self.assertEqual(data["code"], 400)
+        self.assertEqual(set(data["msg"]), {"menus.bad name", "resources.bad-resource"})
+        self.assertEqual(list(data["msg"]["menus.bad name"]), ["name"])
+        self.assertEqual(list(data["msg"]["resources.bad-resource"]), ["name"])
+        # 校验失败时整个导入回滚
+        self.assertFalse(App.objects.filter(name="app3").exists())
+
+    # 父菜单校验失败时，子菜单及引用它们的资源记录为无效，而不是中断整个导入
+    def test_import_invalid_parent(self):
+        document = {
+            "menus": [{"name": "bad name", "description": "d", "url": "/"},
+                      {"name": "menu1", "description": "d", "url": "/", "parent": "bad name"},
+                      {"name": "menu2", "description": "d", "url": "/", "parent": "menu1"}],
+            "resources": [{"name": "readA", "description": "d", "menu": "menu2"},
+                          {"name": "readB", "description": "d", "menu": "menu2", "parent": "readA"}],
+        }
+        data = self.client.post("/sso/api/rbac/app3", document, content_type="application/json").json()
+        self.assertEqual(data["code"], 400)
+        self.assertEqual(list(data["msg"]["menus.bad name"]), ["name"])
+        self.assertEqual(data["msg"]["menus.menu1"], {"parent": ["parent bad name is invalid"]})
+        self.assertEqual(data["msg"]["menus.menu2"], {"parent": ["parent menu1 is invalid"]})
+        self.assertEqual(data["msg"]["resources.readA"], {"menu": ["menu menu2 is invalid"]})
+        self.assertEqual(set(data["msg"]["resources.readB"]), {"parent", "menu"})
+
+
+class TokenCacheTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        token_local_cache.clear()
+        self.user = User.objects.create(username="user1", cname="用户1", email="user1@test.com")
+        self.key = self.user.token.key
+        self.user_client = Client(HTTP_ACCESS_TOKEN=self.key)
+
+    def get_myself(self):
+        return self.user_client.get("/sso/api/user/myself/").json()
+
+    def test_cache_hit(self):
+        self.get_myself()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_myself()["data"]["cname"], "用户1")
+        # 进程内缓存失效后从redis读取
+        token_local_cache.clear()
+        with self.assertNumQueries(0):
+            self.get_myself()
+
+    # 提交前其它请求以旧快照重新缓存时，提交后仍会被清除
+    def test_deactivate_after_commit(self):
+        self.get_myself()
+        snapshot = get_token_cache(self.key)
+        with transaction.atomic():
+            self.user.is_active = False
+            self.user.save()
+            set_token_cache(self.key, snapshot)
+        self.assertEqual(self.get_myself()["code"], 401)
+
+    def test_publish_after_commit(self):
+        self.get_myself()
+        with mock.patch("core.libs.pubsub.publish") as publish:
+            with transaction.atomic():
+                self.user.cname = "用户2"
+                self.user.save()
+                publish.assert_not_called()
+            publish.assert_called_once_with(TOKEN_INVALIDATE_CHANNEL, [self.key])
+        # 其它进程收到消息后清除进程内缓存
+        token_local_cache.set(self.key, {})
+        pubsub.dispatch({"channel": pubsub.get_channel_name(TOKEN_INVALIDATE_CHANNEL), "data": json.dumps([self.key])})
+        self.assertIsNone(token_local_cache.get(self.key))
+        self.assertEqual(self.get_myself()["data"]["cname"], "用户2")
+
+
+class ResponseCacheTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.super_user = User.objects.create(username=utils.SUPER_USERNAME_LIST[0], email="super@test.com")
+        self.client = Client(HTTP_ACCESS_TOKEN=self.super_user.token.key)
+        self.group = Group.objects.create(name="group1", description="d")
+        self.user = User.objects.create(username="user1", cname="用户1", email="user1@test.com")
+        self.url = "/sso/api/group/{}/user/".format(self.group.id)
+
+    # 缓存命中且ETag未变化时返回304，不查询数据库
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()["data"], [])
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    # 关联关系变化后版本号递增，缓存失效
+    def test_invalidate_after_write(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.client.patch(self.url, {"add": [self.user.id]}, content_type="application/json")
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user["username"] for user in response.json()["data"]], ["user1"])
+        self.assertNotEqual(response["ETag"], etag)
+        # 关联用户的信息变化同样使缓存失效
+        self.user.cname = "用户2"
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).json()["data"][0]["cname"], "用户2")
+
+
+class VersionETagTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.super_user = User.objects.create(username=utils.SUPER_USERNAME_LIST[0], email="super@test.com")
+        self.client = Client(HTTP_ACCESS_TOKEN=self.super_user.token.key)
+        self.group = Group.objects.create(name="group1", description="d")
+
+    def assert_not_modified(self, url):
+        etag = self.client.get(url)["ETag"]
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        return etag
+
+    def test_list_and_retrieve(self):
+        list_url = "/sso/api/group/"
+        detail_url = "/sso/api/group/{}/".format(self.group.id)
+        list_etag = self.assert_not_modified(list_url)
+        detail_etag = self.assert_not_modified(detail_url)
+        self.client.put(detail_url, {"name": "group2", "description": "d"}, content_type="application/json")
+        response = self.client.get(list_url, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag).json()["data"]["name"],
+                         "group2")
+        # 事务回滚时版本号不变
+        etag = self.assert_not_modified(list_url)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Group.objects.create(name="group3", description="d")
+                raise RuntimeError
+        self.assertEqual(self.client.get(list_url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class PaginationTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            Group.objects.create(name="group{}".format(i), description="d")
+
+    # 未携带分页参数时返回完整列表
+    def test_plain_list(self):
+        data = self.client.get("/sso/api/group/").json()["data"]
+        self.assertEqual([group["name"] for group in data], ["group{}".format(i) for i in range(5)])
+
+    def test_cursor(self):
+        names = []
+        url = "/sso/api/group/?page_size=2"
+        while url:
+            data = self.client.get(url).json()["data"]
+            self.assertLessEqual(len(data["results"]), 2)
+            names += [group["name"] for group in data["results"]]
+            url = data["next"]
+        self.assertEqual(names, ["group{}".format(i) for i in range(5)])
+
+
+class MembershipPatchTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = Group.objects.create(name="group1", description="d")
+        self.users = [User.objects.create(username="user{}".format(i), cname="u", email="user{}@test.com".format(i))
+                      for i in range(3)]
+        self.group.user.add(self.users[0])
+        self.url = "/sso/api/group/{}/user/".format(self.group.id)
+
+    def patch(self, data):
+        return self.client.patch(self.url, data, content_type="application/json").json()
+
+    # 只写入实际变化的关联，已存在的关联不计入新增，不存在的关联不计入删除
+    def test_counts(self):
+        data = self.patch({"add": [self.users[0].id, self.users[1].id], "remove": [self.users[2].id]})
+        self.assertEqual(data["data"], {"added": 1, "removed": 0})
+        data = self.patch({"add": [self.users[2].id], "remove": [self.users[0].id]})
+        self.assertEqual(data["data"], {"added": 1, "removed": 1})
+        self.assertEqual(set(self.group.user.values_list("id", flat=True)), {self.users[1].id, self.users[2].id})
+
+    def test_invalid(self):
+        self.assertEqual(self.patch({"add": [self.users[1].id], "remove": [self.users[1].id]})["code"], 400)
+        self.assertEqual(self.patch({"add": [0]})["code"], 400)
+        self.assertEqual(self.patch({"add": self.users[1].id})["code"], 400)
+        self.assertEqual(list(self.group.user.values_list("id", flat=True)), [self.users[0].id])
+
+
+class BulkTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.super_user = User.objects.create(username=utils.SUPER_USERNAME_LIST[0], email="super@test.com")
+        self.client = Client(HTTP_ACCESS_TOKEN=self.super_user.token.key)
+        self.apps = [App.objects.create(name=name) for name in ["app1", "app2"]]
+
+    def bulk(self, url, items, method="post"):
+        return getattr(self.client, method)("/sso/api/{}/bulk/".format(url), {"items": items},
+                                            content_type="application/json").json()
+
+    # 唯一性校验与逐条新增、修改一致：批次内重复及与已有记录重名均报错，且不写入任何数据
+    def test_unique(self):
+        Role.objects.create(name="role1", description="d", app=self.apps[0])
+        data = self.bulk("role", [{"name": "role1", "description": "d", "app": self.apps[1].id},
+                                  {"name": "role2", "description": "d", "app": self.apps[0].id},
+                                  {"name": "role2", "description": "d", "app": self.apps[1].id}])
+        self.assertEqual(data["code"], 400)
+        self.assertEqual(set(data["msg"]), {"0", "2"})
+        response = self.client.post("/sso/api/role/", {"name": "role1", "description": "d", "app": self.apps[1].id},
+                                    content_type="application/json")
+        self.assertEqual(response.json()["code"], 400)
+        self.assertEqual(Role.objects.count(), 1)
+
+    # 与逐条保存相同：新增用户同时生成token，禁用用户后清除token缓存
+    def test_users(self):
+        data = self.bulk("user", [{"username": "user1", "cname": "用户1", "email": "user1@test.com"},
+                                  {"username": "user2", "cname": "用户2", "email": "user2@test.com"}])
+        user = User.objects.get(id=data["data"]["ids"][0])
+        user_client = Client(HTTP_ACCESS_TOKEN=user.token.key)
+        self.assertEqual(user_client.get("/sso/api/user/myself/").json()["code"], 200)
+        self.bulk("user", [{"id": user.id, "username": "user1", "cname": "用户1", "email": "user1@test.com",
+                            "is_active": False}], method="put")
+        self.assertEqual(user_client.get("/sso/api/user/myself/").json()["code"], 401)
+
+    # 批量修改角色所属应用时同时更新新旧应用的权限索引
+    def test_move_roles(self):
+        menu = Menu.objects.create(name="menu1", description="d", url="/", app=self.apps[0])
+        resource = Resource.objects.create(name="readA", description="d", app=self.apps[0], menu=menu)
+        role = Role.objects.create(name="role1", description="d", app=self.apps[0])
+        resource.role.add(role)
+        for app in self.apps:
+            get_permission_index(app.name)
+        self.assertIn(role.id, get_cached_permission_index("app1").role_bitmaps)
+        data = self.bulk("role", [{"id": role.id, "name": "role1", "description": "d", "app": self.apps[1].id}],
+                         method="put")
+        self.assertEqual(data["data"], {"updated": 1})
+        self.assertNotIn(role.id, get_cached_permission_index("app1").role_bitmaps)
+        self.assertIn(role.id, get_cached_permission_index("app2").role_bitmaps)
+
+
+class ClosureTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = App.objects.create(name="app1")
+        self.menus = []
+        parent = None
+        for name in ["menu1", "menu2", "menu3"]:
+            parent = Menu.objects.create(name=name, description="d", url="/", app=self.app, parent=parent)
+            self.menus.append(parent)
+
+    def get_ancestor_ids(self, menu):
+        return dict(MenuClosure.objects.filter(descendant=menu).values_list("ancestor_id", "depth"))
+
+    def test_move(self):
+        menu1, menu2, menu3 = self.menus
+        self.assertEqual(self.get_ancestor_ids(menu3), {menu1.id: 2, menu2.id: 1, menu3.id: 0})
+        menu4 = Menu.objects.create(name="menu4", description="d", url="/", app=self.app)
+        menu2.parent = menu4
+        menu2.save()
+        self.assertEqual(self.get_ancestor_ids(menu3), {menu4.id: 2, menu2.id: 1, menu3.id: 0})
+        menu2.parent = None
+        menu2.save()
+        self.assertEqual(self.get_ancestor_ids(menu3), {menu2.id: 1, menu3.id: 0})
+
+    # 不能移动到自身或其后代节点下，闭包表保持不变
+    def test_circular_parent(self):
+        menu1, menu2, menu3 = self.menus
+        for parent in [menu1, menu3]:
+            menu1.parent = parent
+            with self.assertRaises(exceptions.ParseError):
+                menu1.save()
+        with self.assertRaises(exceptions.ParseError):
+            move_node(Menu, menu1.id, menu3.id)
+        self.assertEqual(self.get_ancestor_ids(menu3), {menu1.id: 2, menu2.id: 1, menu3.id: 0})
+
+    # 闭包表为空的已有数据在migrate后自动补全
+    def test_backfill(self):
+        resource1 = Resource.objects.create(name="readA", description="d", app=self.app, menu=self.menus[0])
+        resource2 = Resource.objects.create(name="readB", description="d", app=self.app, menu=self.menus[0],
+                                            parent=resource1)
+        MenuClosure.objects.all().delete()
+        ResourceClosure.objects.all().delete()
+        emit_post_migrate_signal(0, False, "default")
+        self.assertEqual(self.get_ancestor_ids(self.menus[2]), {self.menus[0].id: 2, self.menus[1].id: 1,
+                                                                self.menus[2].id: 0})
+        self.assertEqual(set(ResourceClosure.objects.filter(descendant=resource2).values_list("ancestor_id",
+                                                                                             flat=True)),
+                         {resource1.id, resource2.id})
+
+
+class ManifestTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        app = App.objects.create(name="app1")
+        menu = Menu.objects.create(name="menu1", description="d", url="/", app=app)
+        self.resources = [Resource.objects.create(name=name, description="d", app=app, menu=menu)
+                          for name in ["readA", "readB"]]
+        self.role = Role.objects.create(name="role1", description="d", app=app)
+        self.resources[0].role.add(self.role)
+        self.user = User.objects.create(username="user1", cname="用户1", email="user1@test.com")
+        self.role.user.add(self.user)
+        self.client = Client(HTTP_ACCESS_TOKEN=self.user.token.key)
+
+    def get_manifest(self, version=None, **extra):
+        params = {"app_name": "app1"}
+        if version is not None:
+            params["version"] = version
+        return self.client.get("/sso/api/user/manifest/", params, **extra)
+
+    def test_not_modified(self):
+        response = self.get_manifest()
+        data = response.json()["data"]
+        self.assertEqual((data["full"], data["resources"]), (True, ["readA"]))
+        self.assertEqual(len(data["menus"]), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_manifest(data["version"]).status_code, 304)
+            self.assertEqual(self.get_manifest(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+    # 只返回增减的资源名称，菜单未变化时不返回菜单
+    def test_delta(self):
+        version = self.get_manifest().json()["data"]["version"]
+        self.resources[1].role.add(self.role)
+        data = self.get_manifest(version).json()["data"]
+        self.assertEqual(data, {"version": data["version"], "full": False, "added": ["readB"], "removed": []})
+        self.assertNotEqual(data["version"], version)
+        self.resources[0].role.remove(self.role)
+        self.resources[1].role.remove(self.role)
+        data = self.get_manifest(data["version"]).json()["data"]
+        self.assertEqual((data["added"], data["removed"], data["menus"]), ([], ["readA", "readB"], []))
+
+    # 客户端的版本已不在缓存中时返回完整清单
+    def test_unknown_version(self):
+        self.get_manifest()
+        data = self.get_manifest("0").json()["data"]
+        self.assertEqual((data["full"], data["resources"]), (True, ["readA"]))
+
+
+class RbacEventsTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        recent_events.clear()
+        self.app = App.objects.create(name="app1")
+        self.version = get_version(get_rbac_version_name(self.app.id))
+
+    def tearDown(self):
+        recent_events.clear()
+
+    def get_events(self, **params):
+        params.setdefault("app_name", "app1")
+        return self.client.get("/sso/api/rbac_events", params).json()["data"]
+
+    def test_reset(self):
+        self.assertEqual(self.get_events(), {"version": self.version, "reset": True, "events": []})
+        # 版本号之后的事件已不在进程缓冲区中
+        with mock.patch("core.views.events.RBAC_EVENT_DELIVERY_TIMEOUT", 0):
+            data = self.get_events(version=self.version - 1)
+        self.assertEqual((data["version"], data["reset"]), (self.version, True))
+
+    def test_events(self):
+        event = {"app_id": self.app.id, "version": self.version + 1, "user_ids": None, "role_ids": [1]}
+        receive_event(dict(event, app_id=self.app.id + 1))
+        receive_event(event)
+        self.assertEqual(self.get_events(version=self.version, timeout=5),
+                         {"version": self.version + 1, "reset": False, "events": [event]})
+
+    # 等待的请求数达到上限时不等待，直接返回当前版本号
+    def test_max_waiters(self):
+        start = time.time()
+        with mock.patch("core.views.events.poll_waiters", threading.BoundedSemaphore(1)) as waiters:
+            waiters.acquire()
+            data = self.get_events(version=self.version, timeout=5)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(data, {"version": self.version, "reset": False, "events": []})
+
+
+class BatchPermissionTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="user1", cname="用户1", email="user1@test.com")
+        for app_name in ["app1", "app2"]:
+            app = App.objects.create(name=app_name)
+            menu = Menu.objects.create(name="menu1", description="d", url="/", app=app)
+            role = Role.objects.create(name="role1", description="d", app=app)
+            role.user.add(self.user)
+            Resource.objects.create(name="readA", description="d", app=app, menu=menu).role.add(role)
+            Resource.objects.create(name="readB", description="d", app=app, menu=menu)
+        self.user_client = Client(HTTP_ACCESS_TOKEN=self.user.token.key)
+
+    def test_post(self):
+        permissions = {"app1": ["readA", "readB", "readC"], "app2": ["readA"], "app3": ["readA"]}
+        data = self.user_client.post("/sso/api/user/has_permissions/", {"permissions": permissions},
+                                     content_type="application/json").json()["data"]
+        self.assertEqual(data["permissions"], {"app1": {"readA": True, "readB": False}, "app2": {"readA": True},
+                                               "app3": {}})
+        self.assertEqual(set(data["errors"]), {"app1", "app3"})
+        self.assertEqual(list(data["errors"]["app1"]), ["readC"])
+
+    def test_get(self):
+        data = self.user_client.get("/sso/api/user/has_permissions/",
+                                    {"app_name": "app2", "permission_name": ["readA", "readB"]}).json()["data"]
+        self.assertEqual(data, {"permissions": {"app2": {"readA": True, "readB": False}}, "errors": {}})
+
+    def test_invalid_payload(self):
+        response = self.user_client.post("/sso/api/user/has_permissions/", {"permissions": {"app1": "readA"}},
+                                         content_type="application/json")
+        self.assertEqual(response.json()["code"], 400)
+
+
+class ExportPermissionTestCase(BaseTestCase):
+    # 普通用户按readExport、readRbac等资源校验权限
+    def test_user_permission(self):
+        app = App.objects.create(name=utils.APP_NAME)
+        menu = Menu.objects.create(name="menu1", description="d", url="/", app=app)
+        resources = dict((name, Resource.objects.create(name=name, description="d", app=app, menu=menu))
+                         for name in ["readExport", "readRbac"])
+        user = User.objects.create(username="user1", cname="用户1", email="user1@test.com")
+        role = Role.objects.create(name="role1", description="d", app=app)
+        role.user.add(user)
+        resources["readExport"].role.add(role)
+        client = Client(HTTP_ACCESS_TOKEN=user.token.key)
+        response = client.get("/sso/api/export/user")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("attachment", response["Content-Disposition"])
+        self.assertEqual(client.get("/sso/api/rbac/{}".format(app.name)).json()["code"], 403)
+
+
+class PermissionIndexTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.apps = [App.objects.create(name=name) for name in ["app1", "app2"]]
+        self.menus = [Menu.objects.create(name="menu1", description="d", url="/", app=app) for app in self.apps]
+        self.resource = Resource.objects.create(name="resource1", description="d", app=self.apps[0],
+                                                menu=self.menus[0])
+        for app in self.apps:
+            get_permission_index(app.name)
+
+    def get_resource_names(self, app):
+        return set(get_cached_permission_index(app.name).name_ordinals)
+
+    def test_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.resource.name = "resource2"
+                self.resource.save()
+                raise RuntimeError
+        self.assertEqual(self.get_resource_names(self.apps[0]), {"resource1"})
+
+    def test_move_to_other_app(self):
+        self.resource.app = self.apps[1]
+        self.resource.menu = self.menus[1]
+        self.resource.save()
+        self.assertEqual(self.get_resource_names(self.apps[0]), set())
+        self.assertEqual(self.get_resource_names(self.apps[1]), {"resource1"})
+
+    def get_permissions(self, user, resource_names):
+        index_results = get_user_permissions(user, "app1", resource_names)
+        # 索引与SQL两种方式的结果一致
+        self.assertEqual(index_results, check_permissions_by_sql(user, self.apps[0].id, resource_names))
+        return index_results
+
+    # 关联到父资源的角色同时拥有其任意层级的可用子资源
+    def test_inherit_from_ancestors(self):
+        child = Resource.objects.create(name="resource2", description="d", app=self.apps[0], menu=self.menus[0],
+                                        parent=self.resource)
+        grandchild = Resource.objects.create(name="resource3", description="d", app=self.apps[0],
+                                             menu=self.menus[0], parent=child)
+        other = Resource.objects.create(name="resource4", description="d", app=self.apps[0], menu=self.menus[0])
+        role = Role.objects.create(name="role1", description="d", app=self.apps[0])
+        user = User.objects.create(username="user1", cname="用户1", email="user1@test.com")
+        role.user.add(user)
+        self.resource.role.add(role)
+        names = ["resource1", "resource2", "resource3", "resource4"]
+        self.assertEqual(self.get_permissions(user, names),
+                         {"resource1": True, "resource2": True, "resource3": True, "resource4": False})
+        child.available = False
+        child.save()
+        self.assertEqual(self.get_permissions(user, names),
+                         {"resource1": True, "resource2": False, "resource3": True, "resource4": False})
+        # 移出父资源后不再继承
+        grandchild.parent = other
+        grandchild.save()
+        self.assertEqual(self.get_permissions(user, names),
+                         {"resource1": True, "resource2": False, "resource3": False, "resource4": False})
+
+    # 角色移动到其它应用后从旧应用的索引中移除
+    def test_move_role_to_other_app(self):
+        role = Role.objects.create(name="role1", description="d", app=self.apps[0])
+        self.resource.role.add(role)
+        self.assertIn(role.id, get_cached_permission_index("app1").role_bitmaps)
+        role.app = self.apps[1]
+        role.save()
+        self.assertNotIn(role.id, get_cached_permission_index("app1").role_bitmaps)
+        self.assertEqual(get_cached_permission_index("app2").role_bitmaps.get(role.id), 0)
+
+
+class TmpTokenTestCase(BaseTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="user1", cname="用户1", email="user1@test.com",
+                                        last_login=datetime(2020, 1, 2, 3, 4, 5))
+
+    def get_myself(self, token_str):
+        return Client(HTTP_TMP_TOKEN=token_str).get("/sso/api/user/myself/").json()
+
+    def assert_myself_without_query(self, token_str):
+        expected = {"id": self.user.id, "username": "user1", "cname": "用户1", "email": "user1@test.com",
+                    "is_active": True, "last_login": "2020-01-02T03:04:05"}
+        with self.assertNumQueries(0):
+            data = self.get_myself(token_str)
+        self.assertEqual(data["code"], 200)
+        self.assertEqual(data["data"], expected)
+
+    def test_opaque_token(self):
+        self.assert_myself_without_query(generate_temp_token(self.user, token_format="opaque"))
+
+    def test_signed_token(self):
+        with mock.patch.dict(utils.TMP_TOKEN_SIGNING_KEYS, {"k1": "secret"}), \
+                mock.patch.object(utils, "TMP_TOKEN_SIGNING_KEY_ID", "k1"):
+            self.assert_myself_without_query(generate_temp_token(self.user, token_format="signed"))
+
+    # 兑换票据后票据从用户token索引中移除，只保留兑换出的临时token
+    def test_redeem_ticket(self):
+        ticket = generate_temp_token(self.user, token_type="ticket")
+        # 票据为不含用户信息的随机串
+        self.assertRegex(ticket, r"^[0-9a-f]{32}$")
+        data = Client().get("/sso/api/get_token_by_ticket", {"ticket": ticket}).json()
+        self.assertEqual(data["data"]["user"], {"username": "user1", "cname": "用户1", "email": "user1@test.com"})
+        index_key = get_user_token_index_key(self.user.id)
+        self.assertEqual(get_redis_connection("default").smembers(index_key),
+                         {cache.client.make_key(get_tmp_token_key(data["data"]["token"])).encode()})
+        self.assertEqual(Client().get("/sso/api/get_token_by_ticket", {"ticket": ticket}).json()["code"], 401)
+        self.assert_myself_without_query(data["data"]["token"])
+
+    # 注销时删除临时token并从用户token索引中移除
+    def test_logout(self):
+        token_str = generate_temp_token(self.user, token_format="opaque")
+        index_key = get_user_token_index_key(self.user.id)
+        self.assertEqual(len(get_redis_connection("default").smembers(index_key)), 1)
+        Client(HTTP_TMP_TOKEN=token_str).get("/sso/api/logout")
+        self.assertEqual(get_redis_connection("default").smembers(index_key), set())
+        self.assertEqual(self.get_myself(token_str)["code"], 401)
+
+    # 事务回滚时不吊销临时token
+    def test_revoke_after_commit(self):
+        token_str = generate_temp_token(self.user, token_format="opaque")
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.user.is_active = False
+                self.user.save()
+                raise RuntimeError
+        self.assertEqual(self.get_myself(token_str)["code"], 200)
+        self.user.refresh_from_db()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get_myself(token_str)["code"], 401)
+
+    # 用户信息变化后临时token中的快照随之刷新
+    def test_snapshot_refreshed(self):
+        token_str = generate_temp_token(self.user, token_format="opaque")
+        self.user.cname = "用户2"
+        self.user.save()
+        self.assertEqual(self.get_myself(token_str)["data"]["cname"], "用户2")
+
+
+def new_ldap_connection(*args, **kwargs):
+    conn = mock.MagicMock(closed=False, bound=True, response=[{"dn": "uid=user1"}])
+    conn.bind.return_value = True
+    conn.rebind.return_value = True
+    conn.search.return_value = True
+    return conn
+
+
+@mock.patch("core.libs.auth.Server", mock.MagicMock())
+@mock.patch("core.libs.auth.Connection")
+class LDAPConnectionPoolTestCase(SimpleTestCase):
+    def get_pool(self, connection):
+        self.connections = []
+
+        def new_connection(*args, **kwargs):
+            self.connections.append(new_ldap_connection())
+            return self.connections[-1]
+        connection.side_effect = new_connection
+        pool = LDAPConnectionPool("ldap.test", 389, "cn=admin", "secret")
+        pool.server.info.to_json.return_value = '{"raw": {"objectClass": ["OpenLDAProotDSE"]}}'
+        return pool
+
+    # 服务器类型只检测一次，search连接被复用
+    def test_reuse_search_connection(self, connection):
+        pool = self.get_pool(connection)
+        for _ in range(3):
+            self.assertEqual(pool.search("dc=test", "(uid=user1)", ["cn"]), [{"dn": "uid=user1"}])
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(connection.call_args, mock.call(pool.server, user="cn=admin", password="secret",
+                                                         receive_timeout=LDAP_RECEIVE_TIMEOUT))
+
+    # 复用的连接已被服务端关闭时丢弃，使用新连接重试一次
+    def test_retry_with_new_connection(self, connection):
+        pool = self.get_pool(connection)
+        pool.search("dc=test", "(uid=user1)", ["cn"])
+        stale = self.connections[-1]
+        stale.search.side_effect = LDAPCommunicationError("connection closed")
+        self.assertEqual(pool.search("dc=test", "(uid=user1)", ["cn"]), [{"dn": "uid=user1"}])
+        stale.unbind.assert_called_once_with()
+        self.assertEqual(len(self.connections), 3)
+        # 新连接同样无法通信时报告LDAP不可用
+        self.connections[-1].search.side_effect = LDAPCommunicationError("connection closed")
+        connection.side_effect = lambda *args, **kwargs: stale
+        with self.assertRaises(LDAPUnavailable):
+            pool.search("dc=test", "(uid=user1)", ["cn"])
+
+    # bind连接通过rebind复用，密码错误时连接仍放回连接池
+    def test_reuse_bind_connection(self, connection):
+        pool = self.get_pool(connection)
+        conn = pool.bind("uid=user1", "password")
+        pool.release_bind_connection(conn)
+        conn.rebind.return_value = False
+        self.assertIsNone(pool.bind("uid=user1", "wrong"))
+        conn.rebind.return_value = True
+        self.assertIs(pool.bind("uid=user1", "password"), conn)
+        self.assertEqual(len(self.connections), 1)
+
+
+@mock.patch("core.libs.backends.LDAPAuth")
+class LDAPFallbackTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        verified_password_cache.clear()
+        self.backend = LDAPAuthBackend()
+
+    def login_by_ldap(self, ldap_auth):
+        ldap_auth.return_value.auth.return_value = {"username": "user1", "displayName": "用户1",
+                                                    "mail": "user1@test.com"}
+        return self.backend.authenticate(None, "user1", "password")
+
+    # LDAP登录成功后保存密码哈希，LDAP不可用时使用本地密码哈希校验
+    @mock.patch("core.libs.backends.LDAP_FALLBACK_ENABLED", True)
+    def test_fallback(self, ldap_auth):
+        user = self.login_by_ldap(ldap_auth)
+        self.assertIsNotNone(User.objects.get(id=user.id).password_verified_time)
+        ldap_auth.return_value.auth.side_effect = LDAPUnavailable("ldap server is down")
+        self.assertEqual(self.backend.authenticate(None, "user1", "password"), user)
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.backend.authenticate(None, "user1", "wrong")
+
+    # 本地密码哈希超过LDAP_FALLBACK_MAX_AGE未经LDAP校验时不再使用
+    @mock.patch("core.libs.backends.LDAP_FALLBACK_ENABLED", True)
+    def test_expired(self, ldap_auth):
+        user = self.login_by_ldap(ldap_auth)
+        User.objects.filter(id=user.id).update(
+            password_verified_time=timezone.now() - timedelta(seconds=LDAP_FALLBACK_MAX_AGE + 1))
+        ldap_auth.return_value.auth.side_effect = LDAPUnavailable("ldap server is down")
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.backend.authenticate(None, "user1", "password")
+
+    @mock.patch("core.libs.backends.LDAP_FALLBACK_ENABLED", False)
+    def test_disabled(self, ldap_auth):
+        self.login_by_ldap(ldap_auth)
+        ldap_auth.return_value.auth.side_effect = LDAPUnavailable("ldap server is down")
+        with self.assertRaises(LDAPUnavailable):
+            self.backend.authenticate(None, "user1", "password")
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    @mock.patch("core.libs.auth.time.monotonic")
+    def test_open_and_reset(self, monotonic):
+        monotonic.return_value = 100
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        # 超过reset_timeout后只放行一个试探请求
+        monotonic.return_value = 130
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        # 试探失败时重新熔断，成功时关闭
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        monotonic.return_value = 160
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+
+class LDAPExecutorTestCase(SimpleTestCase):
+    def raise_unavailable(self):
+        raise LDAPUnavailable("ldap server is down")
+
+    def test_circuit_open(self):
+        executor = LDAPExecutor("ldap.test")
+        for _ in range(executor.breaker.failure_threshold):
+            with self.assertRaises(LDAPUnavailable):
+                executor.run(self.raise_unavailable)
+        with self.assertRaises(LDAPCircuitOpen):
+            executor.run(lambda: True)
+
+    # 用户密码错误等业务异常不计入熔断
+    def test_other_errors(self):
+        executor = LDAPExecutor("ldap.test")
+        for _ in range(executor.breaker.failure_threshold):
+            with self.assertRaises(ValueError):
+                executor.run(int, "x")
+        self.assertEqual(executor.run(int, "1"), 1)
+
+    def test_timeout(self):
+        executor = LDAPExecutor("ldap.test")
+        event = threading.Event()
+        with self.assertRaises(LDAPUnavailable):
+            executor.run(event.wait, timeout=0.01)
+        self.assertEqual(executor.breaker.failures, 1)
+        event.set()
+
+    # 超时的操作执行完毕前仍占用名额，名额用尽时直接拒绝
+    @mock.patch("core.libs.auth.LDAP_SLOT_TIMEOUT", 0.01)
+    def test_busy(self):
+        executor = LDAPExecutor("ldap.test", max_workers=1)
+        event = threading.Event()
+        with self.assertRaises(LDAPUnavailable):
+            executor.run(event.wait, timeout=0.01)
+        with self.assertRaises(LDAPBusy):
+            executor.run(lambda: True)
+        event.set()
+        for _ in range(100):
+            if executor.to_dict()["running"] == 0:
+                break
+            time.sleep(0.01)
+        self.assertTrue(executor.run(lambda: True))
+
+
+@override_settings(LDAP_HOST="ldap.test", LDAP_PORT=389, LDAP_SEARCH_BASE="dc=test", LDAP_SYNC_EXCLUDE_USERNAMES=["svc1"])
+@mock.patch("core.management.commands.sync_ldap.LDAPAuth")
+class SyncLDAPTestCase(BaseTestCase):
+    def set_directory(self, ldap_auth, users):
+        def search_users(user_filter=None, since=None, page_size=500):
+            for username, (cname, email, modified) in users.items():
+                if since is None or modified >= since:
+                    yield {"username": username, "displayName": cname, "mail": email}, modified
+        ldap_auth.return_value.search_users.side_effect = search_users
+
+    def sync(self, **options):
+        stdout, stderr = StringIO(), StringIO()
+        call_command("sync_ldap", stdout=stdout, stderr=stderr, **options)
+        return stderr.getvalue()
+
+    def get_users(self):
+        return dict((username, (email, is_active)) for username, email, is_active in
+                    User.objects.exclude(id=self.super_user.id).values_list("username", "email", "is_active"))
+
+    def test_upsert(self, ldap_auth):
+        User.objects.create(username="user2", cname="u", email="user2@test.com", is_active=False)
+        User.objects.create(username="svc1", cname="s", email="taken@test.com")
+        self.set_directory(ldap_auth, {
+            "user1": ("用户1", "user1@test.com", "20200101000000Z"),
+            # 已禁用的用户重新出现时启用
+            "user2": ("用户2", "user2@test.com", "20200101000000Z"),
+            "user3": ("用户3", "taken@test.com", "20200101000000Z"),
+            "bad user": ("x", "bad@test.com", "20200101000000Z"),
+        })
+        stderr = self.sync(batch_size=2)
+        self.assertIn("skip ldap user user3", stderr)
+        self.assertIn("skip ldap user bad user", stderr)
+        self.assertEqual(self.get_users(), {"user1": ("user1@test.com", True), "user2": ("user2@test.com", True),
+                                            "svc1": ("taken@test.com", True)})
+        self.assertTrue(Token.objects.filter(user__username="user1").exists())
+        # 增量同步只处理上次同步位置之后变化的用户，修改后的邮箱与其他用户冲突时跳过
+        self.set_directory(ldap_auth, {
+            "user1": ("用户1", "taken@test.com", "20200102000000Z"),
+            "user2": ("用户2", "user2-new@test.com", "20200102000000Z"),
+        })
+        self.assertIn("skip ldap user user1", self.sync())
+        self.assertEqual(ldap_auth.return_value.search_users.call_args[0][1], "20200101000000Z")
+        self.assertEqual(self.get_users()["user1"], ("user1@test.com", True))
+        self.assertEqual(self.get_users()["user2"], ("user2-new@test.com", True))
+
+    # LDAP中已不存在的用户被禁用，超级管理员及排除的账号除外
+    def test_deactivate(self, ldap_auth):
+        for username in ["user1", "user2", "svc1", "svc2"]:
+            User.objects.create(username=username, cname=username, email="{}@test.com".format(username))
+        self.set_directory(ldap_auth, {"user1": ("user1", "user1@test.com", "20200101000000Z")})
+        self.sync(deactivate=True, exclude=["svc2"])
+        self.assertEqual(dict((username, is_active) for username, (_, is_active) in self.get_users().items()),
+                         {"user1": True, "user2": False, "svc1": True, "svc2": True})
+        self.assertTrue(User.objects.get(id=self.super_user.id).is_active)
@@ -2,7 +2,8 @@
 from django.conf.urls import url
 from django.urls import include
 from rest_framework import routers
-from core.views import auth
+from core.views import auth, events
+from core.views.export import ExportView, RbacView
 from core.views.basic import MenuViewSet, RoleViewSet, AppViewSet, ResourceViewSet, UserViewSet, GroupViewSet
 
 router = routers.DefaultRouter()
@@ -17,5 +18,10 @@ urlpatterns = [
     url(r'login$', auth.login),
     url(r'logout$', auth.logout),
     url(r'get_token_by_ticket$', auth.get_token_by_ticket),
+    url(r'ldap_status$', auth.ldap_status),
+    url(r'revoked_tokens$', auth.revoked_tokens),
+    url(r'rbac_events$', events.rbac_events),
+    url(r'export/(?P<name>\w+)$', ExportView.as_view()),
+    url(r'rbac/(?P<app_name>\w+)$', RbacView.as_view()),
     url(r'', include(router.urls)),
 ]
@@ -1,24 +1,28 @@
 # coding: utf8
 
-import uuid
 from django.contrib import auth
-from django.core.cache import cache
-from rest_framework.decorators import api_view
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import IsAuthenticated
 from core.libs import utils
+from core.libs.auth import get_ldap_status
+from core.libs.authentication import SessionAuthentication, TokenAuthentication, TmpTokenAuthentication
 from core.libs.response import ApiResponse, UnauthorizedResponse, BadRequestResponse
-from core.models import User
+from core.libs.tokens import generate_temp_token, redeem_ticket, ticket_profile_fields, revoke_temp_token, \
+    get_revocation_list
 
 
 def return_user_or_ticket(request, user):
     redirect_url = request.GET.get('redirect')
     if redirect_url:
-        ticket = generate_temp_token(user.id, token_type="ticket")
+        ticket = generate_temp_token(user, token_type="ticket")
         params_connect_flag = '&' if '?' in redirect_url else '?'
         redirect_url = "{}{}ticket={}".format(redirect_url, params_connect_flag, ticket)
         data = {"type": "redirect", "redirect": redirect_url}
     else:
         auth.login(request, user)
-        tmp_token = generate_temp_token(user.id)
+        tmp_token = generate_temp_token(user)
         data = {"type": "login", "token": tmp_token}
     return ApiResponse(data=data)
 
@@ -52,37 +56,46 @@ def logout(request):
     try:
         if request.user.is_authenticated:
             auth.logout(request)
+        # 注销时吊销请求携带的临时token，签名token加入吊销列表
+        tmp_token = utils.get_token(request, utils.TMP_TOKEN_HEADER_STRING)
+        if tmp_token:
+            revoke_temp_token(tmp_token)
     except Exception as e:
         print(e.__str__())
     return ApiResponse(msg='logout success')
 
 
-def generate_temp_token(user_id, token_type="token"):
-    token_str = uuid.uuid4().hex
-    cache_prefix = utils.TMP_TOKEN_PREFIX
-    expire = utils.TMP_TOKEN_TIMEOUT
-    if token_type == 'ticket':
-        cache_prefix = utils.TMP_TICKET_PREFIX
-        expire = utils.TMP_TICKET_TIMEOUT
-    cache.set("{}:{}".format(cache_prefix, token_str), user_id, expire)
-    return token_str
-
-
 @api_view(["GET"])
 def get_token_by_ticket(request):
     ticket = request.GET.get("ticket")
     if not ticket:
         return UnauthorizedResponse("parameter ticket is required.")
-    ticket_key = "{}:{}".format(utils.TMP_TICKET_PREFIX, ticket)
-    user_id = cache.get(ticket_key)
-    cache.delete(ticket_key)
-    if not user_id:
+    # 票据只能兑换一次，兑换与生成临时token在redis中原子完成，不查询数据库
+    result = redeem_ticket(ticket)
+    if result is None:
         return UnauthorizedResponse("invalid ticket or ticket already expired.")
-    tmp_token = generate_temp_token(user_id)
-    user = User.objects.get(id=user_id)
-    user_info = {
-        "username": user.username,
-        "cname": user.cname,
-        "email": user.email
-    }
+    tmp_token, ticket_value = result
+    user_info = dict((field, ticket_value[field]) for field in ticket_profile_fields)
     return ApiResponse(data={"token": tmp_token, "user": user_info})
+
+
+# LDAP工作线程及熔断器状态
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication, TokenAuthentication, TmpTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def ldap_status(request):
+    return ApiResponse(data=get_ldap_status())
+
+
+# 签名临时token的吊销列表，供接入的应用定期同步后在进程内校验token，版本未变化时返回304
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication, TokenAuthentication, TmpTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def revoked_tokens(request):
+    revocations = get_revocation_list()
+    etag = quote_etag(str(revocations["version"]))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = ApiResponse(data=revocations)
+        response["ETag"] = etag
+    return response
@@ -1,4 +1,8 @@
 # coding: utf8
+from django.db import transaction
+from django.http import HttpResponseNotModified
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import exceptions
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
@@ -6,10 +10,15 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 from core.libs.authentication import TokenAuthentication, TmpTokenAuthentication, SessionAuthentication
-from core.libs.permissions import CheckUserPermission, check_user_has_permission
+from core.libs.permissions import CheckUserPermission, check_user_has_permission, check_user_has_permissions
 from core.libs.response import BadRequestResponse, ApiResponse, ForbiddenResponse
-from core.libs import utils
+from core.libs import utils, bulk
+from core.libs.caches import get_model_version_name, get_app_id
+from core.libs.decorator import cache_response, get_version_etag
 from core.libs.exception import api_exception_handler
+from core.libs.manifest import get_manifest_data, get_rbac_version
+from core.libs.menus import get_user_menu
+from core.libs.pagination import IdCursorPagination
 from core.models import Menu, App, Role, Resource, Group, User
 from core.serializer import MenuSerializer, AppSerializer, RoleSerializer, ResourceSerializer, GroupSerializer, \
     UserSerializer
@@ -25,35 +34,80 @@ def format_response(response):
     return response
 
 
+# 一次查询校验id是否全部存在，返回id集合
 def check_pk_is_exist(model, pk_list):
     model_name = model.__name__.lower()
-    if isinstance(pk_list, list):
-        for pk in pk_list:
-            try:
-                model.objects.get(id=pk)
-            except model.DoesNotExist:
-                raise exceptions.ParseError("{} id {} does not exist".format(model_name, pk))
-            except Exception as e:
-                raise exceptions.ParseError("invalid {} id {}".format(model_name, pk))
-    else:
+    if not isinstance(pk_list, list):
         raise exceptions.ParseError("parameter {} is null or not a list".format(model_name))
+    pk_set = set()
+    for pk in pk_list:
+        try:
+            pk_set.add(int(pk))
+        except (TypeError, ValueError):
+            raise exceptions.ParseError("invalid {} id {}".format(model_name, pk))
+    not_exist_pks = pk_set - set(model.objects.filter(id__in=pk_set).values_list("id", flat=True))
+    if not_exist_pks:
+        raise exceptions.ParseError("{} id {} does not exist".format(
+            model_name, ", ".join(str(pk) for pk in sorted(not_exist_pks))))
+    return pk_set
+
+
+# 增量修改多对多关系，参数为{"add": [id, ...], "remove": [id, ...]}，只写入实际变化的关联，返回新增及删除的数量
+def patch_many_to_many(request, related_obj, related_model):
+    add_list = request.data.get("add") or []
+    remove_list = request.data.get("remove") or []
+    if not (isinstance(add_list, list) and isinstance(remove_list, list)):
+        raise exceptions.ParseError("parameter add and remove must be a list")
+    check_pk_is_exist(related_model, add_list + remove_list)
+    add_ids = set(int(pk) for pk in add_list)
+    remove_ids = set(int(pk) for pk in remove_list)
+    if add_ids & remove_ids:
+        raise exceptions.ParseError("id {} in both add and remove".format(
+            ", ".join(str(pk) for pk in sorted(add_ids & remove_ids))))
+    exist_ids = set(related_obj.filter(id__in=add_ids | remove_ids).values_list("id", flat=True))
+    add_ids -= exist_ids
+    remove_ids &= exist_ids
+    # 通过关联管理器批量写入，保证触发m2m_changed信号以清除缓存
+    with transaction.atomic():
+        if add_ids:
+            related_obj.add(*add_ids)
+        if remove_ids:
+            related_obj.remove(*remove_ids)
+    return ApiResponse(msg="process success", data={"added": len(add_ids), "removed": len(remove_ids)})
 
 
 def extend_many_to_many_url(request, obj, related_obj, serializer_class):
     related_mode = serializer_class.Meta.model
+    if request.method == "PATCH":
+        return patch_many_to_many(request, related_obj, related_mode)
     serializer = serializer_class(related_obj.all(), many=True)
     if request.method == "GET":
         return ApiResponse(data=serializer.data)
     elif request.method in ["POST", "PUT"]:
-        pk_list = request.data.get("id")
-        check_pk_is_exist(related_mode, pk_list)
-        related_obj.set(pk_list)
+        related_obj.set(check_pk_is_exist(related_mode, request.data.get("id")))
     else:
         related_obj.clear()
     obj.save()
     return ApiResponse(msg="process success", data=serializer.data)
 
 
+# 解析批量权限检测参数，返回{app_name: [permission_name, ...]}
+def get_permission_name_map(request):
+    if request.method == "GET":
+        app_name = utils.get_param_or_exception(request, "app_name")
+        return {app_name: request.GET.getlist("permission_name")}
+    permissions = request.data.get("permissions")
+    if permissions is None:
+        app_name = utils.get_param_or_exception(request, "app_name")
+        permissions = {app_name: request.data.get("permission_name")}
+    if not isinstance(permissions, dict):
+        raise exceptions.ParseError("parameter permissions is not a dict")
+    for app_name, permission_names in permissions.items():
+        if not isinstance(permission_names, list):
+            raise exceptions.ParseError("permission names of app {} is null or not a list".format(app_name))
+    return permissions
+
+
 def get_end_url_path(url_path):
     path_list = url_path.split('/')
     return path_list[-2] if url_path.endswith('/') else path_list[-1]
@@ -78,6 +132,7 @@ class PermissionView(AuthenticationView):
 
 
 class BaseView(PermissionView, ModelViewSet):
+    pagination_class = IdCursorPagination
     uk_name_list = ['name']
     model = None
     error_msg = None
@@ -103,11 +158,23 @@ class BaseView(PermissionView, ModelViewSet):
                 pass
         return False
 
+    def get_etag(self, request):
+        return get_version_etag(request, [get_model_version_name(self.queryset.model)])
+
+    # 客户端的ETag与当前版本一致时直接返回304，不查询数据库
     def list(self, request, *args, **kwargs):
-        return format_response(super().list(request, *args, **kwargs))
+        etag = self.get_etag(request)
+        response = get_conditional_response(request, etag=etag) or format_response(
+            super().list(request, *args, **kwargs))
+        response["ETag"] = etag
+        return response
 
     def retrieve(self, request, *args, **kwargs):
-        return format_response(super().retrieve(request, *args, **kwargs))
+        etag = self.get_etag(request)
+        response = get_conditional_response(request, etag=etag) or format_response(
+            super().retrieve(request, *args, **kwargs))
+        response["ETag"] = etag
+        return response
 
     def create(self, request, *args, **kwargs):
         self.check_uk_is_exist(request, "create")
@@ -132,7 +199,8 @@ class ExtendUserView:
     def get_user_related_obj(self):
         raise NotImplementedError("you must override this function")
 
-    @action(detail=True, methods=["GET", "POST", "PUT", "DELETE"])
+    @action(detail=True, methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+    @cache_response(related_models=[User])
     def user(self, request, pk=None):
         return extend_many_to_many_url(request, self.get_object(), self.get_user_related_obj(), UserSerializer)
 
@@ -141,7 +209,8 @@ class ExtendGroupView:
     def get_group_related_obj(self):
         raise NotImplementedError("you must override this function")
 
-    @action(detail=True, methods=["GET", "POST", "PUT", "DELETE"])
+    @action(detail=True, methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+    @cache_response(related_models=[Group])
     def group(self, request, pk=None):
         return extend_many_to_many_url(request, self.get_object(), self.get_group_related_obj(), GroupSerializer)
 
@@ -150,15 +219,17 @@ class ExtendRoleView:
     def get_role_related_obj(self):
         raise NotImplementedError("you must override this function")
 
-    @action(detail=True, methods=["GET", "POST", "PUT", "DELETE"])
+    @action(detail=True, methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+    @cache_response(related_models=[Role])
     def role(self, request, pk=None):
         return extend_many_to_many_url(request, self.get_object(), self.get_role_related_obj(), RoleSerializer)
 
 
 class ExtendSortedFormatView:
     @action(detail=False, methods=["GET"])
+    @cache_response()
     def format(self, request):
-        obj_list = utils.sort_obj(self.queryset, self.serializer_class)
+        obj_list = utils.get_tree_by_queryset(self.queryset, self.serializer_class)
         return ApiResponse(data=obj_list)
 
 
@@ -167,11 +238,22 @@ class ExtendGetObjectByAppView:
         return self.serializer_class(self.queryset.filter(app=app), many=True).data
 
     @action(detail=False, methods=["GET"])
+    @cache_response(related_models=[App], app_param="id")
     def get_obj_by_app(self, request):
         app = utils.get_obj_by_request_param(request, App, param_id="id")
         return ApiResponse(data=self.get_object_list(app))
 
 
+class ExtendBulkView:
+    # 批量新增（POST）或修改（PUT），参数为{"items": [...]}，任一条数据校验失败时全部不写入，并返回每条数据的错误信息
+    @action(detail=False, methods=["POST", "PUT"])
+    def bulk(self, request):
+        items = request.data.get("items")
+        if request.method == "POST":
+            return ApiResponse(data={"ids": bulk.bulk_create(self.serializer_class, items, self.uk_name_list)})
+        return ApiResponse(data={"updated": bulk.bulk_update(self.serializer_class, items, self.uk_name_list)})
+
+
 class AppViewSet(BaseView):
     queryset = App.objects.all()
     serializer_class = AppSerializer
@@ -189,7 +271,7 @@ class AppViewSet(BaseView):
         return BadRequestResponse(msg="删除失败，存在与之关联的{}".format(model_name))
 
 
-class RoleViewSet(BaseView, ExtendUserView, ExtendGroupView, ExtendGetObjectByAppView):
+class RoleViewSet(BaseView, ExtendUserView, ExtendGroupView, ExtendGetObjectByAppView, ExtendBulkView):
     model = None
     queryset = Role.objects.all()
     serializer_class = RoleSerializer
@@ -200,7 +282,8 @@ class RoleViewSet(BaseView, ExtendUserView, ExtendGroupView, ExtendGetObjectByAp
     def get_group_related_obj(self):
         return self.get_object().group
 
-    @action(detail=True, methods=["GET", "POST", "PUT", "DELETE"])
+    @action(detail=True, methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+    @cache_response(related_models=[Resource])
     def resource(self, request, pk=None):
         role = self.get_object()
         if request.method == "GET":
@@ -208,7 +291,7 @@ class RoleViewSet(BaseView, ExtendUserView, ExtendGroupView, ExtendGetObjectByAp
         return extend_many_to_many_url(request, role, role.resource_set, ResourceSerializer)
 
 
-class MenuViewSet(BaseView, ExtendSortedFormatView, ExtendGetObjectByAppView):
+class MenuViewSet(BaseView, ExtendSortedFormatView, ExtendGetObjectByAppView, ExtendBulkView):
     queryset = Menu.objects.all()
     serializer_class = MenuSerializer
     authenticate_permission_path = ['my_menu']
@@ -226,14 +309,14 @@ class MenuViewSet(BaseView, ExtendSortedFormatView, ExtendGetObjectByAppView):
     @action(detail=False, methods=["GET"])
     def my_menu(self, request):
         app = utils.get_obj_by_request_param(request, App, param_name="app_name")
-        menus = utils.get_menu_by_user_and_app(request.user, app)
+        menus = get_user_menu(request.user, app)
         return ApiResponse(data=menus)
 
     def get_object_list(self, app):
-        return utils.sort_obj(self.queryset.filter(app=app), self.serializer_class)
+        return utils.get_tree_by_queryset(self.queryset.filter(app=app), self.serializer_class)
 
 
-class ResourceViewSet(BaseView, ExtendSortedFormatView, ExtendGetObjectByAppView):
+class ResourceViewSet(BaseView, ExtendSortedFormatView, ExtendGetObjectByAppView, ExtendBulkView):
     queryset = Resource.objects.all()
     serializer_class = ResourceSerializer
 
@@ -246,10 +329,10 @@ class ResourceViewSet(BaseView, ExtendSortedFormatView, ExtendGetObjectByAppView
         return BadRequestResponse(msg="删除失败，存在与之关联的{}".format(model_name))
 
     def get_object_list(self, app):
-        return utils.sort_obj(self.queryset.filter(app=app), self.serializer_class)
+        return utils.get_tree_by_queryset(self.queryset.filter(app=app), self.serializer_class)
 
 
-class GroupViewSet(BaseView, ExtendUserView, ExtendRoleView):
+class GroupViewSet(BaseView, ExtendUserView, ExtendRoleView, ExtendBulkView):
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
 
@@ -260,11 +343,11 @@ class GroupViewSet(BaseView, ExtendUserView, ExtendRoleView):
         return self.get_object().role_set
 
 
-class UserViewSet(BaseView, ExtendGroupView, ExtendRoleView):
+class UserViewSet(BaseView, ExtendGroupView, ExtendRoleView, ExtendBulkView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     uk_name_list = ['username', 'email']
-    authenticate_permission_path = ['token', 'myself', 'has_permission', 'permission']
+    authenticate_permission_path = ['token', 'myself', 'has_permission', 'has_permissions', 'permission', 'manifest']
 
     @action(detail=False, methods=["GET", "POST", "PUT"])
     def token(self, request):
@@ -289,6 +372,17 @@ class UserViewSet(BaseView, ExtendGroupView, ExtendRoleView):
             return ApiResponse()
         return ForbiddenResponse()
 
+    # 批量检测权限，每个应用只解析一次用户的角色，无效的资源名称在errors中单独返回
+    @action(detail=False, methods=["GET", "POST"])
+    def has_permissions(self, request):
+        results = {}
+        errors = {}
+        for app_name, permission_names in get_permission_name_map(request).items():
+            results[app_name], app_errors = check_user_has_permissions(request.user, app_name, permission_names)
+            if app_errors:
+                errors[app_name] = app_errors
+        return ApiResponse(data={"permissions": results, "errors": errors})
+
     @action(detail=False, methods=["GET"])
     def permission(self, request):
         app = utils.get_obj_by_request_param(request, App, param_name="app_name")
@@ -297,6 +391,27 @@ class UserViewSet(BaseView, ExtendGroupView, ExtendRoleView):
             resource_name_list.append(resource.name)
         return ApiResponse(data=resource_name_list)
 
+    # 用户在应用下的资源名称及菜单树，附带应用的权限清单版本号。参数version为客户端上次获取的版本号，
+    # 版本号未变化时返回304，否则只返回增减的资源名称，菜单变化时附带新的菜单树
+    @action(detail=False, methods=["GET"])
+    def manifest(self, request):
+        app_name = utils.get_param_or_exception(request, "app_name")
+        app_id = get_app_id(app_name)
+        if app_id is None:
+            raise exceptions.ParseError("invalid app name {}".format(app_name))
+        # 后续只用到应用的id及名称，不查询数据库
+        app = App(id=app_id, name=app_name)
+        version = get_rbac_version(app)
+        client_version = request.GET.get("version")
+        etag = quote_etag("{}:{}".format(request.user.id, version))
+        if client_version == str(version):
+            response = HttpResponseNotModified()
+        else:
+            response = get_conditional_response(request, etag=etag) or ApiResponse(
+                data=get_manifest_data(request.user, app, version, client_version))
+        response["ETag"] = etag
+        return response
+
     def get_group_related_obj(self):
         return self.get_object().group_set
 
@@ -0,0 +1,53 @@
+# coding: utf8
+from rest_framework import exceptions
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import IsAuthenticated
+
+from core.libs import utils
+from core.libs.authentication import SessionAuthentication, TokenAuthentication, TmpTokenAuthentication
+from core.libs.caches import get_app_id, get_rbac_version_name, get_version
+from core.libs.events import wait_events, is_complete, poll_waiters, RBAC_EVENT_POLL_TIMEOUT, \
+    RBAC_EVENT_DELIVERY_TIMEOUT
+from core.libs.response import ApiResponse
+
+
+def get_poll_timeout(request):
+    try:
+        timeout = float(request.GET.get("timeout", RBAC_EVENT_POLL_TIMEOUT))
+    except ValueError:
+        raise exceptions.ParseError("parameter timeout is not a number")
+    return min(max(timeout, 0), RBAC_EVENT_POLL_TIMEOUT)
+
+
+# 长轮询应用的权限变化事件。version为客户端已知的权限清单版本号，有新事件时立即返回，否则最多等待timeout秒。
+# 客户端未提供版本号，或之后的事件已不在进程缓冲区中时返回reset，客户端应重新获取权限清单。
+# 等待的请求数超过RBAC_EVENT_MAX_WAITERS时不等待，直接返回
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication, TokenAuthentication, TmpTokenAuthentication])
+@permission_classes([IsAuthenticated])
+def rbac_events(request):
+    app_name = utils.get_param_or_exception(request, "app_name")
+    app_id = get_app_id(app_name)
+    if app_id is None:
+        raise exceptions.ParseError("invalid app name {}".format(app_name))
+    version = get_version(get_rbac_version_name(app_id))
+    try:
+        client_version = int(request.GET.get("version"))
+    except (TypeError, ValueError):
+        client_version = None
+    if client_version is None or client_version > version:
+        return ApiResponse(data={"version": version, "reset": True, "events": []})
+    if client_version < version:
+        events = wait_events(app_id, client_version, RBAC_EVENT_DELIVERY_TIMEOUT, until_version=version)
+        if not is_complete(events, client_version, version):
+            return ApiResponse(data={"version": version, "reset": True, "events": []})
+    else:
+        # 等待的请求数达到上限时立即返回当前版本号，由客户端稍后重新轮询，避免占满工作线程
+        if not poll_waiters.acquire(blocking=False):
+            return ApiResponse(data={"version": version, "reset": False, "events": []})
+        try:
+            events = wait_events(app_id, client_version, get_poll_timeout(request))
+        finally:
+            poll_waiters.release()
+    return ApiResponse(data={"version": events[-1]["version"] if events else version, "reset": False,
+                             "events": events})
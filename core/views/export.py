@@ -0,0 +1,38 @@
+# coding: utf8
+from django.http import StreamingHttpResponse
+
+from core.libs import utils
+from core.libs.export import EXPORT_CONTENT_TYPES, iter_export
+from core.libs.rbac import iter_app_document, import_app_document
+from core.libs.response import BadRequestResponse, ApiResponse
+from core.models import App
+from core.views.basic import PermissionView
+
+
+# 流式导出用户、用户组、角色及其关联关系，type参数为ndjson（默认）或csv
+class ExportView(PermissionView):
+    resource_name = "Export"
+
+    def get(self, request, name):
+        export_format = request.GET.get("type", "ndjson")
+        try:
+            rows = iter_export(name, export_format)
+        except ValueError as e:
+            return BadRequestResponse(msg=str(e))
+        response = StreamingHttpResponse(rows, content_type=EXPORT_CONTENT_TYPES[export_format])
+        response["Content-Disposition"] = 'attachment; filename="{}.{}"'.format(name, export_format)
+        return response
+
+
+# 导出（GET）或导入（POST）应用的菜单、资源、角色及角色与资源关联的配置文档
+class RbacView(PermissionView):
+    resource_name = "Rbac"
+
+    def get(self, request, app_name):
+        app = utils.get_obj_or_exception(App, uk_name=app_name)
+        response = StreamingHttpResponse(iter_app_document(app), content_type="application/json")
+        response["Content-Disposition"] = 'attachment; filename="{}.json"'.format(app_name)
+        return response
+
+    def post(self, request, app_name):
+        return ApiResponse(data=import_app_document(request.data, app_name))
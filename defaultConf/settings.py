@@ -35,7 +35,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.staticfiles',
     'rest_framework',
-    'core',
+    'core.apps.CoreConfig',
 ]
 
 MIDDLEWARE = [
@@ -173,6 +173,15 @@ LDAP_PORT = getattr(customConfigs, 'LDAP_PORT', 389)
 LDAP_SEARCH_BASE = getattr(customConfigs, 'LDAP_SEARCH_BASE', None)
 LDAP_ADMIN_DN = getattr(customConfigs, 'LDAP_ADMIN_DN', None)
 LDAP_ADMIN_PASSWORD = getattr(customConfigs, 'LDAP_ADMIN_PASSWORD', None)
+LDAP_CONNECT_TIMEOUT = getattr(customConfigs, 'LDAP_CONNECT_TIMEOUT', 3)
+LDAP_RECEIVE_TIMEOUT = getattr(customConfigs, 'LDAP_RECEIVE_TIMEOUT', 5)
+# LDAP服务不可用时使用本地保存的密码哈希进行校验，本地密码哈希超过LDAP_FALLBACK_MAX_AGE秒未经LDAP校验则不再使用
+LDAP_FALLBACK_ENABLED = getattr(customConfigs, 'LDAP_FALLBACK_ENABLED', False)
+LDAP_FALLBACK_MAX_AGE = getattr(customConfigs, 'LDAP_FALLBACK_MAX_AGE', 7 * 24 * 3600)
+# manage.py sync_ldap查询用户使用的过滤条件，为空时使用(uid=*)或(sAMAccountName=*)
+LDAP_SYNC_FILTER = getattr(customConfigs, 'LDAP_SYNC_FILTER', None)
+# manage.py sync_ldap --deactivate不禁用的本地用户及服务账号的用户名，超级管理员总是不会被禁用
+LDAP_SYNC_EXCLUDE_USERNAMES = getattr(customConfigs, 'LDAP_SYNC_EXCLUDE_USERNAMES', [])
 
 AUTH_USER_MODEL = "core.User"
 
@@ -0,0 +1,181 @@
+# coding: utf8
+"""
+签名临时token的生成与进程内校验，仅依赖标准库，接入SSO的应用可直接使用。
+
+token格式为 <key id>.<payload>.<signature>，payload为base64url编码的json：
+    uid: 用户id, usr: 用户名, cn: 中文名, eml: 邮箱, lgn: 最后登录时间（ISO格式）,
+    iat: 签发时间, exp: 过期时间, jti: token id
+signature为以key id对应密钥计算的 HMAC-SHA256("<key id>.<payload>")。
+
+吊销列表由SSO提供，包含已吊销token id的布隆过滤器及被禁用用户的吊销时间，
+TokenVerifier按sync_interval定期同步，校验token时不需要网络请求。
+"""
+import base64
+import hashlib
+import hmac
+import json
+import math
+import threading
+import time
+import urllib.request
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def get_signature(key, message):
+    if isinstance(key, str):
+        key = key.encode()
+    return b64encode(hmac.new(key, message.encode(), hashlib.sha256).digest())
+
+
+def sign_token(payload, key_id, key):
+    if "." in key_id:
+        raise ValueError("key id can not contain '.'")
+    message = "{}.{}".format(key_id, b64encode(json.dumps(payload, separators=(",", ":")).encode()))
+    return "{}.{}".format(message, get_signature(key, message))
+
+
+def is_signed_token(token):
+    return token.count(".") == 2
+
+
+# 校验签名及有效期，返回payload，不检查吊销列表
+def decode_token(token, keys, now=None):
+    try:
+        key_id, payload, signature = token.split(".")
+    except (AttributeError, ValueError):
+        raise InvalidToken("malformed token")
+    if key_id not in keys:
+        raise InvalidToken("unknown key id {}".format(key_id))
+    if not hmac.compare_digest(signature, get_signature(keys[key_id], "{}.{}".format(key_id, payload))):
+        raise InvalidToken("invalid signature")
+    try:
+        payload = json.loads(b64decode(payload).decode())
+    except ValueError:
+        raise InvalidToken("malformed payload")
+    if not isinstance(payload, dict) or payload.get("exp", 0) <= (now or time.time()):
+        raise InvalidToken("token expired")
+    return payload
+
+
+class BloomFilter:
+    """
+    位数组长度为size、使用hash_count个哈希函数的布隆过滤器，不存在误判为存在的概率由容量和位数决定
+    """
+    def __init__(self, size, hash_count, bits=None):
+        self.size = size
+        self.hash_count = hash_count
+        self.bits = bits or bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        return cls(size, max(int(round(size / capacity * math.log(2))), 1))
+
+    # 由一次sha256的两段结果组合出各哈希函数的位置
+    def get_positions(self, item):
+        digest = hashlib.sha256(str(item).encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self.get_positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] >> (position & 7) & 1 for position in self.get_positions(item))
+
+    def to_dict(self):
+        return {"size": self.size, "hash_count": self.hash_count, "bits": b64encode(bytes(self.bits))}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["size"], data["hash_count"], bytearray(b64decode(data["bits"])))
+
+
+# 生成吊销列表，token_ids为已吊销的token id，users为{用户id: 吊销时间}，吊销时间及之前签发的token均无效
+def build_revocation_list(token_ids, users, version, error_rate=0.001):
+    bloom = BloomFilter.for_capacity(len(token_ids), error_rate)
+    for token_id in token_ids:
+        bloom.add(token_id)
+    return {"version": version, "tokens": bloom.to_dict(),
+            "users": dict((str(user_id), int(revoked_at)) for user_id, revoked_at in users.items())}
+
+
+# 从SSO的revoked_tokens接口读取吊销列表，headers中需携带访问token，如{"access-token": "..."}
+def get_sso_revocation_fetcher(url, headers, timeout=5):
+    def fetch():
+        request = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode())["data"]
+    return fetch
+
+
+class TokenVerifier:
+    """
+    进程内校验签名token。
+    keys: {key id: 密钥}
+    fetch_revocations: 返回最新吊销列表的函数，为空时不检查吊销
+    check_revoked: 布隆过滤器命中时精确判断token id是否已吊销的函数，为空时按已吊销处理
+    sync_interval: 吊销列表的同步间隔（秒），同步失败时继续使用上次的列表
+    """
+    def __init__(self, keys, fetch_revocations=None, check_revoked=None, sync_interval=30):
+        self.keys = keys
+        self.fetch_revocations = fetch_revocations
+        self.check_revoked = check_revoked
+        self.sync_interval = sync_interval
+        self.version = None
+        self.tokens = None
+        self.users = {}
+        self.synced_at = 0
+        self.sync_lock = threading.Lock()
+
+    def load(self, revocations):
+        if revocations["version"] != self.version:
+            self.tokens = BloomFilter.from_dict(revocations["tokens"])
+            self.users = dict((int(user_id), revoked_at) for user_id, revoked_at in revocations["users"].items())
+            self.version = revocations["version"]
+
+    # 超过同步间隔时同步吊销列表，其它线程正在同步时直接使用当前列表
+    def sync(self, force=False):
+        if self.fetch_revocations is None or not (force or time.time() - self.synced_at >= self.sync_interval):
+            return
+        if not self.sync_lock.acquire(blocking=force or self.tokens is None):
+            return
+        try:
+            self.synced_at = time.time()
+            self.load(self.fetch_revocations())
+        except Exception:
+            # 从未同步成功时无法判断吊销状态，拒绝校验并在下次请求时重试
+            if self.tokens is None:
+                self.synced_at = 0
+                raise InvalidToken("revocation list unavailable")
+        finally:
+            self.sync_lock.release()
+
+    def is_revoked(self, payload):
+        if payload.get("iat", 0) <= self.users.get(payload.get("uid"), -1):
+            return True
+        if self.tokens is not None and payload.get("jti") in self.tokens:
+            return self.check_revoked(payload["jti"]) if self.check_revoked else True
+        return False
+
+    # 返回token的payload，token无效、过期或已吊销时抛出InvalidToken
+    def verify(self, token):
+        payload = decode_token(token, self.keys)
+        self.sync()
+        if self.is_revoked(payload):
+            raise InvalidToken("token revoked")
+        return payload